@@ -0,0 +1,82 @@
+import sys
+import json
+import time
+import tempfile
+from ctypes import c_float, c_uint32, c_ushort, byref
+from caen_r8033dm_wrapper import CAENR8033DM_WRAPPER
+from caen_fake import FakeCAENLibrary
+
+#Measures how many CAEN channel reads per second the Python side can make, before and after the typed bindings
+#The library is the stand in from caen_fake with no latency and no argument checks, so the time is all spent in this code
+#"Before" is the old get_channel_parameter_value, copied below, which checked every channel and allocated new arrays on every call
+#The watchdog and the I/O thread are turned off, so both sides make their library calls in this thread with nothing else polling the crate
+#Run like:
+#   python3 bench_caen_calls.py [config.json]
+
+prefix = "CAEN Call Benchmark"
+seconds = 1
+repeats = 5     #Each side is timed this many times, taking turns, and the best is kept, so a busy moment on the machine doesn't pick the winner
+all_chs = list(range(16))
+
+#The read the way it was done before the bindings, kept here only to compare against
+def legacy_read(caen, chns, param):
+    size = len(chns)
+    for ch in chns:
+        if param not in caen.ch_params[ch]:
+            sys.exit(f"{prefix} --> {param} missing for channel {ch}")
+        if (('Type' not in caen.ch_params[ch][param]) or ('Mode' not in caen.ch_params[ch][param])):
+            sys.exit(f"{prefix} --> {param} has no Type or Mode for channel {ch}")
+        if (caen.ch_params[ch][param]['Mode'] == caen.PropertyMode.PARAM_MODE_WRONLY):
+            sys.exit(f"{prefix} --> {param} is write only")
+    if (caen.ch_params[chns[0]][param]['Type'] == caen.PropertyType.PARAM_TYPE_FLOAT.name):
+        c_param_val = (c_float * size)()
+    else:
+        c_param_val = (c_uint32 * size)()
+    c_ch_list = (c_ushort * size)()
+    for num,ch in enumerate(chns):
+        c_ch_list[num] = ch
+    return_code = caen.libcaenhvwrapper.CAENHV_GetChParam(caen.caen, c_ushort(caen.slot), param.encode('utf-8'), c_ushort(size), byref(c_ch_list), byref(c_param_val))
+    if (return_code != 0):
+        sys.exit(f"{prefix} --> Reading {param} failed with error code {hex(return_code)}")
+    for num,ch in enumerate(chns):
+        caen.ch_params[ch][param]["Value"] = c_param_val[num]
+    return c_param_val[:]
+
+def legacy_monitor_row(caen, chns, row):
+    row[1::2] = legacy_read(caen, chns, "VMon")
+    row[2::2] = legacy_read(caen, chns, "IMon")
+
+def rate(function):
+    count = 0
+    start = time.perf_counter()
+    end = start + seconds
+    while (time.perf_counter() < end):
+        for _ in range(100):
+            function()
+        count += 100
+    return count / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    config_file = sys.argv[1] if len(sys.argv) > 1 else "config.json"
+    with open(config_file, "r") as jsonfile:
+        json_data = json.load(jsonfile)
+    #Keep the metadata cache for the fake crate out of the real one
+    json_data['caenR8033DM_metadata_cache'] = tempfile.mkdtemp()
+    json_data['caenR8033DM_watchdog'] = "False"
+    json_data['caenR8033DM_io_thread'] = "False"
+    library = FakeCAENLibrary(check_types=False)
+    wrapper = CAENR8033DM_WRAPPER(json_data, library=library)
+    caen = wrapper.caen
+    row = [0.0] * (1 + (2 * len(all_chs)))
+
+    runs = []
+    runs.append(("16 channel VMon read", lambda: legacy_read(caen, all_chs, "VMon"), lambda: caen.get_channel_parameter_value(all_chs, "VMon", raw=True)))
+    runs.append(("1 channel VMon read", lambda: legacy_read(caen, [3], "VMon"), lambda: caen.get_channel_parameter_value(3, "VMon")))
+    runs.append(("16 channel VMon and IMon row", lambda: legacy_monitor_row(caen, all_chs, row), lambda: wrapper.get_monitor_row(all_chs, row)))
+    for name, before, after in runs:
+        before_rate = 0
+        after_rate = 0
+        for _ in range(repeats):
+            before_rate = max(before_rate, rate(before))
+            after_rate = max(after_rate, rate(after))
+        print(f"{prefix} --> {name:<30} before {before_rate:10.0f}/s    after {after_rate:10.0f}/s    {after_rate/before_rate:5.2f}x")
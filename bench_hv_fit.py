@@ -0,0 +1,87 @@
+import sys
+import time
+import numpy as np
+from scipy.optimize import curve_fit
+from hv_fit import fit_exponentials
+from hv_capture import CaptureCache
+
+#Compares the old per channel curve_fit against the vectorized fit, with and without the closed form fast path
+#Synthetic captures have a known tau, so the error is against the truth. For recorded captures there is no truth,
+#so the error is against curve_fit. Run like:
+#   python3 bench_hv_fit.py
+#   python3 bench_hv_fit.py results/20240708162535/name_ch0_pos_open_on.csv [more captures...]
+
+prefix = "HV Fit Benchmark"
+repeats = 5
+fast_path_residual = 0.02
+
+def exp_fit(x, a, b, c):
+    return a*np.exp(-b*x) + c
+
+#The way hv_curve_fit used to do it, one channel at a time. It used to start from 1,1,1, which never finds the relaxing voltages,
+#so the baseline gets a fair start from the ends of the curve and the usual range of tau, so it's comparing fits that actually converge
+def fit_curve_fit(t, y):
+    taus = []
+    duration = t[-1] - t[0]
+    for num in range(y.shape[1]):
+        p0 = [y[0, num] - y[-1, num], 3.0 / duration, y[-1, num]]
+        try:
+            taus.append(curve_fit(exp_fit, t, y[:, num], p0=p0, maxfev=10000)[0][1])
+        except RuntimeError:
+            taus.append(0)
+    return np.array(taus), np.full(y.shape[1], "curve_fit")
+
+def fit_full(t, y):
+    results = fit_exponentials(t, y)
+    return results['tau'], results['method']
+
+def fit_fast(t, y):
+    results = fit_exponentials(t, y, fast_path_residual=fast_path_residual)
+    return results['tau'], results['method']
+
+methods = [("curve_fit", fit_curve_fit), ("vectorized", fit_full), ("fast path", fit_fast)]
+
+#16 channels of charging currents and relaxing voltages, like one phase of the HV test
+#taus is the range of the rates, the fast ones are over in a few samples, which is where the closed form gets tau wrong
+def synthetic_capture(noise, seed=0, taus=(0.01, 0.03)):
+    rng = np.random.default_rng(seed)
+    t = np.arange(300.0)
+    taus = rng.uniform(taus[0], taus[1], 16)
+    amplitudes = np.where(np.arange(16) % 2 == 0, 1.0, -1500.0) * rng.uniform(0.5, 1.5, 16)
+    offsets = np.where(np.arange(16) % 2 == 0, 0.05, 1500.0)
+    clean = amplitudes*np.exp(-np.outer(t, taus)) + offsets
+    y = clean + (rng.normal(0, 1, clean.shape) * noise * np.abs(amplitudes))
+    return t, y, taus
+
+def recorded_capture(path):
+    capture = CaptureCache().get(path)
+    t = capture.time() - capture.time()[0]
+    y = np.stack([capture.current(ch) for ch in range(16)] + [capture.voltage(ch) for ch in range(16)], axis=1)
+    return t, y
+
+def run(name, t, y, truth=None):
+    reference = None
+    print(f"{prefix} --> {name}: {len(t)} samples x {y.shape[1]} channels")
+    for method_name, method in methods:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            taus, paths = method(t, y)
+        elapsed = (time.perf_counter() - start) / repeats
+        if (method_name == "curve_fit"):
+            reference = taus
+        compare = truth if truth is not None else reference
+        with np.errstate(divide='ignore', invalid='ignore'):
+            error = np.nanmax(np.abs((taus / compare) - 1))
+        closed_form = int((paths == "closed_form").sum())
+        print(f"    {method_name:<12} {elapsed*1000:9.2f} ms    max tau error {error:.2e}    closed form used for {closed_form}/{y.shape[1]}")
+
+if __name__ == "__main__":
+    with np.errstate(over='ignore'):
+        for noise in [0.0, 0.001, 0.01, 0.05]:
+            t, y, taus = synthetic_capture(noise)
+            run(f"Synthetic, noise {noise} of the amplitude", t, y, taus)
+        t, y, taus = synthetic_capture(0.001, taus=(0.2, 1.0))
+        run("Synthetic fast decays, noise 0.001 of the amplitude", t, y, taus)
+        for path in sys.argv[1:]:
+            t, y = recorded_capture(path)
+            run(f"Recorded {path}", t, y)
@@ -0,0 +1,226 @@
+import time
+import threading
+import numpy as np
+from ctypes import Structure, c_int, c_uint, c_uint32, c_float, c_char, POINTER, byref, create_string_buffer
+
+#Event mode acquisition for the CAEN crate. Instead of asking for VMon, IMon and Status over and over,
+#the crate is asked to send a message whenever one of them changes, and those messages are picked up here
+#A reader thread takes the events out of the library and puts them in a ring buffer, and the capture takes them out of
+#the ring buffer and keeps the latest value of every channel and parameter
+#The library only supports this on some crates, if subscribing fails the caller should go back to polling
+
+#Layouts from CAENHVWrapper.h, for the events the library hands back
+#There's no copy of the header in this repository to check these against, so every event is checked as it comes in instead.
+#One that names another board, a channel the crate doesn't have or a parameter that wasn't subscribed means the layout
+#doesn't match the library, and the capture goes back to polling rather than trusting anything else that comes out of it
+class CAENHVEvent(Structure):
+    _fields_ = [("Type", c_int),                #0 is a parameter change, 1 an alarm, 2 a keepalive
+                ("ItemID", c_char * 20),        #Name of the parameter that changed
+                ("Lvalue", c_uint32),           #Value for integer parameters like Status
+                ("Fvalue", c_float),            #Value for float parameters like VMon
+                ("Tvalue", c_char * 256),
+                ("SystemHandle", c_int),
+                ("BoardIndex", c_int),
+                ("ChannelIndex", c_int)]
+
+class CAENHVSystemStatus(Structure):
+    _fields_ = [("System", c_int),
+                ("Board", c_int * 16)]
+
+event_parameter = 0
+
+#Layout of one slot of the ring buffer
+event_dtype = np.dtype([("time", np.float64), ("ch", np.uint16), ("param", np.uint8), ("value", np.float64)])
+
+#Fixed size ring buffer with one thread putting events in and one thread taking them out, and no lock between them
+#Only the writer moves head and only the reader moves tail. The writer fills the slot before moving head past it,
+#so the reader never sees a slot that's half written. Assigning an int is atomic in CPython, which is all that's needed
+#When it's full new events are dropped and counted, rather than overwriting ones the reader hasn't got to yet
+class EventRing:
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.slots = np.zeros(capacity, dtype=event_dtype)
+        self.head = 0           #Total events ever written, only changed by the writer
+        self.tail = 0           #Total events ever read, only changed by the reader
+        self.dropped = 0        #Events thrown away because the reader was a whole ring behind
+
+    def push(self, when, ch, param, value):
+        head = self.head
+        if (head - self.tail >= self.capacity):
+            self.dropped += 1
+            return False
+        self.slots[head % self.capacity] = (when, ch, param, value)
+        self.head = head + 1
+        return True
+
+    #Takes everything that's waiting out of the ring and returns it as a copy, oldest first
+    def pop_all(self):
+        head = self.head
+        tail = self.tail
+        if (head == tail):
+            return self.slots[:0].copy()
+        start = tail % self.capacity
+        end = head % self.capacity
+        if (start < end):
+            events = self.slots[start:end].copy()
+        else:
+            events = np.concatenate((self.slots[start:], self.slots[:end]))
+        self.tail = head
+        return events
+
+    def __len__(self):
+        return self.head - self.tail
+
+#Subscribes to the monitored parameters of the given channels and keeps their latest values from the events
+#Use it like:
+#   events = EventAcquisition(caen, list(range(16)))
+#   if (not events.start()):
+#       events = None       #The crate doesn't do events, keep polling
+#   ...
+#   if (events.usable([0, 1, 2])):
+#       row = events.get_monitor_row([0, 1, 2])
+#   events.stop()
+class EventAcquisition:
+    def __init__(self, caen, chs, params=("VMon", "IMon", "Status"), port=0, capacity=65536, poll_interval=0.005, stale_after=5):
+        self.prefix = "CAEN Events"         #Prefix for log messages
+        self.caen = caen                    #The CAENR8033DM the subscription is made on
+        self.chs = chs
+        self.params = params
+        self.param_index = {param.encode('utf-8'): num for num,param in enumerate(params)}
+        self.port = port                    #Local UDP port the crate sends the events to
+        self.poll_interval = poll_interval  #Seconds the reader thread sleeps when the library has nothing for it
+        self.ring = EventRing(capacity)
+        #Latest value of every parameter of every channel, filled from the crate before the events start coming in
+        self.values = np.zeros((caen.num_of_channels, len(params)))
+        self.updated = np.zeros((caen.num_of_channels, len(params)))       #Monotonic time of the last change of each value
+        self.stale_after = stale_after      #Seconds without hearing anything from the crate before the values aren't trusted
+        self.last_heard = None              #Monotonic time the library last handed over any event, keepalives included
+        self.events_received = 0
+        self.events_rejected = 0            #Events that can't be from this crate, any at all and the events aren't used anymore
+        self.polled_rows = 0                #Rows the caller had to poll for because the events weren't usable
+        self.unusable = None                #Why the events stopped being used, None while they're fine
+        self.subscribed = []
+        self.running = False
+        self.thread = None
+
+    #Subscribes every channel. Returns False if the crate turned any of it down, after undoing what did work
+    def start(self):
+        names = ":".join(self.params).encode('utf-8')
+        for ch in self.chs:
+            results = create_string_buffer(len(self.params))
+            return_code = self.caen.libcaenhvwrapper.CAENHV_SubscribeChannelParams(self.caen.caen, self.port, self.caen.slot, ch,
+                                                                                   names, len(self.params), results)
+            if (return_code != 0 or any(results.raw)):
+                print(f"{self.prefix} --> Channel {ch} subscription failed with error code {hex(return_code)}, results {list(results.raw)}")
+                self.unsubscribe()
+                return False
+            self.subscribed.append(ch)
+        #The events only say what changed, so start from what the crate has now
+        now = time.monotonic()
+        for num,param in enumerate(self.params):
+            self.values[self.chs, num] = self.caen.get_channel_parameter_value(self.chs, param, raw=True)
+            self.updated[self.chs, num] = now
+        self.last_heard = now
+        self.running = True
+        self.thread = threading.Thread(target=self.read_events, name="CAEN event reader", daemon=True)
+        self.thread.start()
+        print(f"{self.prefix} --> Subscribed to {list(self.params)} on channels {self.chs}")
+        return True
+
+    def unsubscribe(self):
+        names = ":".join(self.params).encode('utf-8')
+        for ch in self.subscribed:
+            results = create_string_buffer(len(self.params))
+            self.caen.libcaenhvwrapper.CAENHV_UnSubscribeChannelParams(self.caen.caen, self.port, self.caen.slot, ch,
+                                                                       names, len(self.params), results)
+        self.subscribed = []
+
+    def stop(self):
+        self.running = False
+        if (self.thread):
+            self.thread.join()
+            self.thread = None
+        self.unsubscribe()
+
+    #Reader thread. Everything the library has is moved into the ring buffer, and the library's copy is freed straight away
+    def read_events(self):
+        status = CAENHVSystemStatus()
+        events = POINTER(CAENHVEvent)()
+        count = c_uint()
+        library = self.caen.libcaenhvwrapper
+        while (self.running):
+            return_code = library.CAENHV_GetEventData(self.caen.caen, byref(status), byref(events), byref(count))
+            if (return_code != 0):
+                print(f"{self.prefix} --> Getting events failed with error code {hex(return_code)}")
+                time.sleep(self.poll_interval)
+                continue
+            if (count.value == 0):
+                time.sleep(self.poll_interval)
+                continue
+            now = time.monotonic()
+            self.last_heard = now
+            for num in range(count.value):
+                event = events[num]
+                if (event.Type != event_parameter):
+                    continue
+                if (event.ItemID not in self.param_index or event.BoardIndex != self.caen.slot
+                    or event.ChannelIndex < 0 or event.ChannelIndex >= self.caen.num_of_channels):
+                    self.events_rejected += 1
+                    continue
+                param = self.param_index[event.ItemID]
+                if (self.params[param] == "Status"):
+                    value = event.Lvalue
+                else:
+                    value = event.Fvalue
+                self.ring.push(now, event.ChannelIndex, param, value)
+            library.CAENHV_FreeEventData(byref(events))
+
+    #Takes everything out of the ring buffer and brings the latest values up to date. Returns how many events there were
+    def drain(self):
+        events = self.ring.pop_all()
+        if (len(events)):
+            #Fancy index assignment keeps the last of any repeats, which is the newest since the ring is in order
+            self.values[events["ch"], events["param"]] = events["value"]
+            self.updated[events["ch"], events["param"]] = events["time"]
+            self.events_received += len(events)
+        return len(events)
+
+    #Whether the latest values can be used for these channels. They can't once an event has been rejected, or when nothing has come from
+    #the crate, not even a keepalive, and none of the channels' values have changed for stale_after seconds. Then the caller should poll
+    def usable(self, chs):
+        self.drain()
+        if (self.unusable is None):
+            if (self.events_rejected):
+                self.unusable = f"{self.events_rejected} event(s) didn't match the crate, the event layout can't be trusted"
+            elif (time.monotonic() - max(self.last_heard, self.updated[chs].max()) > self.stale_after):
+                self.unusable = f"nothing heard from the crate for {self.stale_after} seconds"
+            if (self.unusable is not None):
+                print(f"{self.prefix} --> {self.unusable}, polling instead")
+                #Nothing reads the events after this, so the reader thread and the crate's subscriptions are let go
+                self.stop()
+        if (self.unusable is not None):
+            self.polled_rows += 1
+            return False
+        return True
+
+    def latest(self, chs, param):
+        self.drain()
+        return self.values[chs, self.params.index(param)]
+
+    #Same row layout and rounding as the wrapper's get_monitor_row, [time, ch V, ch I, ch V, ch I, ...], with nothing read from the crate
+    def get_monitor_row(self, chs, row=None):
+        if (row is None):
+            row = [None] * (1 + (2 * len(chs)))
+        self.drain()
+        row[1::2] = self.values[chs, self.params.index("VMon")].round(self.caen.rounding_factor).tolist()
+        row[2::2] = self.values[chs, self.params.index("IMon")].round(self.caen.rounding_factor).tolist()
+        return row
+
+    def stats(self):
+        results = {}
+        results['events_received'] = self.events_received
+        results['events_dropped'] = self.ring.dropped
+        results['events_rejected'] = self.events_rejected
+        results['polled_rows'] = self.polled_rows
+        results['unusable'] = self.unusable
+        return results
@@ -0,0 +1,249 @@
+import time
+import random
+import threading
+from collections import deque
+from caen_events import CAENHVEvent, event_parameter
+from ctypes import c_char, c_void_p, c_ushort, addressof, create_string_buffer, memmove, sizeof
+
+#Stand in for libcaenhvwrapper, so the CAEN classes can be run and benchmarked with no crate attached
+#It answers the same calls as the real library for one R8033DM with 16 channels, writing its answers into the same memory layouts
+#Pass it as the library when making the low level class:
+#   caen = CAENR8033DM(json_data, library=FakeCAENLibrary())
+#Every call is counted in calls, and latency adds a delay to each one like the network round trip to a real crate
+#check_types can be turned off when timing the Python side, since checking the arguments costs about as much as a real call
+#Event mode works too. Changes made through update() are sent to anything subscribed, and FakeEventSource keeps the monitored
+#values moving the way a crate's would. With supports_events=False it turns subscriptions down like a crate without events
+
+#One library function. It takes argtypes and restype like a ctypes function does, and checks every argument against
+#the argtypes the same way ctypes would, so a call that wouldn't work on the real library fails here too
+class FakeFunction:
+    def __init__(self, name, library, function):
+        self.name = name
+        self.library = library
+        self.function = function
+        self.argtypes = None
+        self.restype = None
+
+    def __call__(self, *args):
+        if (self.argtypes is not None and self.library.check_types):
+            if (len(args) != len(self.argtypes)):
+                raise TypeError(f"{self.name} takes {len(self.argtypes)} arguments ({len(args)} given)")
+            for argtype, arg in zip(self.argtypes, args):
+                argtype.from_param(arg)
+        self.library.calls[self.name] = self.library.calls.get(self.name, 0) + 1
+        if (self.library.latency):
+            time.sleep(self.library.latency)
+        return self.function(*args)
+
+#Gets the ctypes object behind an argument, whether it was passed as is or through byref
+def target(arg):
+    return getattr(arg, "_obj", arg)
+
+#Gets the number out of an argument, whether it's a plain int or a ctypes number
+def number(arg):
+    return getattr(target(arg), "value", arg)
+
+class FakeCAENLibrary:
+    #Parameter name to (Type, Mode), using the numbers from the PropertyType and PropertyMode enums
+    board_params = {"BdIlk": (1, 0), "BdIlkm": (1, 2), "BdCtr": (1, 0), "BdStatus": (3, 0), "HVMax": (0, 0)}
+    ch_params = {"VSet": (0, 2), "ISet": (0, 2), "VMon": (0, 0), "IMon": (0, 0), "RUp": (0, 2), "RDwn": (0, 2),
+                 "Trip": (0, 2), "PDwn": (1, 2), "IMRange": (1, 2), "Status": (2, 0), "Pw": (1, 2)}
+    name_size = 10
+
+    def __init__(self, num_of_channels=16, latency=0, model="R8033DM", serial=1, check_types=True, supports_events=True):
+        self.num_of_channels = num_of_channels
+        self.latency = latency              #Seconds added to every call
+        self.check_types = check_types      #Whether arguments are checked against the argtypes
+        self.model = model
+        self.serial = serial
+        self.calls = {}                     #Function name to the number of times it was called
+        self.ch_values = {param: [0] * num_of_channels for param in self.ch_params}
+        self.board_values = {param: 0 for param in self.board_params}
+        self.keep = []                      #Memory handed back through pointers has to outlive the call
+        self.supports_events = supports_events
+        self.subscriptions = set()          #(channel, parameter) pairs that changes are sent for
+        self.pending_events = deque()       #(channel, parameter, value) waiting for the next CAENHV_GetEventData
+        self.event_blocks = {}              #Address of each block of events handed out, to the block, until it's freed
+        for name in dir(self):
+            if (name.startswith("CAENHV_")):
+                setattr(self, name, FakeFunction(name, self, getattr(self, name)))
+
+    #Points a pointer the caller passed in at memory the library owns, like the real library does for its lists
+    def point(self, arg, buffer):
+        self.keep.append(buffer)
+        c_void_p.from_buffer(target(arg)).value = addressof(buffer)
+
+    #A block of fixed size names, ending with a non alphanumeric entry the way the real lists seem to
+    def name_list(self, names):
+        buffer = (c_char * (self.name_size * (len(names) + 1)))()
+        for num,name in enumerate(names):
+            start = num * self.name_size
+            buffer[start:start+len(name)] = name.encode('utf-8')
+        buffer[len(names) * self.name_size] = b"\x01"
+        return buffer
+
+    def property(self, params, param, prop, result):
+        param_type, param_mode = params[param.decode('utf-8')]
+        result = target(result)
+        if (prop == b"Type"):
+            result.value = param_type
+        elif (prop == b"Mode"):
+            result.value = param_mode
+        elif (prop == b"Onstate"):
+            result.value = b"On"
+        elif (prop == b"Offstate"):
+            result.value = b"Off"
+        elif (prop == b"Maxval"):
+            result.value = 3000
+        else:
+            result.value = 0
+        return 0
+
+    #Changes a channel value the way the crate would on its own, and sends the change to anything subscribed to it
+    def update(self, ch, param, value):
+        self.ch_values[param][ch] = value
+        if ((ch, param) in self.subscriptions):
+            self.pending_events.append((ch, param, value))
+
+    def CAENHV_InitSystem(self, system, link_type, arg, username, password, handle):
+        handle.contents.value = 0
+        return 0
+
+    def CAENHV_DeinitSystem(self, handle):
+        return 0
+
+    def CAENHV_GetCrateMap(self, handle, num_of_slots, num_of_channels, models, descriptions, serials, firmware_min, firmware_max):
+        target(num_of_slots).value = 1
+        self.point(num_of_channels, (c_ushort * 1)(self.num_of_channels))
+        self.point(models, create_string_buffer(self.model.encode('utf-8')))
+        self.point(serials, (c_ushort * 1)(self.serial))
+        return 0
+
+    def CAENHV_GetSysPropList(self, handle, prop_num, prop_list):
+        target(prop_num).value = 0
+        return 0
+
+    def CAENHV_GetBdParamInfo(self, handle, slot, param_list):
+        self.point(param_list, self.name_list(list(self.board_params)))
+        return 0
+
+    def CAENHV_GetBdParamProp(self, handle, slot, param, prop, result):
+        return self.property(self.board_params, param, prop, result)
+
+    def CAENHV_GetBdParam(self, handle, num_of_slots, slots, param, result):
+        target(result).value = self.board_values[param.decode('utf-8')]
+        return 0
+
+    def CAENHV_SetBdParam(self, handle, num_of_slots, slots, param, value):
+        self.board_values[param.decode('utf-8')] = target(value).value
+        return 0
+
+    def CAENHV_GetChParamInfo(self, handle, slot, ch, param_list, param_num):
+        self.point(param_list, self.name_list(list(self.ch_params)))
+        target(param_num).value = len(self.ch_params)
+        return 0
+
+    def CAENHV_GetChParamProp(self, handle, slot, ch, param, prop, result):
+        return self.property(self.ch_params, param, prop, result)
+
+    #The real library writes 12 character names one after another into the memory it's given
+    #Only as much as fits in the caller's memory is written, so a short buffer doesn't get overrun here
+    def CAENHV_GetChName(self, handle, slot, size, ch_list, names):
+        chs = target(ch_list)
+        names = target(names)
+        block = b"".join(f"CH{chs[num]:02d}".encode('utf-8').ljust(12, b"\0") for num in range(number(size)))
+        memmove(names, block, min(len(block), sizeof(names)))
+        return 0
+
+    def CAENHV_GetChParam(self, handle, slot, param, size, ch_list, values):
+        chs = target(ch_list)
+        values = target(values)
+        ch_values = self.ch_values[param.decode('utf-8')]
+        for num in range(number(size)):
+            values[num] = ch_values[chs[num]]
+        return 0
+
+    def CAENHV_SetChParam(self, handle, slot, param, size, ch_list, values):
+        chs = target(ch_list)
+        values = target(values)
+        ch_values = self.ch_values[param.decode('utf-8')]
+        for num in range(number(size)):
+            ch_values[chs[num]] = values[num]
+        return 0
+
+    def CAENHV_SubscribeChannelParams(self, handle, port, slot, ch, params, num_of_params, results):
+        results = target(results)
+        if (not self.supports_events):
+            for num in range(number(num_of_params)):
+                results[num] = 1
+            return 0x3f
+        for param in params.decode('utf-8').split(":"):
+            self.subscriptions.add((number(ch), param))
+        return 0
+
+    def CAENHV_UnSubscribeChannelParams(self, handle, port, slot, ch, params, num_of_params, results):
+        for param in params.decode('utf-8').split(":"):
+            self.subscriptions.discard((number(ch), param))
+        return 0
+
+    #Hands over everything that's changed since the last call, in a block of events the caller has to give back to FreeEventData
+    def CAENHV_GetEventData(self, handle, status, events, count):
+        changes = []
+        while self.pending_events:
+            changes.append(self.pending_events.popleft())
+        target(count).value = len(changes)
+        if (not changes):
+            return 0
+        block = (CAENHVEvent * len(changes))()
+        for num,(ch, param, value) in enumerate(changes):
+            block[num].Type = event_parameter
+            block[num].ItemID = param.encode('utf-8')
+            block[num].ChannelIndex = ch
+            if (self.ch_params[param][0] == 0):
+                block[num].Fvalue = value
+            else:
+                block[num].Lvalue = int(value)
+        self.event_blocks[addressof(block)] = block
+        c_void_p.from_buffer(target(events)).value = addressof(block)
+        return 0
+
+    def CAENHV_FreeEventData(self, events):
+        address = c_void_p.from_buffer(target(events)).value
+        if (self.event_blocks.pop(address, None) is None):
+            return 1
+        return 0
+
+#Stands in for the crate's own changes in event mode, moving VMon and IMon every interval so there's always something to send
+#Each channel sits at its VSet with a little noise while it's on, and near 0 while it's off
+#Use it like:
+#   source = FakeEventSource(library, 0.05)
+#   source.start()
+#   ...
+#   source.stop()
+class FakeEventSource:
+    def __init__(self, library, interval=0.05, noise=0.01):
+        self.library = library
+        self.interval = interval            #Seconds between changes, 0.05 is 20 changes a second for every channel
+        self.noise = noise                  #Size of the random wobble on every value
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="Fake CAEN event source", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if (self.thread):
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        library = self.library
+        while (self.running):
+            for ch in range(library.num_of_channels):
+                level = library.ch_values["VSet"][ch] if library.ch_values["Pw"][ch] else 0
+                library.update(ch, "VMon", level + random.uniform(-self.noise, self.noise))
+                library.update(ch, "IMon", random.uniform(-self.noise, self.noise))
+            time.sleep(self.interval)
@@ -0,0 +1,120 @@
+import time
+import queue
+import atexit
+import threading
+from concurrent.futures import Future
+
+#One thread that owns the CAEN handle and makes every call into the C library, so the library is never entered from two threads at once
+#Anything can hand it work from any thread and get a future back. A request can be a single library call, or a function that
+#makes several, like a snapshot of a few parameters, and nothing from another thread gets in between the calls of one request
+#A request made from the I/O thread itself, from inside another request, runs straight away instead of waiting behind itself
+#With threaded=False there's no thread and requests run in the thread that made them, one at a time behind a lock
+#Use it like:
+#   io = CAENRequestQueue()
+#   future = io.submit(read_things, [0, 1, 2])
+#   values = future.result()
+#   value = io.call(read_things, [3])      #Same thing, waiting for the answer
+#   io.stop()
+class CAENRequestQueue:
+    def __init__(self, threaded=True):
+        self.prefix = "CAEN I/O"            #Prefix for log messages
+        self.requests = queue.SimpleQueue() #(future, function, args, name, monotonic time submitted, queue depth then), None to stop
+        self.lock = threading.RLock()       #Only used when there's no thread
+        self.state_lock = threading.Lock()  #Keeps a request from being queued after the thread has been told to stop
+        self.latency = {}                   #Request name to [count, total seconds, max seconds] for running it
+        self.waited = 0                     #Total seconds requests spent in the queue before they started
+        self.submitted = 0                  #Requests that went through the queue
+        self.depth_total = 0                #Queue depth seen by each request as it was submitted, added up
+        self.depth_max = 0
+        self.thread = None
+        if (threaded):
+            self.thread = threading.Thread(target=self.serve, name="CAEN I/O", daemon=True)
+            self.thread.start()
+            #Stopped before the interpreter starts shutting down, after that a daemon thread can't run anymore,
+            #and the disconnect in CAENR8033DM.__del__ would wait on it forever. Calls made later just run in line
+            atexit.register(self.stop)
+
+    def submit(self, function, *args, name=None):
+        if (name is None):
+            name = getattr(function, "__name__", str(function))
+        future = Future()
+        with self.state_lock:
+            queued = (self.thread is not None and threading.get_ident() != self.thread.ident)
+            if (queued):
+                self.requests.put((future, function, args, name, time.monotonic(), self.requests.qsize()))
+        if (not queued):
+            with self.lock:
+                self.run(future, function, args, name, time.monotonic(), None)
+        return future
+
+    def call(self, function, *args, name=None):
+        return self.submit(function, *args, name=name).result()
+
+    #The stats are only changed here, by whichever thread is running requests, so they don't need a lock of their own
+    def run(self, future, function, args, name, submitted, depth):
+        start = time.monotonic()
+        try:
+            future.set_result(function(*args))
+        except BaseException as e:
+            #sys.exit from a request comes out in the thread waiting on it, like it would have without the queue
+            future.set_exception(e)
+        done = time.monotonic()
+        if (depth is not None):
+            self.waited += start - submitted
+            self.submitted += 1
+            self.depth_total += depth
+            self.depth_max = max(self.depth_max, depth)
+        record = self.latency.setdefault(name, [0, 0, 0])
+        record[0] += 1
+        record[1] += done - start
+        record[2] = max(record[2], done - start)
+
+    def serve(self):
+        while (True):
+            request = self.requests.get()
+            if (request is None):
+                break
+            self.run(*request)
+
+    #Everything queued before this still gets run, anything after runs in line
+    def stop(self):
+        with self.state_lock:
+            thread = self.thread
+            self.thread = None
+            if (thread is None):
+                return
+            self.requests.put(None)
+        if (threading.get_ident() != thread.ident):
+            thread.join()
+        atexit.unregister(self.stop)
+
+    #Summary of how busy the I/O thread was, meant to go into the datastore JSON
+    def stats(self):
+        results = {}
+        results['requests'] = sum(record[0] for record in self.latency.values())
+        results['queued'] = self.submitted
+        results['queue_wait_mean'] = self.waited / self.submitted if self.submitted else None
+        results['queue_depth_mean'] = self.depth_total / self.submitted if self.submitted else None
+        results['queue_depth_max'] = self.depth_max
+        results['latency'] = {}
+        for name, (count, total, longest) in list(self.latency.items()):
+            results['latency'][name] = {"count": count, "mean": total / count, "max": longest}
+        return results
+
+#Stands in for the CAEN library and sends every CAENHV_ call to the I/O thread. Anything else is passed straight through
+class LibraryProxy:
+    def __init__(self, library, io):
+        self.library = library
+        self.io = io
+        self.functions = {}
+
+    def __getattr__(self, name):
+        attribute = getattr(self.library, name)
+        if (not name.startswith("CAENHV_")):
+            return attribute
+        if (name not in self.functions):
+            io = self.io
+            def call(*args):
+                return io.call(attribute, *args, name=name)
+            self.functions[name] = call
+        return self.functions[name]
@@ -10,12 +10,28 @@ CAENHV_GetSysPropList returns 0 system properties and a null pointer
 """
 import sys
 import os
+import json
+import time
 import pprint
 from enum import IntEnum
-from ctypes import c_int, c_float, c_void_p, c_char_p, c_char, c_ushort, pointer, cdll, cast, POINTER, byref, sizeof, c_ulong, c_uint32, c_long, c_short, create_string_buffer, c_uint8
+import threading
+from caen_events import EventAcquisition
+from caen_io import CAENRequestQueue, LibraryProxy
+from ctypes import c_int, c_float, c_void_p, c_char_p, c_char, c_ushort, pointer, cdll, cast, POINTER, byref, sizeof, c_ulong, c_uint, c_uint32, c_long, c_short, create_string_buffer, c_uint8
+
+#Command line option for the test scripts to ignore the parameter metadata cache and read everything from the crate again
+refresh_metadata_flag = "--refresh-metadata"
+
+#Takes the refresh option out of the command line arguments if it's there, so the scripts can count their other arguments as usual
+def pop_refresh_metadata(argv):
+    if (refresh_metadata_flag in argv):
+        argv.remove(refresh_metadata_flag)
+        return True
+    return False
 
 class CAENR8033DM:
-    def __init__(self, json_data):
+    #library can be given to use something other than the real driver, like the stand in from caen_fake
+    def __init__(self, json_data, library=None):
         self.prefix = "CAEN R8033DM"    #Prefix for log messages
         self.error = "Error"            #Listing in the dictionary for when the return is an error
         self.rounding_factor = 2        #Round the return floats to this value
@@ -29,15 +45,36 @@ class CAENR8033DM:
         self.board_params = {}
         self.ch_params = {}
         self.json_data = json_data
-
-        try:
-            dllpath = os.path.join(os.getcwd(), self.json_data['caenR8033DM_driver'])
-            self.libcaenhvwrapper = cdll.LoadLibrary(dllpath)
-        except Exception as e:
-            print(e)
-            sys.exit(f"{self.prefix} --> Could not load CAEN's C library at {dllpath}")
+        self.param_names = {}           #Parameter names already encoded for the C library
+        #Each thread keeps its own channel_reads and channel_writes, so two threads never fill the same ctypes buffer. See thread_buffers
+        self.thread_local = threading.local()
+        #Channel settings only change when we write them, so they're kept in memory instead of being read from the crate every time
+        #Monitored values like VMon, IMon and Status aren't in this list and always come from the crate
+        self.cached_settings = ("VSet", "ISet", "RUp", "RDwn", "Trip", "IMRange", "PDwn")
+        self.settings_ttl = self.json_data.get('caenR8033DM_settings_ttl', 60)     #Seconds before a cached setting is read from the crate again anyway
+        self.settings = {}              #(channel, parameter) to (value, monotonic time it stops being trusted)
+        self.settings_hits = 0          #Reads of a setting answered from memory
+        self.settings_misses = 0        #Reads of a setting that had to go to the crate
+        self.events = None              #Event mode acquisition when it's on and the crate supports it, otherwise everything is polled
+        self.io = None                  #The thread that makes every library call, see caen_io.py
+        self.closed = False             #Set once close() has disconnected from the crate
+
+        if (library is not None):
+            self.libcaenhvwrapper = library
+            dllpath = type(library).__name__
+        else:
+            try:
+                dllpath = os.path.join(os.getcwd(), self.json_data['caenR8033DM_driver'])
+                self.libcaenhvwrapper = cdll.LoadLibrary(dllpath)
+            except Exception as e:
+                print(e)
+                sys.exit(f"{self.prefix} --> Could not load CAEN's C library at {dllpath}")
 
         print(f"{self.prefix} --> CAEN's C library opened at {dllpath}")
+        self.declare_signatures()
+        #Every call into the library goes through one I/O thread from here on, so monitoring threads can share the handle with the test
+        self.io = CAENRequestQueue(self.json_data.get('caenR8033DM_io_thread', "True") == "True")
+        self.libcaenhvwrapper = LibraryProxy(self.libcaenhvwrapper, self.io)
 
         #Integer handler for the connection
         self.caen = c_int()
@@ -53,8 +90,14 @@ class CAENR8033DM:
 
         self.get_crate_info()
         #self.get_sys_info()
-        self.get_board_info()
-        self.get_channel_info()
+        #Walking every parameter's properties takes over a thousand library calls, and they never change for a given crate and driver
+        #So they're saved to disk the first time, and after that only the values are read back from the crate
+        if (self.json_data.get('caenR8033DM_refresh_metadata', "False") == "True" or not self.load_metadata_cache()):
+            self.get_board_info()
+            self.get_channel_info()
+            self.save_metadata_cache()
+        else:
+            self.refresh_values()
         #self.get_channel_parameter_value([12,5, 2, 9, 14], "VSet")
         #self.get_channel_name(5)
         #self.get_channel_name([12,5, 2, 9, 14])
@@ -66,6 +109,18 @@ class CAENR8033DM:
         self.set_ch_parameter([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15], "Pw", [0])
         self.get_channel_parameter_value([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15], "Pw")
         self.get_channel_parameter_value([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15], "Status")
+
+        #"poll" reads VMon and IMon from the crate for every sample, "event" has the crate send them when they change
+        #Not every crate supports events, if the subscription is turned down it carries on polling
+        acquisition = self.json_data.get('caenR8033DM_acquisition', "poll")
+        if (acquisition not in ["poll", "event"]):
+            sys.exit(f"{self.prefix} --> caenR8033DM_acquisition is {acquisition}, it has to be poll or event")
+        if (acquisition == "event"):
+            self.events = EventAcquisition(self, list(range(self.num_of_channels)), port=self.json_data.get('caenR8033DM_event_port', 0),
+                                           stale_after=self.json_data.get('caenR8033DM_event_stale_seconds', 5))
+            if (not self.events.start()):
+                print(f"{self.prefix} --> Crate didn't accept the event subscription, polling instead")
+                self.events = None
         #
         # self.set_ch_parameter([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15], "IMRange", [1])
         # self.get_channel_parameter_value([0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15], "IMRange")
@@ -76,9 +131,132 @@ class CAENR8033DM:
         #print("Board level properties are:")
         #pprint.pprint(self.board_params, width = 1)
 
+    #Tells ctypes the argument and return types of every library function that gets used, from CAENHVWrapper.h
+    #Without this ctypes has to work out how to pass each argument on every call, and would happily pass the wrong type
+    #The handle, slot and channel counts can then be given as plain ints. Pointer arguments are c_void_p so the byref and array arguments all fit
+    def declare_signatures(self):
+        handle = c_int
+        signatures = {}
+        signatures['CAENHV_InitSystem'] = [c_int, c_int, c_void_p, c_char_p, c_char_p, POINTER(c_int)]
+        signatures['CAENHV_DeinitSystem'] = [handle]
+        signatures['CAENHV_GetCrateMap'] = [handle, c_void_p, c_void_p, c_void_p, c_void_p, c_void_p, c_void_p, c_void_p]
+        signatures['CAENHV_GetSysPropList'] = [handle, c_void_p, c_void_p]
+        signatures['CAENHV_GetBdParamInfo'] = [handle, c_ushort, c_void_p]
+        signatures['CAENHV_GetBdParamProp'] = [handle, c_ushort, c_char_p, c_char_p, c_void_p]
+        signatures['CAENHV_GetBdParam'] = [handle, c_ushort, c_void_p, c_char_p, c_void_p]
+        signatures['CAENHV_SetBdParam'] = [handle, c_ushort, c_void_p, c_char_p, c_void_p]
+        signatures['CAENHV_GetChParamInfo'] = [handle, c_ushort, c_ushort, c_void_p, c_void_p]
+        signatures['CAENHV_GetChParamProp'] = [handle, c_ushort, c_ushort, c_char_p, c_char_p, c_void_p]
+        signatures['CAENHV_GetChParam'] = [handle, c_ushort, c_char_p, c_ushort, c_void_p, c_void_p]
+        signatures['CAENHV_SetChParam'] = [handle, c_ushort, c_char_p, c_ushort, c_void_p, c_void_p]
+        signatures['CAENHV_GetChName'] = [handle, c_ushort, c_ushort, c_void_p, c_void_p]
+        #Event mode, see caen_events.py. The parameter names go in as one string separated by colons
+        signatures['CAENHV_SubscribeChannelParams'] = [handle, c_ushort, c_ushort, c_ushort, c_char_p, c_uint, c_void_p]
+        signatures['CAENHV_UnSubscribeChannelParams'] = [handle, c_ushort, c_ushort, c_ushort, c_char_p, c_uint, c_void_p]
+        signatures['CAENHV_GetEventData'] = [handle, c_void_p, c_void_p, c_void_p]
+        signatures['CAENHV_FreeEventData'] = [c_void_p]
+        for name, argtypes in signatures.items():
+            function = getattr(self.libcaenhvwrapper, name)
+            function.argtypes = argtypes
+            function.restype = c_int
+
+    #Parameter names are encoded once and the same bytes are passed every time after that
+    def param_name(self, param):
+        if (param not in self.param_names):
+            self.param_names[param] = param.encode('utf-8')
+        return self.param_names[param]
+
+    #Makes sure every channel has the parameter with its Type and Mode known, before it's read or written
+    #Only run the first time a combination of channels and parameter is used, after that it's already known to be good
+    def check_channel_parameter(self, chns, param):
+        for ch in chns:
+            if param not in self.ch_params[ch]:
+                sys.exit(f"{self.prefix} --> Tried to access parameter{param} which wasn't in the channel parameter list. Channel {ch} parameter list is {self.ch_params[ch]}")
+            if (('Type' not in self.ch_params[ch][param]) or ('Mode' not in self.ch_params[ch][param])):
+                sys.exit(f"{self.prefix} --> Tried to access parameter{param} which didn't have Type and Mode set up in the channel parameter list. Channel {ch} parameter list is {self.ch_params[ch]}")
+            if (self.ch_params[ch][param]['Mode'] == self.PropertyMode.PARAM_MODE_WRONLY):
+                sys.exit(f"{self.prefix} --> Trying to read a parameter that is read only. Channel {ch} parameter list is {self.ch_params[ch]}")
+
+    #The channel array and a buffer of the right type for that many values, for a combination of channels and parameter
+    def channel_buffers(self, chns, param):
+        size = len(chns)
+        if (self.ch_params[chns[0]][param]['Type'] == self.PropertyType.PARAM_TYPE_FLOAT.name):
+            c_param_val = (c_float * size)()
+        else:
+            c_param_val = (c_uint32 * size)()
+        c_ch_list = (c_ushort * size)(*chns)
+        return c_ch_list, c_param_val
+
+    #Reads one parameter for a list of channels with one library call, into a buffer that's kept for those channels and that parameter
+    #Nothing is allocated after the first read of a combination, so the capture loop can read VMon and IMon as fast as the crate answers
+    #The buffer is overwritten by the next read of the same channels and parameter, so copy out anything that needs keeping
+    #Each thread gets its own buffers, so a monitoring thread can't overwrite a reading the test is still using
+    #Returns the library's return code and the buffer
+    def read_channel_parameter(self, chns, param):
+        c_ch_list, c_param_val = self.read_buffers(chns, param)
+        return_code = self.libcaenhvwrapper.CAENHV_GetChParam(self.caen,
+                                                            self.slot,
+                                                            self.param_name(param),     #Parameter to read
+                                                            len(c_ch_list),             #Number of channels you want to read (say 3)
+                                                            c_ch_list,                  #Which specific channels you want to read (say 12, 5, and 8 in that order)
+                                                            c_param_val)                #Will return that many floats or longs, organized in the way you called it
+        return return_code, c_param_val
+
+    #This thread's kept buffers, made the first time the thread reads or writes anything
+    #   channel_reads   (channels, parameter) to the channel array and output buffer for reading it, once the combination has been checked
+    #   channel_writes  (channels, parameter) to the channel array and value buffer for writing it, once the combination has been checked
+    def thread_buffers(self):
+        local = self.thread_local
+        if (not hasattr(local, "channel_reads")):
+            local.channel_reads = {}
+            local.channel_writes = {}
+        return local
+
+    #The kept channel array and output buffer for reading a parameter of these channels in this thread, checked the first time they're used
+    def read_buffers(self, chns, param):
+        channel_reads = self.thread_buffers().channel_reads
+        key = (tuple(chns), param)
+        buffers = channel_reads.get(key)
+        if (buffers is None):
+            self.check_channel_parameter(chns, param)
+            buffers = channel_reads[key] = self.channel_buffers(chns, param)
+        return buffers
+
+    #Reads VMon and IMon of the given channels into a capture row laid out like the HV data files, [time, ch V, ch I, ch V, ch I, ...]
+    #The values go straight from the kept ctypes buffers into the row, rounded like the other reads, there's no snapshot made in between
+    #Both reads are one request to the I/O thread, and inside it the library is called directly instead of going back through the queue
+    def read_monitor_row(self, chns, row):
+        return self.io.call(self.fill_monitor_row, chns, row)
+
+    def fill_monitor_row(self, chns, row):
+        library = self.libcaenhvwrapper.library
+        for offset, param in ((1, "VMon"), (2, "IMon")):
+            c_ch_list, c_param_val = self.read_buffers(chns, param)
+            return_code = library.CAENHV_GetChParam(self.caen, self.slot, self.param_name(param), len(c_ch_list), c_ch_list, c_param_val)
+            if (return_code != 0):
+                self.check_return(return_code, f"Retrieving value for channels {chns}, parameter {param} failed")
+            row[offset::2] = [round(i,self.rounding_factor) for i in c_param_val]
+        return row
+
     def __del__(self):
+        self.close()
+
+    #Stops the event reader, disconnects from the crate and stops the I/O thread. Only does it once, so it's safe to call before __del__
+    def close(self):
+        if (self.closed):
+            return
+        self.closed = True
+        if (self.events):
+            self.events.stop()
         return_code = self.libcaenhvwrapper.CAENHV_DeinitSystem(self.caen)
         self.check_return(return_code, "Disconnection Failed", "Disconnected")
+        if (self.io):
+            self.io.stop()
+
+    #Runs a function on the I/O thread with nothing else getting to the library until it's done, for reads and writes that belong together
+    #Returns a future, the function's return value or exception comes out of it
+    def submit(self, function, *args):
+        return self.io.submit(function, *args)
 
     #This function gets the information about the crate as a whole, number of slots, channels, etc...
     #In our case, we only have 1 slot. For some reason the description list returns nothing and I can' parse the firmware releases, but those don't matter
@@ -100,6 +278,70 @@ class CAENR8033DM:
                                                             byref(c_firmware_releae_max_list))
         self.check_return(return_code, "Failed to get crate map", f"Communicating with Caen {c_model_list.value.decode('utf-8')}, serial number {c_serial_num_list.contents.value} with {c_num_of_slots.value} slots and {c_num_of_channels.contents.value} channels detected")
         self.channel_list = c_num_of_channels.contents
+        self.crate_model = c_model_list.value.decode('utf-8')
+        self.crate_serial = c_serial_num_list.contents.value
+
+    #The metadata cache file for this crate. The crate model, serial number and driver are all in the name,
+    #so a different crate or a driver update never picks up the wrong properties
+    def metadata_cache_path(self):
+        cache_dir = os.path.join(os.getcwd(), self.json_data.get('caenR8033DM_metadata_cache', "caen_metadata"))
+        driver = os.path.basename(self.json_data['caenR8033DM_driver'])
+        name = f"{self.crate_model}_{self.crate_serial}_{driver}.json"
+        return os.path.join(cache_dir, "".join(c if (c.isalnum() or c in "._-") else "_" for c in name))
+
+    #Fills in the board and channel parameter dictionaries from the metadata cache, without the values
+    #Returns False if there's no cache for this crate and driver, or it doesn't match, so the full discovery is run instead
+    def load_metadata_cache(self):
+        path = self.metadata_cache_path()
+        if (not os.path.isfile(path)):
+            print(f"{self.prefix} --> No parameter metadata cached at {path}, reading it all from the crate")
+            return False
+        try:
+            with open(path, "r") as jsonfile:
+                cache = json.load(jsonfile)
+            if ((cache['model'] != self.crate_model) or (cache['serial'] != self.crate_serial) or (cache['driver'] != self.json_data['caenR8033DM_driver'])):
+                print(f"{self.prefix} --> Parameter metadata at {path} is for a different crate or driver, reading it all from the crate")
+                return False
+            board_params = cache['board_params']
+            #JSON keys are always strings, the channel dictionary is keyed by the channel number
+            ch_params = {int(ch): params for ch,params in cache['ch_params'].items()}
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"{self.prefix} --> Parameter metadata at {path} could not be read ({e}), reading it all from the crate")
+            return False
+        if (sorted(ch_params) != list(range(self.num_of_channels))):
+            print(f"{self.prefix} --> Parameter metadata at {path} doesn't have all {self.num_of_channels} channels, reading it all from the crate")
+            return False
+        self.board_params = board_params
+        self.ch_params = ch_params
+        print(f"{self.prefix} --> Loaded parameter metadata from {path}")
+        return True
+
+    #Saves the board and channel parameter properties for the next start. The values are left out since they're always read fresh
+    #Written to a temporary file first so an interrupted write can't leave a half written cache behind
+    def save_metadata_cache(self):
+        path = self.metadata_cache_path()
+        cache = {}
+        cache['model'] = self.crate_model
+        cache['serial'] = self.crate_serial
+        cache['driver'] = self.json_data['caenR8033DM_driver']
+        cache['board_params'] = {param: {k: v for k,v in props.items() if k != "Value"} for param,props in self.board_params.items()}
+        cache['ch_params'] = {ch: {param: {k: v for k,v in props.items() if k != "Value"} for param,props in params.items()} for ch,params in self.ch_params.items()}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False, indent=4)
+        os.replace(path + ".tmp", path)
+        print(f"{self.prefix} --> Saved parameter metadata to {path}")
+
+    #Reads the current value of every board parameter, and every channel parameter with one call for all the channels at once
+    #This is all that's needed at startup when the properties came from the metadata cache
+    def refresh_values(self):
+        for param in self.board_params:
+            if (self.board_params[param]['Mode'] != self.PropertyMode.PARAM_MODE_WRONLY.name):
+                self.get_board_parameter_value(param)
+        chs = list(range(self.num_of_channels))
+        for param in self.ch_params[0]:
+            if (self.ch_params[0][param]['Mode'] != self.PropertyMode.PARAM_MODE_WRONLY.name):
+                self.get_channel_parameter_value(chs, param, fresh=True)
 
     #This function always returns nothing
     def get_sys_info(self):
@@ -396,47 +638,75 @@ class CAENR8033DM:
     #This does that and adds it to the dictionary
     #This can be called with a single channel or a list of channels because the C function allows both
     #If called with a single int for channel, I make it a list of that one int so it works the same
-    def get_channel_parameter_value(self, chns, param, print_meas=False):
+    #With raw=True the values come back unrounded and always as a list, which is what the data capture wants
+    #Settings are answered from the cache when every channel asked for has a fresh entry. fresh=True always goes to the crate,
+    #for when the point is to see what the crate really has, like checking a write. Either way a crate read refreshes the cache
+    def get_channel_parameter_value(self, chns, param, print_meas=False, raw=False, fresh=False):
         if (isinstance(chns, int)):
             chns = [chns]
-        size = len(chns)
-        for ch in chns:
-            if param not in self.ch_params[ch]:
-                sys.exit(f"{self.prefix} --> Tried to access parameter{param} which wasn't in the channel parameter list. Channel {ch} parameter list is {self.ch_params[ch]}")
-            if (('Type' not in self.ch_params[ch][param]) or ('Mode' not in self.ch_params[ch][param])):
-                sys.exit(f"{self.prefix} --> Tried to access parameter{param} which didn't have Type and Mode set up in the channel parameter list. Channel {ch} parameter list is {self.ch_params[ch]}")
-            if (self.ch_params[ch][param]['Mode'] == self.PropertyMode.PARAM_MODE_WRONLY):
-                sys.exit(f"{self.prefix} --> Trying to read a parameter that is read only. Channel {ch} parameter list is {self.ch_params[ch]}")
-        if (self.ch_params[chns[0]][param]['Type'] == self.PropertyType.PARAM_TYPE_FLOAT.name):
-            c_param_val = (c_float * size)()
-        else:
-            c_param_val = (c_uint32 * size)()
-        c_ch_list = (c_ushort * size)()
-        for num,ch in enumerate(chns):
-            c_ch_list[num] = ch
-        return_code = self.libcaenhvwrapper.CAENHV_GetChParam(self.caen,
-                                                            c_ushort(self.slot),
-                                                            param.encode('utf-8'),      #Parameter to read
-                                                            c_ushort(size),             #Number of channels you want to read (say 3)
-                                                            byref(c_ch_list),           #Which specific channels you want to read (say 12, 5, and 8 in that order)
-                                                            byref(c_param_val))         #Will return that many floats or longs, organized in the way you called it
-        if (self.check_return(return_code, f"Retrieving value for channels {chns}, parameter {param} failed") == 0):
-            for num,ch in enumerate(chns):
-                self.ch_params[ch][param]["Value"] = c_param_val[num]
-                if print_meas:
+        c_param_val = None
+        if (param in self.cached_settings and not fresh):
+            c_param_val = self.cached_setting(chns, param)
+        if (c_param_val is not None):
+            self.settings_hits += 1
+            if print_meas:
+                for num,ch in enumerate(chns):
                     print(f"{self.prefix} --> Ch {ch} {param}: {c_param_val[num]}")
         else:
-            for ch in chns:
-                self.ch_params[ch][param]["Value"] = self.error
+            if (param in self.cached_settings):
+                self.settings_misses += 1
+            return_code, c_param_val = self.read_channel_parameter(chns, param)
+            if (self.check_return(return_code, f"Retrieving value for channels {chns}, parameter {param} failed") == 0):
+                for num,ch in enumerate(chns):
+                    self.ch_params[ch][param]["Value"] = c_param_val[num]
+                    if print_meas:
+                        print(f"{self.prefix} --> Ch {ch} {param}: {c_param_val[num]}")
+                self.cache_settings(chns, param, c_param_val)
+            else:
+                for ch in chns:
+                    self.ch_params[ch][param]["Value"] = self.error
+                self.invalidate_settings(chns, param)
 
         #I realized that upstream functions want this value returned to them
         #Since this function can accept a single value or an array, return what was passed in
         #Floats are rounded to make the comparison for a write easier
+        if (raw):
+            return c_param_val[:]
         if (len(chns) == 1):
             return c_param_val[0]
         else:
             return [round(i,self.rounding_factor) for i in c_param_val]
 
+    #The cached values of a setting for every channel asked for, or None if any of them is missing or has expired
+    def cached_setting(self, chns, param):
+        now = time.monotonic()
+        values = []
+        for ch in chns:
+            entry = self.settings.get((ch, param))
+            if (entry is None or entry[1] < now):
+                return None
+            values.append(entry[0])
+        return values
+
+    def cache_settings(self, chns, param, values):
+        if (param not in self.cached_settings):
+            return
+        expires = time.monotonic() + self.settings_ttl
+        for num,ch in enumerate(chns):
+            self.settings[(ch, param)] = (values[num], expires)
+
+    #Forgets cached settings so the next read goes to the crate. Call this whenever the crate could have changed them behind our back,
+    #like after reconnecting or a channel tripping. With no arguments everything is forgotten
+    def invalidate_settings(self, chns=None, param=None):
+        if (chns is None and param is None):
+            self.settings.clear()
+            return
+        if (isinstance(chns, int)):
+            chns = [chns]
+        for key in list(self.settings):
+            if ((chns is None or key[0] in chns) and (param is None or key[1] == param)):
+                del self.settings[key]
+
     #This is a curious function. You pass in a channel like 5 and it returns "CH05"
     #And you can ask for multiple, say channels 12, 4, and 8. Sure enough, you get "Ch12, Ch04, Ch08"
     #There's a corresponding function that lets you set the name to change it. Whatever that does.
@@ -502,32 +772,29 @@ class CAENR8033DM:
             sys.exit(f"{self.prefix} --> Incorrect use of set_ch_parameter! The number of channels and values you supply must be the same! Or only supply one value!\n\
                      You supplied {chns} channels and {vals} values!")
         size = len(chns)
-        for ch in chns:
-            if param not in self.ch_params[ch]:
-                sys.exit(f"{self.prefix} --> Tried to access parameter{param} which wasn't in the channel parameter list. Channel {ch} parameter list is {self.ch_params[ch]}")
-            if (('Type' not in self.ch_params[ch][param]) or ('Mode' not in self.ch_params[ch][param])):
-                sys.exit(f"{self.prefix} --> Tried to access parameter{param} which didn't have Type and Mode set up in the channel parameter list. Channel {ch} parameter list is {self.ch_params[ch]}")
-            if (self.ch_params[ch][param]['Mode'] == self.PropertyMode.PARAM_MODE_WRONLY):
-                sys.exit(f"{self.prefix} --> Trying to read a parameter that is read only. Channel {ch} parameter list is {self.ch_params[ch]}")
-        if (self.ch_params[chns[0]][param]['Type'] == self.PropertyType.PARAM_TYPE_FLOAT.name):
-            c_param_val = (c_float * size)()
-        else:
-            c_param_val = (c_uint32 * size)()
+        channel_writes = self.thread_buffers().channel_writes
+        key = (tuple(chns), param)
+        if (key not in channel_writes):
+            self.check_channel_parameter(chns, param)
+            channel_writes[key] = self.channel_buffers(chns, param)
+        c_ch_list, c_param_val = channel_writes[key]
         if (len(vals) == 1):
             c_param_val[:] = [vals[0]] * size       #This line is where every channel is set to the same value
         else:
             for num,val in enumerate(vals):
                 c_param_val[num] = val
-        c_ch_list = (c_ushort * size)()
-        for num,ch in enumerate(chns):
-            c_ch_list[num] = ch
         return_code = self.libcaenhvwrapper.CAENHV_SetChParam(self.caen,
-                                                            c_ushort(self.slot),
-                                                            param.encode('utf-8'),      #Parameter to write
-                                                            c_ushort(size),             #Number of channels you want to write (say 3)
-                                                            byref(c_ch_list),           #Which specific channels you want to write (say 12, 5, and 8 in that order)
-                                                            byref(c_param_val))         #The array of values for each channel you're writing to
-        self.check_return(return_code, f"Writing value {vals} for channels {chns}, parameter {param} failed")
+                                                            self.slot,
+                                                            self.param_name(param),     #Parameter to write
+                                                            size,                       #Number of channels you want to write (say 3)
+                                                            c_ch_list,                  #Which specific channels you want to write (say 12, 5, and 8 in that order)
+                                                            c_param_val)                #The array of values for each channel you're writing to
+        #Write through to the settings cache, as the value the crate was sent after it went through the C type
+        #A failed write leaves the crate's setting unknown, so it's dropped instead
+        if (self.check_return(return_code, f"Writing value {vals} for channels {chns}, parameter {param} failed") == 0):
+            self.cache_settings(chns, param, c_param_val)
+        else:
+            self.invalidate_settings(chns, param)
 
     #Simple class for checking error responses from the instrument and printing messages if applicable
     def check_return(self, ret, failmessage = None, passmessage = None):
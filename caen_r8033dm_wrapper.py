@@ -1,15 +1,22 @@
 
 from caen_r8033dm import CAENR8033DM
+from caen_ramp import RampSupervisor
+from caen_watchdog import SafetyWatchdog
 import sys
 import time
+import numpy as np
 
 class CAENR8033DM_WRAPPER:
-    def __init__(self, json_data):
+    #library is passed down to the lower level, to run against something other than the real driver
+    def __init__(self, json_data, library=None):
         self.prefix = "CAEN R8033DM Wrapper"            #Prefix for log messages
         self.json_data = json_data
-        self.caen = CAENR8033DM(json_data)      #Creates instance of lower level which holds the connection
+        self.caen = CAENR8033DM(json_data, library)     #Creates instance of lower level which holds the connection
         self.rounding_factor = 2                #When comparing floats, we need to round
-        self.ramp_wait = 1                      #Time between checks when ramping up or down
+        self.ramp_wait = 1                      #Time for the status to catch up after the power is switched
+        self.snapshot_dtypes = {}               #Record array layout for each set of snapshot parameters
+        self.ramp = RampSupervisor(self, self.json_data.get('caenR8033DM_ramp_min_poll', 0.2),
+                                   self.json_data.get('caenR8033DM_ramp_max_poll', 2))
         if (self.caen.caen.value == -1):
             sys.exit(f"{self.prefix} --> Device could not be intialized, returned {self.caen.caen.value}")
 
@@ -24,13 +31,21 @@ class CAENR8033DM_WRAPPER:
             sys.exit(f"{self.prefix} --> Board failed with error {hex(self.get_board_status())}")
 
         channels = [0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15]
-        self.set_current_range(channels, self.json_data['caenR8033DM_current_range'])
-        self.set_overcurrent(channels, self.json_data['caenR8033DM_overcurrent'])
-        self.set_powerdown(channels, self.json_data['caenR8033DM_power_down_mode'])
-        self.set_rampdown(channels, self.json_data['caenR8033DM_ramp_down'])
-        self.set_rampup(channels, self.json_data['caenR8033DM_ramp_up'])
-        self.set_trip_time(channels, self.json_data['caenR8033DM_trip_time'])
-        self.set_HV_value(channels, self.json_data['caenR8033DM_term_voltage'])
+        plan = {}
+        plan["IMRange"] = dict.fromkeys(channels, self.json_data['caenR8033DM_current_range'])
+        plan["ISet"] = dict.fromkeys(channels, self.json_data['caenR8033DM_overcurrent'])
+        plan["PDwn"] = dict.fromkeys(channels, self.json_data['caenR8033DM_power_down_mode'])
+        plan["RDwn"] = dict.fromkeys(channels, self.json_data['caenR8033DM_ramp_down'])
+        plan["RUp"] = dict.fromkeys(channels, self.json_data['caenR8033DM_ramp_up'])
+        plan["Trip"] = dict.fromkeys(channels, self.json_data['caenR8033DM_trip_time'])
+        plan["VSet"] = dict.fromkeys(channels, self.json_data['caenR8033DM_term_voltage'])
+        self.apply_configuration(plan)
+
+        #Watches for trips and interlocks from its own thread for as long as the crate is connected
+        self.watchdog = None
+        if (self.json_data.get('caenR8033DM_watchdog', "False") == "True"):
+            self.watchdog = SafetyWatchdog(self, self.json_data.get('caenR8033DM_watchdog_interval', 0.05), channels)
+            self.watchdog.start()
 
         # print(self.get_channel_status(3))
         # print(self.get_channel_status([3,4,5,6, 7]))
@@ -58,6 +73,9 @@ class CAENR8033DM_WRAPPER:
         self.power_cycle(ch, True)
 
     def turn_off(self, ch, emergency=False):
+        #An emergency turn off deals with whatever the watchdog found, so it shouldn't be raised again later
+        if (emergency and self.watchdog):
+            self.watchdog.clear()
         try:
             self.power_cycle(ch, False)
         except:
@@ -65,53 +83,90 @@ class CAENR8033DM_WRAPPER:
                  self.caen.set_ch_parameter(ch, "Pw", False)   
             raise                             
 
+    #Turns the channels off with a single write and nothing else, no status checks and no waiting for the ramp down
+    #This is what the watchdog does when it finds a fault, it has to be as quick as possible
+    def emergency_off(self, ch):
+        self.caen.set_ch_parameter(ch, "Pw", 0)
+
+    #Stops the watchdog and disconnects from the crate, for when the test stops without using it, like another instrument not starting
+    def close(self):
+        if (self.watchdog):
+            self.watchdog.stop()
+        self.caen.close()
+
+    #Raises anything the watchdog has found since the last check, call it from loops that don't look at the status themselves
+    def check_watchdog(self):
+        if (self.watchdog):
+            self.watchdog.check()
+
     def power_cycle(self, ch, up):
         if (up):
             value = 1
         else:
             value = 0
-        status = self.get_channel_status(ch)
         #Make it work for both single channels and lists
         if (not isinstance(ch, list)):
             ch = [ch]
-        if (not isinstance(status, list)):
-            status = [status]
         #Check if there's any error in the channels before the power is touched
-        for num,i in enumerate(ch):
-            if (status[num] > 0x7):
-                self.channel_error(i, status[num])
+        snap = self.snapshot(ch)
+        self.check_snapshot(snap)
         #Set all the channels to turn on or off
         self.caen.set_ch_parameter(ch, "Pw", value)
         #Need the device status to update, sometimes it says it's completed before it starts
-        print(f"Channel(s) starting at {self.get_voltage(ch)} V, {self.get_current(ch)} uA")        
+        print(f"Channel(s) starting at {snap.VMon.round(self.rounding_factor).tolist()} V, {snap.IMon.round(self.rounding_factor).tolist()} uA")
         time.sleep(self.ramp_wait)
-        print(f"Channel(s) at {self.get_voltage(ch)} V, {self.get_current(ch)} uA")
-        #If any channels are ramping, wait for ramping to finish
-        for num,i in enumerate(ch):
-            self.get_power_status(ch[num])
-            if (self.get_channel_status(ch[num]) != value):
-                self.wait_for_ramp(ch[num], up)
+        snap = self.snapshot(ch)
+        print(f"Channel(s) at {snap.VMon.round(self.rounding_factor).tolist()} V, {snap.IMon.round(self.rounding_factor).tolist()} uA")
+        #If any channels are ramping, wait for all of them to finish together
+        ramping = snap.ch[snap.Status != value].tolist()
+        if (ramping):
+            self.wait_for_ramp(ramping, up)
 
     #Monitor the ramping of the power, while checking to see if channel status throws and error
+    #All the ramping channels are watched together by the ramp supervisor, see caen_ramp.py
     def wait_for_ramp(self, ch, going_up):
-        secs_passed = 0
-        while(True):
-            #print(self.get_channel_status(ch))
-            #print(self.caen.get_channel_parameter_value(ch, "Pw"))
-            if (going_up):
-                #if (self.get_channel_status(ch) == 1 and (self.get_HV_value(ch) - self.get_voltage(ch)) < 100 ):
-                if self.get_channel_status(ch) == 1:
-                    break
-                print(f"{self.prefix} --> Channel {ch} is ramping up to {self.get_HV_value(ch)} V, currently at {self.get_voltage(ch)} V and {self.get_current(ch)} uA ({secs_passed} seconds passed)")
-            else:
-                #if (self.get_channel_status(ch) == 0 and self.get_voltage(ch) < 20) :
-                if self.get_channel_status(ch) == 0:
-                    break
-                print(f"{self.prefix} --> Channel {ch} is ramping down to turn off, currently at {self.get_voltage(ch)} V and {self.get_current(ch)} uA ({secs_passed} seconds passed) ")
-            time.sleep(self.ramp_wait)
-            secs_passed = secs_passed + self.ramp_wait
-            if (self.get_channel_status(ch) > 0x7):
-                self.channel_error(ch, self.get_channel_status(ch))
+        return self.ramp.watch(ch, going_up)
+
+    #Reads the given parameters of all the given channels at once, with one library call per parameter
+    #Returns a NumPy record array with a row per channel and a field per parameter, plus the channel number in "ch"
+    #So snap.VMon is every channel's voltage, snap[num].Status is one channel's status, and snap[snap.Status > 0x7] picks out the errors
+    #Floats come back unrounded. Pass a snapshot from before as out to refill it instead of making a new one
+    #The whole snapshot is one request to the I/O thread, so other threads' calls can't land in the middle of it
+    def snapshot(self, ch, params=("VMon","IMon","Status","Pw"), out=None):
+        if (not isinstance(ch, list)):
+            ch = [ch]
+        return self.caen.io.call(self.fill_snapshot, ch, params, out)
+
+    def fill_snapshot(self, ch, params, out):
+        if (out is None):
+            out = np.recarray(len(ch), dtype=self.snapshot_dtype(ch, params))
+            out.ch = ch
+        for param in params:
+            #Settings come from the cache in the lower level when it has them, everything else is read from the crate
+            if (param in self.caen.cached_settings):
+                out[param] = self.caen.get_channel_parameter_value(ch, param, raw=True)
+                continue
+            return_code, values = self.caen.read_channel_parameter(ch, param)
+            if (return_code != 0):
+                self.caen.check_return(return_code, f"Retrieving value for channels {ch}, parameter {param} failed")
+            out[param] = values
+        return out
+
+    def snapshot_dtype(self, ch, params):
+        if (params not in self.snapshot_dtypes):
+            fields = [("ch", np.uint16)]
+            for param in params:
+                if (self.caen.ch_params[ch[0]][param]['Type'] == self.caen.PropertyType.PARAM_TYPE_FLOAT.name):
+                    fields.append((param, np.float64))
+                else:
+                    fields.append((param, np.uint32))
+            self.snapshot_dtypes[params] = np.dtype(fields)
+        return self.snapshot_dtypes[params]
+
+    #Goes through the channel status in a snapshot and raises the error for the first channel that has one
+    def check_snapshot(self, snap):
+        for row in snap[snap.Status > 0x7]:
+            self.channel_error(int(row.ch), int(row.Status), row)
 
     #These functions basically get and set different parameters of each channel, with a variable amount of channels as the input
     def get_voltage(self, ch, num_avgs=5, print_meas=False):
@@ -134,6 +189,20 @@ class CAENR8033DM_WRAPPER:
     def get_current(self, ch, num_avgs=5, print_meas=False):
         return self.caen.get_channel_parameter_value(ch, "IMon", print_meas)
 
+    #Reads VMon and IMon of all the given channels with one library call each, instead of 2 calls per channel
+    #The readings are put into a row laid out like the HV data files, [time, ch V, ch I, ch V, ch I, ...]
+    #Pass in a row that was already made so the capture loop doesn't have to build a new list for every sample
+    #The readings are copied into the row straight from the lower level's kept buffers, see read_monitor_row
+    #In event mode the row comes from the latest values the crate sent instead, and nothing is read, unless the events have gone stale
+    def get_monitor_row(self, ch, row=None):
+        if (not isinstance(ch, list)):
+            ch = [ch]
+        if (self.caen.events and self.caen.events.usable(ch)):
+            return self.caen.events.get_monitor_row(ch, row)
+        if (row is None):
+            row = [None] * (1 + (2 * len(ch)))
+        return self.caen.read_monitor_row(ch, row)
+
     def set_current_range(self, ch, value):
         self.caen.set_ch_parameter(ch, "IMRange", value)
         return self.get_check_channel_parameter(ch, "IMRange", value)
@@ -179,8 +248,9 @@ class CAENR8033DM_WRAPPER:
     #It should agree, if it doesn't, it throws an error
     #Much of the loops is just dealing with that you can send a single channel and value
     #Or multiple channels and 1 value, or multiple channels and values
+    #The readback always goes to the crate rather than the settings cache, and it's what the cache holds from then on
     def get_check_channel_parameter(self, ch, param, value):
-        resp = self.caen.get_channel_parameter_value(ch, param)
+        resp = self.caen.get_channel_parameter_value(ch, param, fresh=True)
         if (isinstance(ch, list) and not isinstance(value, list)):
             for num in range(len(ch)):
                 if (round(resp[num],self.rounding_factor) != value):
@@ -196,6 +266,63 @@ class CAENR8033DM_WRAPPER:
             sys.exit(f"{self.prefix} --> Wrote {value} to {param}, read back {resp}")
         return resp
 
+    #Writes a whole plan of settings, {parameter: {channel: value}}, and then checks all of it
+    #The library sets every channel in a call to the same value, so channels are grouped by value and each group is one write
+    #What's there before the writes comes from the settings cache, so that doesn't cost any calls when it's up to date
+    #Then each parameter is read back once for all its channels, straight from the crate
+    #If anything didn't take, everything in the plan is put back to what it was before, so a half applied plan isn't left on the crate
+    #Nothing exits here. Returns what didn't take as {parameter: {channel: {"wanted": value, "read": value, "previous": value}}},
+    #so an empty dict means it all worked
+    def configure(self, plan):
+        previous = self.read_plan(plan, fresh=False)
+        self.write_plan(plan)
+        diff = self.plan_diff(plan, self.read_plan(plan))
+        if (diff):
+            for param, chs in diff.items():
+                for ch, values in chs.items():
+                    values["previous"] = previous[param][ch]
+            self.write_plan(previous)
+            left = self.plan_diff(previous, self.read_plan(previous))
+            if (left):
+                print(f"{self.prefix} --> Couldn't put back the settings from before the configuration either: {left}")
+            else:
+                print(f"{self.prefix} --> Configuration didn't take, put back the settings from before it")
+        return diff
+
+    def write_plan(self, plan):
+        for param, values in plan.items():
+            groups = {}
+            for ch, value in values.items():
+                groups.setdefault(value, []).append(ch)
+            for value, chs in groups.items():
+                self.caen.set_ch_parameter(chs, param, value)
+
+    #What the crate has for every parameter and channel in the plan, laid out the same way
+    def read_plan(self, plan, fresh=True):
+        values = {}
+        for param, chs in plan.items():
+            chs = list(chs)
+            resp = self.caen.get_channel_parameter_value(chs, param, fresh=fresh, raw=True)
+            values[param] = {ch: resp[num] for num,ch in enumerate(chs)}
+        return values
+
+    def plan_diff(self, plan, read):
+        diff = {}
+        for param, values in plan.items():
+            for ch, value in values.items():
+                if (round(read[param][ch], self.rounding_factor) != round(value, self.rounding_factor)):
+                    diff.setdefault(param, {})[ch] = {"wanted": value, "read": read[param][ch]}
+        return diff
+
+    #Same as configure, but stops the test if anything didn't take, listing everything that's wrong rather than just the first
+    def apply_configuration(self, plan):
+        diff = self.configure(plan)
+        if (diff):
+            for param, chs in diff.items():
+                for ch, values in chs.items():
+                    print(f"{self.prefix} --> Channel {ch} status {self.get_channel_status(ch)}, wrote {values['wanted']} to {param}, read back {values['read']}")
+            sys.exit(f"{self.prefix} --> Configuration didn't take for {sum(len(chs) for chs in diff.values())} setting(s): {diff}")
+
     #Getting board level parameters doesn't require a channel
     def get_board_status(self):
         return self.caen.get_board_parameter_value("BdStatus")
@@ -216,10 +343,16 @@ class CAENR8033DM_WRAPPER:
             return self.caen.board_params['BdCtr']['Offstate']
 
     #Channel status is passed here, if it's not settled or ramping up/down, I assume there's an error and throw it
-    def channel_error(self, ch, val):
+    #If the status came from a snapshot, pass its row so the voltage and current are from the same moment as the error
+    def channel_error(self, ch, val, snap_row=None):
         if (val > 0x7):
+            #A trip can change the channel's settings on the crate side, so don't trust what's cached for it
+            self.caen.invalidate_settings(ch)
             print(f"{self.prefix} --> Error code {hex(val)}")
-            print(f"Channel {ch}: {self.get_voltage(ch)} V, {self.get_current(ch)} uA")
+            if (snap_row is not None):
+                print(f"Channel {ch}: {snap_row.VMon} V, {snap_row.IMon} uA")
+            else:
+                print(f"Channel {ch}: {self.get_voltage(ch)} V, {self.get_current(ch)} uA")
             if (val & 0x8):
                 sys.exit(f"{self.prefix} --> Channel {ch} is overcurrent")
             if (val & 0x10):
@@ -0,0 +1,70 @@
+import time
+import numpy as np
+
+#Watches a group of CAEN channels ramping up or down until they've all settled, or one of them errors
+#Every tick is one batched read of every channel in the group, instead of each channel being waited on in turn
+#The time until the next tick comes from how far each channel still has to go and its ramp rate (RUp or RDwn in V/s)
+#Far from the end it polls slowly, near the predicted finish it polls quickly, so it neither floods the crate nor waits a
+#whole interval after the last channel settles
+#Use it like:
+#   ramp = RampSupervisor(caen_wrapper, 0.2, 2)
+#   ramp.watch([0, 1, 2, 3], going_up=True)
+#   ramp.history        #Stats for every ramp watched, meant to go into the datastore JSON
+class RampSupervisor:
+    def __init__(self, caen, min_poll=0.2, max_poll=2):
+        self.prefix = "CAEN Ramp Supervisor"    #Prefix for log messages
+        self.caen = caen                        #The CAENR8033DM_WRAPPER the channels are on
+        self.min_poll = min_poll                #Shortest wait between ticks, for when a channel should be finishing
+        self.max_poll = max_poll                #Longest wait between ticks, which also bounds how long an error can go unseen
+        self.history = []
+
+    #Blocks until every channel's status says it's on (going up) or off (going down)
+    #An error status on any channel goes to channel_error straight away, same as the other checks in the wrapper
+    def watch(self, ch, going_up):
+        if (not isinstance(ch, list)):
+            ch = [ch]
+        if (going_up):
+            target = 1
+            rate_param = "RUp"
+        else:
+            target = 0
+            rate_param = "RDwn"
+        #The setpoints and ramp rates don't change while ramping, so they're only read once
+        setup = self.caen.snapshot(ch, ("VSet", rate_param))
+        if (going_up):
+            target_voltage = setup.VSet
+        else:
+            target_voltage = np.zeros(len(ch))
+        rates = setup[rate_param].clip(min=1)
+
+        start = time.monotonic()
+        polls = 0
+        snap = None
+        while(True):
+            snap = self.caen.snapshot(ch, ("VMon", "IMon", "Status"), snap)
+            polls += 1
+            self.caen.check_snapshot(snap)
+            self.caen.check_watchdog()
+            ramping = snap.Status != target
+            if (not ramping.any()):
+                break
+            secs_passed = round(time.monotonic() - start, 1)
+            #The negative channels read back a positive VMon, so the distance left is the same for both
+            remaining = abs(target_voltage - abs(snap.VMon))
+            predicted = remaining / rates
+            for num in ramping.nonzero()[0]:
+                if (going_up):
+                    print(f"{self.prefix} --> Channel {snap[num].ch} is ramping up to {round(setup[num].VSet, self.caen.rounding_factor)} V, currently at {snap[num].VMon} V and {snap[num].IMon} uA, about {predicted[num]:.1f} seconds left ({secs_passed} seconds passed)")
+                else:
+                    print(f"{self.prefix} --> Channel {snap[num].ch} is ramping down to turn off, currently at {snap[num].VMon} V and {snap[num].IMon} uA, about {predicted[num]:.1f} seconds left ({secs_passed} seconds passed)")
+            #Check again when the next channel should be done. The status often lags the voltage,
+            #so once the prediction has run out it drops to the shortest wait instead of giving up on it
+            time.sleep(min(max(predicted[ramping].min(), self.min_poll), self.max_poll))
+
+        result = {}
+        result['channels'] = ch
+        result['going_up'] = going_up
+        result['seconds'] = time.monotonic() - start
+        result['polls'] = polls
+        self.history.append(result)
+        return result
@@ -0,0 +1,120 @@
+import sys
+import time
+import atexit
+import threading
+
+#Keeps an eye on the crate from its own thread the whole time it's running, so a trip is caught while the test is
+#busy with something else, like a 5 minute capture that never looks at the channel status
+#Every interval it reads Status for all the channels in one call, plus the board interlock and board status, as one request to the I/O thread
+#When anything is wrong it turns every channel off with one write straight away, without waiting for the test to notice
+#The fault is then latched until the test calls check(), which raises it in the test's own thread as a SystemExit,
+#the same as a channel error found anywhere else, so the usual emergency_shutoff and retry handling takes over from there
+#The worst case from a fault appearing to the channels being told to turn off is about one interval plus one sample
+#Use it like:
+#   watchdog = SafetyWatchdog(caen_wrapper, 0.05)
+#   watchdog.start()
+#   ...
+#   watchdog.check()        #In any loop that runs for a while
+#   watchdog.stop()
+class SafetyWatchdog:
+    def __init__(self, caen, interval=0.05, chs=None):
+        self.prefix = "CAEN Safety Watchdog"    #Prefix for log messages
+        self.caen = caen                        #The CAENR8033DM_WRAPPER to watch
+        self.interval = interval                #Seconds between samples
+        self.chs = chs if chs is not None else list(range(caen.caen.num_of_channels))
+        self.fault = None                       #Description of the fault waiting for check(), None when there isn't one
+        self.faults = []                        #Every fault seen, with how long it took to shut off, for the results JSON
+        self.samples = 0
+        self.sample_time_max = 0                #Longest a sample took, the other half of the worst case detection time
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if (self.thread):
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="CAEN safety watchdog", daemon=True)
+        self.thread.start()
+        #Stopped before the I/O thread is, since atexit runs the last one registered first
+        atexit.register(self.stop)
+        print(f"{self.prefix} --> Watching channels {self.chs} every {self.interval} seconds")
+
+    def stop(self):
+        self.running = False
+        if (self.thread):
+            self.thread.join()
+            self.thread = None
+            atexit.unregister(self.stop)
+
+    #Reads everything the watchdog looks at and returns what's wrong, or None. Runs on the I/O thread
+    def sample(self):
+        problems = []
+        return_code, status = self.caen.caen.read_channel_parameter(self.chs, "Status")
+        if (return_code != 0):
+            return [f"reading channel status failed with error code {hex(return_code)}"], None
+        status = status[:]
+        for num,ch in enumerate(self.chs):
+            if (status[num] > 0x7):
+                problems.append(f"channel {ch} status {hex(status[num])}")
+        if (self.caen.caen.get_board_parameter_value("BdIlk")):
+            problems.append("board interlock tripped")
+        board_status = self.caen.caen.get_board_parameter_value("BdStatus")
+        if (board_status != 0):
+            problems.append(f"board status {hex(board_status)}")
+        return problems, status
+
+    def run(self):
+        deadline = time.monotonic()
+        while (self.running):
+            start = time.monotonic()
+            try:
+                problems, status = self.caen.caen.io.call(self.sample)
+            except BaseException as e:
+                #Losing the crate is a fault too, but there's no way to turn anything off through it
+                problems, status = [f"lost contact with the crate ({e!r})"], None
+            detected = time.monotonic()
+            self.samples += 1
+            self.sample_time_max = max(self.sample_time_max, detected - start)
+            if (problems and self.fault is None):
+                self.shut_off(problems, status, detected)
+            deadline += self.interval
+            now = time.monotonic()
+            if (deadline > now):
+                time.sleep(deadline - now)
+            else:
+                deadline = now
+
+    def shut_off(self, problems, status, detected):
+        try:
+            self.caen.emergency_off(self.chs)
+            shutoff = time.monotonic() - detected
+            print(f"{self.prefix} --> Found {', '.join(problems)}, turned every channel off {shutoff * 1000:.1f} ms after it was seen")
+        except BaseException as e:
+            shutoff = None
+            print(f"{self.prefix} --> Found {', '.join(problems)}, but turning the channels off failed ({e!r})")
+        fault = {}
+        fault['time'] = time.time()
+        fault['problems'] = problems
+        fault['status'] = list(status) if status is not None else None
+        fault['detect_to_shutoff'] = shutoff
+        self.faults.append(fault)
+        self.fault = fault
+
+    #Raises a latched fault as a SystemExit in whichever thread calls this, and clears it so the watchdog can catch the next one
+    def check(self):
+        fault = self.fault
+        if (fault is not None):
+            self.fault = None
+            sys.exit(f"{self.prefix} --> HV turned off because of {', '.join(fault['problems'])}")
+
+    #Forgets a latched fault, for when the test has already dealt with it by turning everything off itself
+    def clear(self):
+        self.fault = None
+
+    def stats(self):
+        results = {}
+        results['interval'] = self.interval
+        results['samples'] = self.samples
+        results['sample_time_max'] = self.sample_time_max
+        results['faults'] = self.faults
+        return results
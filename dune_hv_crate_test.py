@@ -4,50 +4,57 @@ import json
 import os
 import time
 import openpyxl
+import threading
 from datetime import datetime
 from keysight_daq970a import Keysight970A
 from rigol_dp832a import RigolDP832A
+from visa_reconnect import ReconnectManager
+from instrument_startup import bring_up
+from test_scheduler import StepScheduler
+from hv_sequence import load_phases, termination_log, termination_plot
+from hv_adaptive import AdaptiveCapture
+from settling import wait_until_stable
 from caen_r8033dm_wrapper import CAENR8033DM_WRAPPER
-
-import csv
-from pathlib import Path
-import matplotlib.dates as mdates
-import matplotlib.ticker as mticker
-from datetime import datetime, timedelta
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MultipleLocator
-import numpy as np
-from scipy.optimize import curve_fit
+from caen_r8033dm import pop_refresh_metadata
+from periodic_sampler import PeriodicSampler
+from hv_capture import CaptureWriter, BinaryCaptureWriter, CaptureCache, capture_columns
+from hv_analysis import AnalysisPipeline, fit_capture
+from hv_plotting import PlotService, plot_capture, format_plot, capture_ch_columns
 
 import traceback
+import contextlib
 
 class LDOmeasure:
-    def __init__(self, config_file = None, name = None):
+    def __init__(self, config_file = None, name = None, refresh_metadata = False):
         self.prefix = "DUNE HV Crate Tester"
         print(f"{self.prefix} --> Welcome to the DUNE HV crate production testing script")
+        #Captures that have been read for fitting and plotting, so each file is only parsed once per phase
+        self.capture_cache = CaptureCache()
+        #Without a config the plots are drawn in this process as they're asked for, which is what JustPlot wants
+        self.plots = PlotService("immediate", 0, self.capture_cache)
         if not config_file:
             print(f"{self.prefix} --> No config file given, test will not run")
             return
         with open(config_file, "r") as jsonfile:
             self.json_data = json.load(jsonfile)
+        if (refresh_metadata):
+            self.json_data['caenR8033DM_refresh_metadata'] = "True"
         self.rm = pyvisa.ResourceManager('@py')      
+        #Plots are drawn by their own worker processes, as they come in, all at the end of the test, or not at all
+        self.plots = PlotService(self.json_data.get('hv_plot_mode', "immediate"), self.json_data.get('hv_plot_workers', 2), self.capture_cache)
         
         
         #Initialize all instruments first so that you don't waste time with input if something is not connected
-        self.c = CAENR8033DM_WRAPPER(self.json_data)
-        self.k = Keysight970A(self.rm, self.json_data)
-
-        #Since there are 2 Rigols, set them up here so they know what channels they have
-        #And if the test sequence calls the wrong one, it'll throw an error
-        self.r0 = RigolDP832A(self.rm, self.json_data, 0)
-        self.r0.setup_fan()
-        self.r0.setup_heater_supply()
-        self.r0.setup_heater_switch()
-
-        self.r1 = RigolDP832A(self.rm, self.json_data, 1)
-        self.r1.setup_hvpullup()
-        self.r1.setup_hvpullup2()
-        self.r1.setup_fanread()
+        #They're all started at once, and any that don't come up are listed together, after the ones that did are closed again
+        names = ["caen", "keysight", "rigol0", "rigol1"]
+        instruments, self.startup_times = bring_up({name: (lambda name=name: self.start_instrument(name)) for name in names},
+                                                   self.json_data.get('instrument_startup_timeouts'), close=self.stop_instrument)
+        self.c = instruments["caen"]
+        self.k = instruments["keysight"]
+        self.r0 = instruments["rigol0"]
+        self.r1 = instruments["rigol1"]
+        #Brings back only the VISA sessions that break, see reset_pyvisa_connections
+        self.reconnects = ReconnectManager(self.rm)
         #Now we can get the input for the name of the test
         if (name):
             self.test_name = name
@@ -62,6 +69,9 @@ class LDOmeasure:
         self.datastore['test_name'] = self.test_name
         self.start_time = datetime.now()
         self.datastore['start_time'] = self.start_time
+        self.datastore['startup_times'] = self.startup_times
+        #The test steps can run at the same time, so only one of them writes to the spreadsheet or saves it at once
+        self.spreadsheet_lock = threading.RLock()
         self.initialize_spreadsheet()
 
         self.fan_test_result = True
@@ -69,15 +79,21 @@ class LDOmeasure:
         self.hv_test_result = True
 
         self.datastore['Tests'] = {}
+        self.datastore['hv_captures'] = {}
+        #How long each wait actually took to settle, keyed by what was being waited for
+        self.settle_times = {}
         
 
+        #The fan and heater tests use Rigol 0, Rigol 1's fanread output and the DAQ's 901A mux card, and the HV test uses the CAEN,
+        #Rigol 1's pullups and the DAQ's 907A relay outputs, so the fan and heater tests can run during the HV test's captures
+        #The fan and heater tests share the mux card, so they still take turns
+        #If one of them fails, everything is powered off straight away and the others stop at their next measurement
+        self.scheduler = StepScheduler(self.json_data.get('run_tests_concurrently', "False") == "True", on_failure=self.emergency_shutoff)
+        self.scheduler.add("fan", self.fan_test, ["rigol0", "rigol1.fanread", "keysight.901A"])
+        self.scheduler.add("heater", self.heater_test, ["rigol0", "keysight.901A"])
+        self.scheduler.add("hv", self.hv_test, ["caen", "rigol1.hvpullup", "keysight.907A"])
         try:
-            self.fan_test()
-            self.wb.save(self.path_to_spreadsheet)
-            self.heater_test()
-            self.wb.save(self.path_to_spreadsheet)
-            
-            self.hv_test() #add'l specific exceptions are handled within 
+            self.scheduler.run() #add'l specific HV exceptions are handled within hv_test
         except:
             print("Detected exception, powering off all devices first.")
             self.emergency_shutoff()		
@@ -91,7 +107,18 @@ class LDOmeasure:
         else:
             self.ws.cell(row=self.row, column=1, value=self.test_name).style = "fail"
             self.datastore['overall'] = "Fail"
-        self.wb.save(self.path_to_spreadsheet)
+        self.save_spreadsheet()
+        self.datastore['test_schedule'] = self.scheduler.stats()
+        self.datastore['settle_times'] = self.settle_times
+        self.datastore['rigol_settle_times'] = {"rigol0": self.r0.settle_times, "rigol1": self.r1.settle_times}
+
+        #Deferred plots are drawn now that the instruments are done with, and any still being drawn are waited for
+        print(f"{self.prefix} --> Finishing plots...")
+        self.plots.finish()
+        self.plots.shutdown()
+        self.datastore['plots_made'] = self.plots.plots_made
+        self.datastore['plot_time'] = self.plots.plot_time
+        self.datastore['visa_reconnects'] = self.reconnects.stats()
 
         end_time = datetime.now()
         test_time = end_time - self.start_time
@@ -195,7 +222,7 @@ class LDOmeasure:
             for column_letter in column_letters:
                 self.ws.column_dimensions[column_letter].bestFit = True
             self.ws.freeze_panes = self.ws.cell(row=3, column=2)
-            self.wb.save(self.path_to_spreadsheet)
+            self.save_spreadsheet()
             self.row = 3
 
         #In any case, start filling in the spreadsheet with initial test parameters we have right know
@@ -203,15 +230,21 @@ class LDOmeasure:
         self.ws.cell(row=self.row, column=1, value=self.test_name).style = "fail"
         self.ws.cell(row=self.row, column=2, value=datetime.today().strftime('%m/%d/%Y'))
         self.ws.cell(row=self.row, column=3, value=datetime.today().strftime('%I:%M:%S %p'))
-        self.wb.save(self.path_to_spreadsheet)
+        self.save_spreadsheet()
+
+    def save_spreadsheet(self):
+        with self.spreadsheet_lock:
+            self.wb.save(self.path_to_spreadsheet)
 
     def fan_test(self):
         #Fan test
         self.k.initialize_fan()
         self.r0.power("ON", "fan")
         self.r1.power("ON", "fanread")
-        print(f"{self.prefix} --> Fans turned on, waiting {self.json_data['fan_wait']} seconds for the fans to reach steady state...")
-        time.sleep(self.json_data['fan_wait'])
+        print(f"{self.prefix} --> Fans turned on, waiting up to {self.json_data['fan_wait']} seconds for the fans to reach steady state...")
+        #The fans are up to speed once the current they draw stops changing
+        self.settle("fan", lambda: self.r0.get_current("fan"), self.json_data.get('fan_settle_tolerance', 0.02),
+                    self.json_data['fan_wait'], self.json_data.get('fan_settle_min', 1))
         fan_voltage = self.r0.get_voltage("fan")
         fan_current = self.r0.get_current("fan")
         fanread_voltage = self.r1.get_voltage("fanread")
@@ -224,36 +257,38 @@ class LDOmeasure:
         print(f"{self.prefix} --> Read signal for each fan was {fan_read_signal}")
         print(f"{self.prefix} --> Fan read pullup supply was {fanread_voltage}V and {fanread_current}A")
 
-        self.fan_test_result = True
-        if ((fan_voltage < self.json_data["fan_voltage_max"]) and (fan_voltage > self.json_data["fan_voltage_min"])):
-            self.ws.cell(row=self.row, column=4, value=fan_voltage)
-            self.datastore['Tests']['fan_voltage_test'] = "Pass"
-        else:
-            self.ws.cell(row=self.row, column=4, value=fan_voltage).style = "fail"
-            self.datastore['Tests']['fan_voltage_test'] = "Fail"
-            self.fan_test_result = False
+        with self.spreadsheet_lock:
+            self.fan_test_result = True
+            if ((fan_voltage < self.json_data["fan_voltage_max"]) and (fan_voltage > self.json_data["fan_voltage_min"])):
+                self.ws.cell(row=self.row, column=4, value=fan_voltage)
+                self.datastore['Tests']['fan_voltage_test'] = "Pass"
+            else:
+                self.ws.cell(row=self.row, column=4, value=fan_voltage).style = "fail"
+                self.datastore['Tests']['fan_voltage_test'] = "Fail"
+                self.fan_test_result = False
 
-        if ((fan_current < self.json_data["fan_current_max"]) and (fan_current > self.json_data["fan_current_min"])):
-            self.ws.cell(row=self.row, column=5, value=fan_current)
-            self.datastore['Tests']['fan_current_test'] = "Pass"
-        else:
-            self.ws.cell(row=self.row, column=5, value=fan_current).style = "fail"
-            self.datastore['Tests']['fan_current_test'] = "Fail"
-            self.fan_test_result = False
-
-        for i in range(1,7):
-            if ((fan_read_signal[i] < self.json_data["fan_read_max"]) and (fan_read_signal[i] > self.json_data["fan_read_min"])):
-                self.ws.cell(row=self.row, column=self.fan_rd_first_col-1+i, value=round(fan_read_signal[i], self.rounding_factor))
-                self.datastore['Tests'][f'fan_signal_test_{i}'] = "Pass"
+            if ((fan_current < self.json_data["fan_current_max"]) and (fan_current > self.json_data["fan_current_min"])):
+                self.ws.cell(row=self.row, column=5, value=fan_current)
+                self.datastore['Tests']['fan_current_test'] = "Pass"
             else:
-                self.ws.cell(row=self.row, column=self.fan_rd_first_col-1+i, value=round(fan_read_signal[i], self.rounding_factor)).style = "fail"
+                self.ws.cell(row=self.row, column=5, value=fan_current).style = "fail"
+                self.datastore['Tests']['fan_current_test'] = "Fail"
                 self.fan_test_result = False
 
-        self.datastore['fan_voltage'] = fan_voltage
-        self.datastore['fan_current'] = fan_current
-        self.datastore['fanread_voltage'] = fanread_voltage
-        self.datastore['fanread_current'] = fanread_current
-        self.datastore['fan_read_signal'] = fan_read_signal
+            for i in range(1,7):
+                if ((fan_read_signal[i] < self.json_data["fan_read_max"]) and (fan_read_signal[i] > self.json_data["fan_read_min"])):
+                    self.ws.cell(row=self.row, column=self.fan_rd_first_col-1+i, value=round(fan_read_signal[i], self.rounding_factor))
+                    self.datastore['Tests'][f'fan_signal_test_{i}'] = "Pass"
+                else:
+                    self.ws.cell(row=self.row, column=self.fan_rd_first_col-1+i, value=round(fan_read_signal[i], self.rounding_factor)).style = "fail"
+                    self.fan_test_result = False
+
+            self.datastore['fan_voltage'] = fan_voltage
+            self.datastore['fan_current'] = fan_current
+            self.datastore['fanread_voltage'] = fanread_voltage
+            self.datastore['fanread_current'] = fanread_current
+            self.datastore['fan_read_signal'] = fan_read_signal
+            self.save_spreadsheet()
 
     def heater_test(self):
         #Heater test
@@ -262,17 +297,18 @@ class LDOmeasure:
         heater_resistance = self.k.measure_resistance()
         print(f"{self.prefix} --> Heating element resistances are {heater_resistance}")
 
-        self.heat_test_result = True
-        for i in range(1,5):
-            if ((heater_resistance[i] < self.json_data["heating_element_max"]) and (heater_resistance[i] > self.json_data["heating_element_min"])):
-                self.ws.cell(row=self.row, column=self.tc_res_first_col-1+i, value=round(heater_resistance[i], self.rounding_factor))
-                self.datastore['Tests'][f'heating_element_test_{i}'] = "Pass"
-            else:
-                self.ws.cell(row=self.row, column=self.tc_res_first_col-1+i, value=round(heater_resistance[i], self.rounding_factor)).style = "fail"
-                self.datastore['Tests'][f'heating_element_test_{i}'] = "Fail"
-                self.heat_test_result = False
+        with self.spreadsheet_lock:
+            self.heat_test_result = True
+            for i in range(1,5):
+                if ((heater_resistance[i] < self.json_data["heating_element_max"]) and (heater_resistance[i] > self.json_data["heating_element_min"])):
+                    self.ws.cell(row=self.row, column=self.tc_res_first_col-1+i, value=round(heater_resistance[i], self.rounding_factor))
+                    self.datastore['Tests'][f'heating_element_test_{i}'] = "Pass"
+                else:
+                    self.ws.cell(row=self.row, column=self.tc_res_first_col-1+i, value=round(heater_resistance[i], self.rounding_factor)).style = "fail"
+                    self.datastore['Tests'][f'heating_element_test_{i}'] = "Fail"
+                    self.heat_test_result = False
 
-        self.datastore['heater_resistance'] = heater_resistance
+            self.datastore['heater_resistance'] = heater_resistance
 
         #Then prepare RTD and switch relay to connect power
         self.k.initialize_rtd()
@@ -280,7 +316,9 @@ class LDOmeasure:
         self.r0.power("ON", "heat_supply")
         self.r0.power("ON", "heat_switch")
         print(f"{self.prefix} --> Heat turned on, waiting {self.json_data['heat_wait']} seconds for the sensors to heat up...")
-        time.sleep(self.json_data['heat_wait'])
+        #This one stays a fixed wait. The test is how much the temperature rises in heat_wait seconds, so waiting until it's stable
+        #would change what's being measured
+        self.scheduler.sleep(self.json_data['heat_wait'])
         supply_voltage = self.r0.get_voltage("heat_supply")
         supply_current = self.r0.get_current("heat_supply")
         switch_voltage = self.r0.get_voltage("heat_switch")
@@ -300,23 +338,25 @@ class LDOmeasure:
         print(f"{self.prefix} --> Original temperatures were {temp1}")
         print(f"{self.prefix} --> Temperatures after {self.json_data['heat_wait']} seconds were {temp2}, a rise of {temp_rise}")
 
-        for i in range(4):
-            if ((temp_rise[i] < self.json_data["temp_increase_max"]) and (temp_rise[i] > self.json_data["temp_increase_min"])):
-                self.ws.cell(row=self.row, column=self.tc_res_first_col+4+i, value=round(temp_rise[i], self.rounding_factor))
-                self.datastore['Tests'][f'temperature_rise_test_{i}'] = "Pass"
-            else:
-                self.ws.cell(row=self.row, column=self.tc_res_first_col+4+i, value=round(temp_rise[i], self.rounding_factor)).style = "fail"
-                self.datastore['Tests'][f'temperature_rise_test_{i}'] = "Fail"
-                self.heat_test_result = False
+        with self.spreadsheet_lock:
+            for i in range(4):
+                if ((temp_rise[i] < self.json_data["temp_increase_max"]) and (temp_rise[i] > self.json_data["temp_increase_min"])):
+                    self.ws.cell(row=self.row, column=self.tc_res_first_col+4+i, value=round(temp_rise[i], self.rounding_factor))
+                    self.datastore['Tests'][f'temperature_rise_test_{i}'] = "Pass"
+                else:
+                    self.ws.cell(row=self.row, column=self.tc_res_first_col+4+i, value=round(temp_rise[i], self.rounding_factor)).style = "fail"
+                    self.datastore['Tests'][f'temperature_rise_test_{i}'] = "Fail"
+                    self.heat_test_result = False
 
-        self.datastore['heater_supply_voltage'] = supply_voltage
-        self.datastore['heater_supply_current'] = supply_current
-        self.datastore['heater_switch_voltage'] = switch_voltage
-        self.datastore['heater_switch_current'] = switch_current
+            self.datastore['heater_supply_voltage'] = supply_voltage
+            self.datastore['heater_supply_current'] = supply_current
+            self.datastore['heater_switch_voltage'] = switch_voltage
+            self.datastore['heater_switch_current'] = switch_current
 
-        self.datastore['temp1'] = temp1
-        self.datastore['temp2'] = temp2
-        self.datastore['temp_rise'] = temp_rise
+            self.datastore['temp1'] = temp1
+            self.datastore['temp2'] = temp2
+            self.datastore['temp_rise'] = temp_rise
+            self.save_spreadsheet()
 
     def hv_test(self):
         #HV Leakage Test
@@ -324,6 +364,13 @@ class LDOmeasure:
         self.r1.power("ON", "hvpullup")
         self.r1.power("ON", "hvpullup2")
         self.hv_test_result = True        
+        #Each phase's fits and plots are done by the analysis workers while the next phase ramps and records
+        #They're all collected into hv_results before anything is passed or failed
+        workers = 0
+        if (self.json_data.get('hv_background_analysis', "False") == "True"):
+            workers = self.json_data.get('hv_analysis_workers', 2)
+        self.hv_phase_times = []
+        self.analysis = AnalysisPipeline(self.results_path, workers, self.json_data.get('hv_fit_fast_path_residual'), self.capture_cache, self.plots)
         # for i in self.json_data['channels_to_test']:
         if (self.json_data["simultaneous_test"] == "True"): #This distinction does not matter if only one channel total is being tested
             chs_to_test = self.json_data['channels_to_test'] #Test all channels at once
@@ -336,10 +383,13 @@ class LDOmeasure:
             single_test_done = False
             if (self.json_data["simultaneous_test"] == "True"):
             	single_test = chs_to_test            	
+            #Whatever a failed attempt handed to the analysis is dropped, the retry does every phase again
+            attempt = self.analysis.mark()
             try:
             	self.hv_test_single(single_test, hv_results)
             	single_test_done = True
             except (ConnectionResetError, BrokenPipeError) as e:
+            	self.analysis.discard(attempt)
             	print(traceback.format_exc())
             	print("Connection broken, attempting to reset...")
             	self.c.turn_off(list(range(16)), emergency=True)             	    
@@ -347,7 +397,8 @@ class LDOmeasure:
             	self.r1.power("ON", "hvpullup")
             	self.r1.power("ON", "hvpullup2")   
             except SystemExit as e:
-            	self.emergency_shutoff() 
+            	self.analysis.discard(attempt)
+            	self.emergency_shutoff(hv_only=True) 
             	print(traceback.format_exc())
             	print("Detecting exception",e,"but shutting off and continuing...")      
             	self.r1.power("ON", "hvpullup")
@@ -372,452 +423,402 @@ class LDOmeasure:
                 print("Connection broken, attempting to reset...")
                 self.reset_pyvisa_connections()
 
-        #Voltage is in volts, current is in microamps, R in Mohms
-        for i in chs_to_test:
-            try:
-                hv_results[i]["pos_open_R"] = float(hv_results[i]["pos_open_V"])/float(hv_results[i]["pos_open_I"])
-            except:
-                hv_results[i]["pos_open_R"] = 0
-            try:
-                hv_results[i]["pos_term_R"] = float(hv_results[i]["pos_term_V"])/float(hv_results[i]["pos_term_I"])
-            except:
-                hv_results[i]["pos_term_R"] = 0
-            try:
-                hv_results[i]["neg_open_R"] = float(hv_results[i]["neg_open_V"])/float(hv_results[i]["neg_open_I"])
-            except:
-                hv_results[i]["neg_open_R"] = 0
-            try:
-                hv_results[i]["neg_term_R"] = float(hv_results[i]["neg_term_V"])/float(hv_results[i]["neg_term_I"])
-            except:
-                hv_results[i]["neg_term_R"] = 0
-
-            print(f"{self.prefix} --> Channel {i} HV results are {hv_results[i]}")
-
-            for num,j in enumerate(["pos_open_R", "neg_open_R"]):
-                max_val = self.json_data["hv_resistance_open_max"]
-                min_val = self.json_data["hv_resistance_open_min"]
-
-                if ((float(hv_results[i][j]) < max_val) and (float(hv_results[i][j]) > min_val)):
-                    self.ws.cell(row=self.row, column=self.hv_res_first_col+(i*self.hv_cols)+(num*6), value=f"{round(float(hv_results[i][j]), self.rounding_factor)}Mohm")
-                    self.datastore['Tests'][f'hv_test_ch{i}_{j}'] = "Pass"
-                else:
-                    self.ws.cell(row=self.row, column=self.hv_res_first_col+(i*self.hv_cols)+(num*6), value=f"{round(float(hv_results[i][j]), self.rounding_factor)}Mohm").style = "fail"
-                    self.datastore['Tests'][f'hv_test_ch{i}_{j}'] = "Fail"
-                    self.hv_test_result = False
-
-            for num,j in enumerate(["pos_term_R", "neg_term_R"]):
-                max_val = self.json_data["hv_resistance_term_max"]
-                min_val = self.json_data["hv_resistance_term_min"]
-
-                if ((float(hv_results[i][j]) < max_val) and (float(hv_results[i][j]) > min_val)):
-                    self.ws.cell(row=self.row, column=self.hv_res_first_col+3+(i*self.hv_cols)+(num*6), value=f"{round(float(hv_results[i][j]*1E3), self.rounding_factor)}kohm")
-                    self.datastore['Tests'][f'hv_test_ch{i}_{j}'] = "Pass"
-                else:
-                    self.ws.cell(row=self.row, column=self.hv_res_first_col+3+(i*self.hv_cols)+(num*6), value=f"{round(float(hv_results[i][j]*1E3), self.rounding_factor)}kohm").style = "fail"
-                    self.datastore['Tests'][f'hv_test_ch{i}_{j}'] = "Fail"
-                    self.hv_test_result = False
-
-            for num,j in enumerate(["pos_open", "pos_term", "neg_open", "neg_term"]):
-                j_on = j + "_on_fit"
-                j_off = j + "_off_fit"
-                if ((float(hv_results[i][j_on][0][1]) < self.json_data["hv_tau_max"]) and (float(hv_results[i][j_on][0][1]) > self.json_data["hv_tau_min"])):
-                    self.ws.cell(row=self.row, column=self.hv_res_first_col+1+(i*self.hv_cols)+(num*3), value=round(float(hv_results[i][j_on][0][1]), self.rounding_factor))
-                    self.datastore['Tests'][f'hv_on_fit_test_ch{i}_{j_on}'] = "Pass"
-                else:
-                    self.ws.cell(row=self.row, column=self.hv_res_first_col+1+(i*self.hv_cols)+(num*3), value=round(float(hv_results[i][j_on][0][1]), self.rounding_factor)).style = "fail"
-                    self.datastore['Tests'][f'hv_on_fit_test_ch{i}_{j_on}'] = "Fail"
-                    self.hv_test_result = False
-                if ((float(hv_results[i][j_off][0][1]) < self.json_data["hv_tau_max"]) and (float(hv_results[i][j_off][0][1]) > self.json_data["hv_tau_min"])):
-                    self.ws.cell(row=self.row, column=self.hv_res_first_col+2+(i*self.hv_cols)+(num*3), value=round(float(hv_results[i][j_off][0][1]), self.rounding_factor))
-                    self.datastore['Tests'][f'hv_off_fit_test_ch{i}_{j_off}'] = "Pass"
-                else:
-                    self.ws.cell(row=self.row, column=self.hv_res_first_col+2+(i*self.hv_cols)+(num*3), value=round(float(hv_results[i][j_off][0][1]), self.rounding_factor)).style = "fail"
-                    self.datastore['Tests'][f'hv_off_fit_test_ch{i}_{j_off}'] = "Fail"
-                    self.hv_test_result = False
-
-            self.datastore[f'hv_ch{i}'] = {}
-            for j in ["pos_open_V", "pos_open_I", "pos_open_R", "neg_open_V", "neg_open_I", "neg_open_R", "pos_open_on_fit", "pos_open_off_fit", "neg_open_on_fit", "neg_open_off_fit",
-                      "pos_term_V", "pos_term_I", "pos_term_R", "neg_term_V", "neg_term_I", "neg_term_R", "pos_term_on_fit", "pos_term_off_fit", "neg_term_on_fit", "neg_term_off_fit"]:
-                self.datastore[f'hv_ch{i}'][j] = hv_results[i][j]
+        #Anything still being fit or plotted is finished and put into hv_results here
+        self.analysis.join(hv_results)
+        self.analysis.shutdown()
+        self.datastore['hv_analysis_time'] = self.analysis.analysis_time
+        self.datastore['hv_analysis_wait'] = self.analysis.wait_time
+        #How long each step of the HV sequence took, and how much of it was ramping, settling and capturing
+        self.datastore['hv_phase_times'] = self.hv_phase_times
+        #How long each ramp took and how many times the supervisor had to check on it
+        self.datastore['hv_ramps'] = self.c.ramp.history
+        self.datastore['caen_settings_hits'] = self.c.caen.settings_hits
+        self.datastore['caen_settings_misses'] = self.c.caen.settings_misses
+        if (self.c.caen.events):
+            self.datastore['caen_events'] = self.c.caen.events.stats()
+        self.datastore['caen_io'] = self.c.caen.io.stats()
+        if (self.c.watchdog):
+            self.datastore['caen_watchdog'] = self.c.watchdog.stats()
+
+        with self.spreadsheet_lock:
+            #Voltage is in volts, current is in microamps, R in Mohms
+            for i in chs_to_test:
+                for j in ["pos_open", "pos_term", "neg_open", "neg_term"]:
+                    #A phase left out of hv_phases has nothing to check
+                    if (f"{j}_V" not in hv_results[i]):
+                        continue
+                    try:
+                        hv_results[i][f"{j}_R"] = float(hv_results[i][f"{j}_V"])/float(hv_results[i][f"{j}_I"])
+                    except:
+                        hv_results[i][f"{j}_R"] = 0
+
+                print(f"{self.prefix} --> Channel {i} HV results are {hv_results[i]}")
+
+                for num,j in enumerate(["pos_open_R", "neg_open_R"]):
+                    if (j not in hv_results[i]):
+                        continue
+                    max_val = self.json_data["hv_resistance_open_max"]
+                    min_val = self.json_data["hv_resistance_open_min"]
+
+                    if ((float(hv_results[i][j]) < max_val) and (float(hv_results[i][j]) > min_val)):
+                        self.ws.cell(row=self.row, column=self.hv_res_first_col+(i*self.hv_cols)+(num*6), value=f"{round(float(hv_results[i][j]), self.rounding_factor)}Mohm")
+                        self.datastore['Tests'][f'hv_test_ch{i}_{j}'] = "Pass"
+                    else:
+                        self.ws.cell(row=self.row, column=self.hv_res_first_col+(i*self.hv_cols)+(num*6), value=f"{round(float(hv_results[i][j]), self.rounding_factor)}Mohm").style = "fail"
+                        self.datastore['Tests'][f'hv_test_ch{i}_{j}'] = "Fail"
+                        self.hv_test_result = False
+
+                for num,j in enumerate(["pos_term_R", "neg_term_R"]):
+                    if (j not in hv_results[i]):
+                        continue
+                    max_val = self.json_data["hv_resistance_term_max"]
+                    min_val = self.json_data["hv_resistance_term_min"]
+
+                    if ((float(hv_results[i][j]) < max_val) and (float(hv_results[i][j]) > min_val)):
+                        self.ws.cell(row=self.row, column=self.hv_res_first_col+3+(i*self.hv_cols)+(num*6), value=f"{round(float(hv_results[i][j]*1E3), self.rounding_factor)}kohm")
+                        self.datastore['Tests'][f'hv_test_ch{i}_{j}'] = "Pass"
+                    else:
+                        self.ws.cell(row=self.row, column=self.hv_res_first_col+3+(i*self.hv_cols)+(num*6), value=f"{round(float(hv_results[i][j]*1E3), self.rounding_factor)}kohm").style = "fail"
+                        self.datastore['Tests'][f'hv_test_ch{i}_{j}'] = "Fail"
+                        self.hv_test_result = False
+
+                for num,j in enumerate(["pos_open", "pos_term", "neg_open", "neg_term"]):
+                    j_on = j + "_on_fit"
+                    j_off = j + "_off_fit"
+                    if (j_on in hv_results[i]):
+                        if ((float(hv_results[i][j_on][0][1]) < self.json_data["hv_tau_max"]) and (float(hv_results[i][j_on][0][1]) > self.json_data["hv_tau_min"])):
+                            self.ws.cell(row=self.row, column=self.hv_res_first_col+1+(i*self.hv_cols)+(num*3), value=round(float(hv_results[i][j_on][0][1]), self.rounding_factor))
+                            self.datastore['Tests'][f'hv_on_fit_test_ch{i}_{j_on}'] = "Pass"
+                        else:
+                            self.ws.cell(row=self.row, column=self.hv_res_first_col+1+(i*self.hv_cols)+(num*3), value=round(float(hv_results[i][j_on][0][1]), self.rounding_factor)).style = "fail"
+                            self.datastore['Tests'][f'hv_on_fit_test_ch{i}_{j_on}'] = "Fail"
+                            self.hv_test_result = False
+                    if (j_off in hv_results[i]):
+                        if ((float(hv_results[i][j_off][0][1]) < self.json_data["hv_tau_max"]) and (float(hv_results[i][j_off][0][1]) > self.json_data["hv_tau_min"])):
+                            self.ws.cell(row=self.row, column=self.hv_res_first_col+2+(i*self.hv_cols)+(num*3), value=round(float(hv_results[i][j_off][0][1]), self.rounding_factor))
+                            self.datastore['Tests'][f'hv_off_fit_test_ch{i}_{j_off}'] = "Pass"
+                        else:
+                            self.ws.cell(row=self.row, column=self.hv_res_first_col+2+(i*self.hv_cols)+(num*3), value=round(float(hv_results[i][j_off][0][1]), self.rounding_factor)).style = "fail"
+                            self.datastore['Tests'][f'hv_off_fit_test_ch{i}_{j_off}'] = "Fail"
+                            self.hv_test_result = False
+
+                self.datastore[f'hv_ch{i}'] = {}
+                for j in ["pos_open_V", "pos_open_I", "pos_open_R", "neg_open_V", "neg_open_I", "neg_open_R", "pos_open_on_fit", "pos_open_off_fit", "neg_open_on_fit", "neg_open_off_fit",
+                          "pos_term_V", "pos_term_I", "pos_term_R", "neg_term_V", "neg_term_I", "neg_term_R", "pos_term_on_fit", "pos_term_off_fit", "neg_term_on_fit", "neg_term_off_fit"]:
+                    if (j in hv_results[i]):
+                        self.datastore[f'hv_ch{i}'][j] = hv_results[i][j]
 
     def hv_test_single(self, single_test, hv_results):
             if (self.json_data["simultaneous_test"] != "True"):
             	chs_to_test = [single_test] #Test only one channel at a time
             else:
             	chs_to_test = single_test #Test all channels (input is array)
-            		
-            #chs_to_test = self.json_data['channels_to_test']
-            pos_chs = []
-            neg_chs = []
-            
+
+            #Which CAEN channel each test channel is on for each polarity, so the analysis knows where to put each channel's fit
+            chs_map = {"pos": {}, "neg": {}}
             for i in chs_to_test:
-                pos_chs.append(self.json_data[f"pcb_ch_{i}_pos"])
-                neg_chs.append(self.json_data[f"pcb_ch_{i}_neg"])
+                chs_map["pos"][i] = self.json_data[f"pcb_ch_{i}_pos"]
+                chs_map["neg"][i] = self.json_data[f"pcb_ch_{i}_neg"]
                 hv_results[i] = {}
 
             chs_string = ""
             for i in chs_to_test:
                 chs_string = chs_string + str(i) + "_"
 
-            #Measure the ramp from 0 to positive voltage with open termination
-            v = self.json_data['caenR8033DM_open_voltage']
-            relay_setting = 0
-            for i in chs_to_test:
-                relay_setting = relay_setting | (1 << i)  
-            for pos_ch in pos_chs:
-                self.c.set_HV_value(pos_ch, v)
-                print(f"{self.prefix} --> Turning Channel {pos_ch} HV from 0 to {v}V with open termination")
-
-            #self.k.set_relay(0, 1 << i) #<- how does this work?
-            ramp_done = False
-            while not ramp_done:
-                try:
-            	    self.k.set_relay(0, relay_setting)
-            	    self.c.turn_on(pos_chs)
-            	    print(f"{self.prefix} --> HV reached max values, waiting {self.json_data['hv_stability_wait']} seconds to stabilize...")
-            	    ramp_done = True
-            	    time.sleep(self.json_data['hv_stability_wait']) #may need to change for simul test?
-                except (ConnectionResetError, BrokenPipeError) as e:
-            	    print(traceback.format_exc())
-            	    print("Connection broken, attempting to reset...")
-            	    self.c.turn_off(list(range(16)), emergency=True)
-            	    self.reset_pyvisa_connections()
-            	    self.r1.power("ON", "hvpullup")
-            	    self.r1.power("ON", "hvpullup2")
-
-
-
-            csv_name = f"{self.test_name}_chs{chs_string}pos_open_on.csv"
-            self.record_hv_data(csv_name)
-            for i in chs_to_test:
-                pos_ch = self.json_data[f"pcb_ch_{i}_pos"]
-                fit = self.hv_curve_fit(csv_name, pos_ch, on = True, term = False)
-                hv_results[i]["pos_open_on_fit"] = fit
-                hv_results[i]["pos_open_V"] = self.c.get_voltage(pos_ch)
-                hv_results[i]["pos_open_I"] = self.c.get_current(pos_ch)
-                self.make_plot(csv_name, f"Ch {i} from 0 to {v}V, open termination", pos_ch, fit[0][1], [v-5, v+5])
-
-            ###################
-
-            #Measure the ramp from positive voltage to 0 with open termination
-            for pos_ch in pos_chs:
-                print(f"{self.prefix} --> Turning Channel {pos_ch} HV from {v}V to 0 with open termination")
-            self.c.turn_off(pos_chs)
-            # print(f"{self.prefix} --> HV turned off, waiting {self.json_data['hv_stability_wait']} seconds to stabilize...")
-            # time.sleep(self.json_data['hv_stability_wait'])
-
-            csv_name = f"{self.test_name}_ch{chs_string}_pos_open_off.csv"
-            self.record_hv_data(csv_name)
-            for i in chs_to_test:
-                pos_ch = self.json_data[f"pcb_ch_{i}_pos"]
-                fit = self.hv_curve_fit(csv_name, pos_ch, on = False, term = False)
-                hv_results[i]["pos_open_off_fit"] = fit
-                self.make_plot(csv_name, f"Ch {i} from {v} to 0V, open termination", pos_ch, fit[0][1])
-
-            ###################
-
-            #Measure the ramp from 0 to positive voltage with 10k termination
-            v = self.json_data['caenR8033DM_term_voltage']
-            for pos_ch in pos_chs:
-                self.c.set_HV_value(pos_ch, v)
-                print(f"{self.prefix} --> Turning Channel {pos_ch} HV from 0 to {v}V with 10k termination")
-            ramp_done = False
-            while not ramp_done:
-                try:
-            	    self.k.set_relay(0, 0)
-            	    self.c.turn_on(pos_chs)
-            	    ramp_done = True
-            	    print(f"{self.prefix} --> HV reached max value, waiting {self.json_data['hv_termination_wait']} seconds to stabilize...")
-            	    time.sleep(self.json_data['hv_termination_wait'])
-                except (ConnectionResetError, BrokenPipeError) as e:
-            	    print(traceback.format_exc())
-            	    print("Connection broken, attempting to reset...")
-            	    self.c.turn_off(list(range(16)), emergency=True)
-            	    self.reset_pyvisa_connections()
-            	    self.r1.power("ON", "hvpullup")
-            	    self.r1.power("ON", "hvpullup2")
-
-
-            csv_name = f"{self.test_name}_ch{chs_string}_pos_term_on.csv"
-            self.record_hv_data(csv_name, short_time=True)
-            for i in chs_to_test:
-                pos_ch = self.json_data[f"pcb_ch_{i}_pos"]
-                fit = self.hv_curve_fit(csv_name, pos_ch, on = True, term = True)
-                hv_results[i]["pos_term_on_fit"] = fit
-                #hv_results[i]["pos_term_V"] = self.c.get_voltage(pos_ch)
-                #hv_results[i]["pos_term_I"] = self.c.get_current(pos_ch)
-
-
-                print("Measuring 10k terminated voltage and current...")
-                voltage = self.c.get_voltage(pos_ch, print_meas=True)
-                current = self.c.get_current(pos_ch, print_meas=True)
-
-                #print(f"Ch {i} voltage: {voltage}, current {current}, resistance {voltage/current}")
-                hv_results[i]["pos_term_V"] = voltage
-                hv_results[i]["pos_term_I"] = current
-
-                self.make_plot(csv_name, f"Ch {i} from 0 to {v}V, termination resistor", pos_ch, fit[0][1], [v-5, v+5])
-            time.sleep(5)
-            ###################
-
-            #Measure the ramp from positive voltage to 0 with 10k termination
-            for pos_ch in pos_chs:
-                print(f"{self.prefix} --> Turning Channel {pos_ch} HV from {v}V to 0 with 10k termination")
-            self.c.turn_off(pos_chs)
-            # print(f"{self.prefix} --> HV turned off, waiting {self.json_data['hv_stability_wait']} seconds to stabilize...")
-            # time.sleep(self.json_data['hv_stability_wait'])
-
-            csv_name = f"{self.test_name}_ch{chs_string}_pos_term_off.csv"
-            self.record_hv_data(csv_name, short_time=True)
-            for i in chs_to_test:
-                pos_ch = self.json_data[f"pcb_ch_{i}_pos"]
-                fit = self.hv_curve_fit(csv_name, pos_ch, on = False, term = True)
-                hv_results[i]["pos_term_off_fit"] = fit
-                self.make_plot(csv_name, f"Ch {i} from {v} to 0V, termination resistor", pos_ch, fit[0][1])
-
-            ###################
-
-            #Measure the ramp from 0 to negative voltage with open termination
-            v = self.json_data['caenR8033DM_open_voltage']
-            for neg_ch in neg_chs:
-                self.c.set_HV_value(neg_ch, v)
-                print(f"{self.prefix} --> Turning Channel {neg_ch} HV from 0 to -{v}V with open termination")
-            ramp_done = False
-            while not ramp_done:
-                try:
-            	    self.k.set_relay(relay_setting, relay_setting)
-            	    self.c.turn_on(neg_chs)
-            	    ramp_done = True
-            	    print(f"{self.prefix} --> HV reached max value, waiting {self.json_data['hv_stability_wait']} seconds to stabilize...")
-            	    time.sleep(self.json_data['hv_stability_wait'])
-                except (ConnectionResetError, BrokenPipeError) as e:
-            	    print(traceback.format_exc())
-            	    print("Connection broken, attempting to reset...")
-            	    self.c.turn_off(list(range(16)), emergency=True)
-            	    self.reset_pyvisa_connections()
-            	    self.r1.power("ON", "hvpullup")
-            	    self.r1.power("ON", "hvpullup2")
-
-            csv_name = f"{self.test_name}_ch{chs_string}_neg_open_on.csv"
-            self.record_hv_data(csv_name)
-            for i in chs_to_test:
-                neg_ch = self.json_data[f"pcb_ch_{i}_neg"]
-                fit = self.hv_curve_fit(csv_name, neg_ch, on = True, term = False)
-                hv_results[i]["neg_open_on_fit"] = fit
-                hv_results[i]["neg_open_V"] = self.c.get_voltage(neg_ch)
-                hv_results[i]["neg_open_I"] = self.c.get_current(neg_ch)
-                self.make_plot(csv_name, f"Ch {i} from 0 to -{v}V, open termination", neg_ch, fit[0][1], [v-5, v+5])
-
-            ###################
-
-            #Measure the ramp from negative voltage to 0 with open termination
-            for neg_ch in neg_chs:
-                print(f"{self.prefix} --> Turning Channel {neg_ch} HV from -{v}V to 0 with open termination")
-            self.c.turn_off(neg_chs)
-            # print(f"{self.prefix} --> HV turned off, waiting {self.json_data['hv_stability_wait']} seconds to stabilize...")
-            # time.sleep(self.json_data['hv_stability_wait'])
-
-            csv_name = f"{self.test_name}_ch{chs_string}_neg_open_off.csv"
-            self.record_hv_data(csv_name)
-            for i in chs_to_test:
-                neg_ch = self.json_data[f"pcb_ch_{i}_neg"]
-                fit = self.hv_curve_fit(csv_name, neg_ch, on = False, term = False)
-                hv_results[i]["neg_open_off_fit"] = fit
-                self.make_plot(csv_name, f"Ch {i} from -{v} to 0V, open termination", neg_ch, fit[0][1])
-
-            ###################
-            
-            #Measure the ramp from 0 to negative voltage with 10k termination
-            v = self.json_data['caenR8033DM_term_voltage']
-            for neg_ch in neg_chs:
-                self.c.set_HV_value(neg_ch, v)
-                print(f"{self.prefix} --> Turning Channel {neg_ch} HV from 0 to -{v}V with 10k termination")
-            ramp_done = False
-
-            while not ramp_done:
-                try:
-            	    self.k.set_relay(relay_setting, 0)
-            	    self.c.turn_on(pos_chs)
-            	    ramp_done = True
-            	    print(f"{self.prefix} --> HV reached max value, waiting {self.json_data['hv_termination_wait']} seconds to stabilize...")
-            	    time.sleep(self.json_data['hv_termination_wait'])
-                except (ConnectionResetError, BrokenPipeError) as e:
-            	    print(traceback.format_exc())
-            	    print("Connection broken, attempting to reset...")
-            	    self.c.turn_off(list(range(16)), emergency=True)
-            	    self.reset_pyvisa_connections()
-            	    self.r1.power("ON", "hvpullup")
-            	    self.r1.power("ON", "hvpullup2")
-                # except ValueError as e:
-                    # print(e)
-                    # #print("Positive channel voltages:", self.c.get_current(pos_chs))
-
-                    # self.c.turn_off(neg_chs)
-
-                    # pullups_ok = False
-                    # while not pullups_ok:
-                        # try:
-                            # hvv = self.r1.get_voltage("hvpullup")
-                            # hv2v = self.r1.get_voltage("hvpullup2")
-                            # if hvv >= 18 and hv2v >= 18: #check if they are on
-                                # pullups_ok = True
-                            # else:
-                                # print("Resetting and power cycling pullup")
-                                # print(hvv, hv2v)
-                                # raise ValueError("")
-                        # except Exception as e:
-                            # print(e)
-                            # try:
-                                # self.reset_pullup_rigol_and_power_on()
-                                # time.sleep(5)
-                            # except Exception as e:
-                                # time.sleep(5)
-                                # pass #run again
-                    # # self.reset_pyvisa_connections()
-                    # # self.r1.power("ON", "hvpullup")
-                    # # self.r1.power("ON", "hvpullup2")
-                    # # time.sleep(1)
-                    # print("Resetting relays")
-                    # #self.k.keysight.close()
-                    # #self.k = Keysight970A(self.rm, self.json_data)
-                    # #time.sleep(1)
-                    # self.k.set_relay(0, relay_setting)
-                    # print("Trying to fire relay again")
-                    # #try block will run again
-
-            csv_name = f"{self.test_name}_ch{chs_string}_neg_term_on.csv"
-            self.record_hv_data(csv_name, short_time=True)
-            for i in chs_to_test:
-                neg_ch = self.json_data[f"pcb_ch_{i}_neg"]          
-                fit = self.hv_curve_fit(csv_name, neg_ch, on = True, term = True)
-                hv_results[i]["neg_term_on_fit"] = fit
-                #hv_results[i]["neg_term_V"] = self.c.get_voltage(neg_ch)
-                #hv_results[i]["neg_term_I"] = self.c.get_current(neg_ch)
-                print("Measuring 10k terminated voltage and current...")
-                voltage = self.c.get_voltage(neg_ch, print_meas=True)
-                current = self.c.get_current(neg_ch, print_meas=True)
-                #print(f"Ch {i} voltage: {voltage}, current {current}, resistance {voltage/current}")
-                hv_results[i]["neg_term_V"] = voltage
-                hv_results[i]["neg_term_I"] = current
-                self.make_plot(csv_name, f"Ch {i} from 0 to -{v}V, termination resistor", neg_ch, fit[0][1], [v-5, v+5])
-            time.sleep(5) #debug
-            ###################            
-            
-            #Measure the ramp from 0 to negative voltage with 10k termination
-            for neg_ch in neg_chs:
-                print(f"{self.prefix} --> Turning Channel {neg_ch} HV from -{v}V to 0 with 10k termination")
-            self.c.turn_off(neg_chs)
-            # print(f"{self.prefix} --> HV turned off, waiting {self.json_data['hv_stability_wait']} seconds to stabilize...")
-            # time.sleep(self.json_data['hv_stability_wait'])
-
-            csv_name = f"{self.test_name}_ch{chs_string}_neg_term_off.csv"
-            self.record_hv_data(csv_name, short_time=True)
-            for i in chs_to_test:
-                neg_ch = self.json_data[f"pcb_ch_{i}_neg"]              
-                fit = self.hv_curve_fit(csv_name, neg_ch, on = False, term = True)
-                hv_results[i]["neg_term_off_fit"] = fit
-                self.make_plot(csv_name, f"Ch {i} from -{v} to 0V, termination resistor", neg_ch, fit[0][1])
-
-            ###################            
-
-
-            
-    def emergency_shutoff(self):
+            #The phases and their order come from hv_phases in the config, see hv_sequence.py
+            for step in load_phases(self.json_data):
+                self.run_hv_step(step, chs_to_test, chs_map, chs_string, hv_results)
+
+    #Does one step of the HV sequence, one phase or a few that are done together. The relays are set and the channels ramped,
+    #then it waits for the HV to settle, records the capture, reads VMon and IMon for the resistance and hands the capture to the analysis
+    def run_hv_step(self, step, chs_to_test, chs_map, chs_string, hv_results):
+        start = time.monotonic()
+        names = [phase.name for phase in step]
+        relays = set(phase.relays(chs_to_test) for phase in step) - {None}
+        if (len(relays) > 1):
+            sys.exit(f"{self.prefix} --> Phases {names} need different relay settings {relays}, so they can't be done together")
+        plan = {"VSet": {}}
+        on_chs = []
+        off_chs = []
+        for phase in step:
+            chs = list(chs_map[phase.polarity].values())
+            if (phase.action == "on"):
+                plan["VSet"].update(dict.fromkeys(chs, phase.voltage))
+                on_chs.extend(chs)
+                for ch in chs:
+                    print(f"{self.prefix} --> Turning Channel {ch} HV from 0 to {phase.sign()}{phase.voltage}V with {termination_log[phase.termination]}")
+            else:
+                off_chs.extend(chs)
+                for ch in chs:
+                    print(f"{self.prefix} --> Turning Channel {ch} HV from {phase.sign()}{phase.voltage}V to 0 with {termination_log[phase.termination]}")
+        if (plan["VSet"]):
+            self.c.apply_configuration(plan)
+
+        ramp_done = False
+        while not ramp_done:
+            #Nothing gets turned on once another step has failed and everything was powered off
+            self.scheduler.check()
+            try:
+                for relay_hv, relay_term in relays:
+                    self.k.set_relay(relay_hv, relay_term)
+                if (on_chs):
+                    self.c.turn_on(on_chs)
+                if (off_chs):
+                    self.c.turn_off(off_chs)
+                ramp_done = True
+            except (ConnectionResetError, BrokenPipeError) as e:
+                print(traceback.format_exc())
+                print("Connection broken, attempting to reset...")
+                self.c.turn_off(list(range(16)), emergency=True)
+                self.reset_pyvisa_connections()
+                self.r1.power("ON", "hvpullup")
+                self.r1.power("ON", "hvpullup2")
+        ramped = time.monotonic()
+        wait = max(phase.wait for phase in step)
+        if (wait):
+            print(f"{self.prefix} --> HV reached max values, waiting up to {wait} seconds to stabilize...")
+            self.settle_hv(f"{'_'.join(names)}_stability", on_chs + off_chs, wait)
+        settled = time.monotonic()
+
+        csv_name = f"{self.test_name}_ch{chs_string}_{'_'.join(names)}.csv"
+        csv_name = self.record_hv_data(csv_name, short_time=all(phase.short_time for phase in step), adaptive=self.adaptive_capture(step, chs_map))
+        captured = time.monotonic()
+        for phase in step:
+            chs = chs_map[phase.polarity]
+            v = phase.voltage
+            if (phase.measure):
+                #Every channel's voltage and current are read together right after the capture
+                #The snapshot is raw, so they're rounded the same as the single channel reads used to give them
+                snap = self.c.snapshot(list(chs.values()), ("VMon", "IMon"))
+                for num,i in enumerate(chs_to_test):
+                    voltage = round(float(snap[num].VMon), self.rounding_factor)
+                    current = round(float(snap[num].IMon), self.rounding_factor)
+                    print(f"{self.prefix} --> Ch {chs[i]} VMon: {voltage}, IMon: {current}")
+                    hv_results[i][f"{phase.polarity}_{phase.termination}_V"] = voltage
+                    hv_results[i][f"{phase.polarity}_{phase.termination}_I"] = current
+            if (phase.analysis == "fit"):
+                plots = []
+                for i in chs_to_test:
+                    if (phase.action == "on"):
+                        plots.append((f"Ch {i} from 0 to {phase.sign()}{v}V, {termination_plot[phase.termination]}", chs[i], [v-5, v+5]))
+                    else:
+                        plots.append((f"Ch {i} from {phase.sign()}{v} to 0V, {termination_plot[phase.termination]}", chs[i], None))
+                self.analysis.submit(csv_name, f"{phase.name}_fit", chs, on = (phase.action == "on"), term = (phase.termination == "term"), plots = plots)
+        pause = max(phase.pause for phase in step)
+        if (pause):
+            self.settle_hv(f"{'_'.join(names)}_pause", on_chs + off_chs, pause)
+
+        timing = {}
+        timing['phases'] = names
+        timing['channels'] = list(chs_to_test)
+        timing['ramp'] = ramped - start
+        timing['settle'] = settled - ramped
+        timing['capture'] = captured - settled
+        timing['total'] = time.monotonic() - start
+        self.hv_phase_times.append(timing)
+        print(f"{self.prefix} --> {' and '.join(names)} took {timing['total']:.1f} seconds, {timing['ramp']:.1f} of them ramping")
+
+    #hv_only leaves the fan and heater power alone, for an HV retry while the fan or heater test might be running alongside it
+    def emergency_shutoff(self, hv_only=False):
         self.c.turn_off(list(range(16)), emergency=True) #Turn off HV channels
         #input("pause here")
-        self.r0.power("OFF", "heat_supply") #Turn off fan and heater power
-        self.r0.power("OFF", "heat_switch")
-        self.r0.power("OFF", "fan")
-        self.r1.power("OFF", "fanread")
+        if (not hv_only):
+            #No waiting for each output to settle, they all go off one after the other as fast as the supplies take it
+            self.r0.power("OFF", "heat_supply", settle=False) #Turn off fan and heater power
+            self.r0.power("OFF", "heat_switch", settle=False)
+            self.r0.power("OFF", "fan", settle=False)
+            self.r1.power("OFF", "fanread", settle=False)
         self.k.set_relay(0, 0) #Probably not necessary    
 
-    def reset_pyvisa_connections(self):	
-        self.r0.rigol.close()
-        self.r0 = RigolDP832A(self.rm, self.json_data, 0)
-        self.r0.setup_fan()
-        self.r0.setup_heater_supply()
-        self.r0.setup_heater_switch()
-            
-        self.r1.rigol.close()
-        self.r1 = RigolDP832A(self.rm, self.json_data, 1)
-        self.r1.setup_hvpullup()
-        self.r1.setup_hvpullup2()
-        self.r1.setup_fanread()  
-            	
-        self.k.keysight.close()
-        self.k = Keysight970A(self.rm, self.json_data)    
+    #Only the instruments that stopped answering get a new session, and they keep their settings, outputs and relays
+    #An instrument is only set up from scratch if reconnecting it doesn't work
+    #The fan or heater test can be using these instruments at the same time, so every one of them is held for the whole reconnect
+    #That way no other step sends anything in the middle of it or picks up an instrument that's halfway through being rebuilt
+    def reset_pyvisa_connections(self):
+        with contextlib.ExitStack() as held:
+            for instrument in (self.r0, self.r1, self.k):
+                held.enter_context(instrument.lock)
+            instruments = self.reconnects.recover({"rigol0": self.r0, "rigol1": self.r1, "keysight": self.k}, self.rebuild_instrument)
+            self.r0 = instruments["rigol0"]
+            self.r1 = instruments["rigol1"]
+            self.k = instruments["keysight"]
+        #The connection broke partway through something, so the CAEN settings we remember can't be trusted either
+        self.c.caen.invalidate_settings()
+
+    #Makes one instrument and sets it up, at the start of the test or when reconnecting it didn't work
+    def start_instrument(self, name):
+        if (name == "caen"):
+            return CAENR8033DM_WRAPPER(self.json_data)
+        elif (name == "keysight"):
+            return Keysight970A(self.rm, self.json_data)
+        #Since there are 2 Rigols, set them up here so they know what channels they have
+        #And if the test sequence calls the wrong one, it'll throw an error
+        elif (name == "rigol0"):
+            r0 = RigolDP832A(self.rm, self.json_data, 0)
+            r0.setup_fan()
+            r0.setup_heater_supply()
+            r0.setup_heater_switch()
+            return r0
+        elif (name == "rigol1"):
+            r1 = RigolDP832A(self.rm, self.json_data, 1)
+            r1.setup_hvpullup()
+            r1.setup_hvpullup2()
+            r1.setup_fanread()
+            return r1
+        sys.exit(f"{self.prefix} --> Don't know how to start instrument {name}")
+
+    #Lets go of an instrument that started when another one didn't. The CAEN's watchdog and I/O threads are stopped and it's disconnected
+    def stop_instrument(self, name, instrument):
+        if (name == "caen"):
+            instrument.close()
+        elif (name == "keysight"):
+            instrument.keysight.close()
+        else:
+            instrument.rigol.close()
+
+    #The full setup of one VISA instrument, after closing whatever's left of its old session
+    #The *RST turns everything off, but another test step can still be using the instrument, so it gets back the outputs that were on,
+    #and the DAQ its measurement setup and relays. It keeps the old lock, which reset_pyvisa_connections is holding
+    def rebuild_instrument(self, name):
+        old = {"rigol0": self.r0, "rigol1": self.r1, "keysight": self.k}[name]
+        try:
+            self.reconnects.session(old).close()
+        except Exception:
+            pass
+        new = self.start_instrument(name)
+        new.lock = old.lock
+        if (name == "keysight"):
+            if (old.state is not None):
+                getattr(new, f"initialize_{old.state}")()
+            if (old.relay_hv_state is not None):
+                new.set_relay(old.relay_hv_state, old.relay_term_state)
+            #A step that was already waiting to use the old object talks over the new session instead of the closed one
+            old.keysight = new.keysight
+        else:
+            for ch, onoff in old.outputs.items():
+                if (onoff == "ON"):
+                    new.power("ON", ch)
+            old.rigol = new.rigol
+        return new
     	
-    def record_hv_data(self, name, short_time=False):
-        data = []
-        cycle_start_time = time.time()
-        time_string = datetime.fromtimestamp(cycle_start_time)
-        prev_measurement = cycle_start_time - 1
+    #Waits for a measurement to settle instead of sleeping for a fixed time, see settling.py. max_wait is what the fixed sleep used to be
+    #Every wait is kept under its name in settle_times in the results JSON, so the limits can be tuned from real runs
+    def settle(self, name, measure, tolerance, max_wait, min_wait=0):
+        #Every reading checks whether another test step failed, so a long wait doesn't hold up the shutdown
+        def checked_measure():
+            self.scheduler.check()
+            return measure()
+        result = wait_until_stable(checked_measure, tolerance, self.json_data.get('settle_window', 3), min_wait, max_wait,
+                                   self.json_data.get('settle_poll_interval', 0.5))
+        self.settle_times.setdefault(name, []).append(result)
+        print(f"{self.prefix} --> {name} {'settled' if result['settled'] else 'did not settle'} after {result['time']:.1f} of up to {max_wait} seconds")
+        return result
+
+    #The HV is settled once VMon of every channel in the step stops moving
+    def settle_hv(self, name, chs, max_wait):
+        return self.settle(name, lambda: self.c.snapshot(chs, ("VMon",)).VMon, self.json_data.get('hv_settle_tolerance', 0.5), max_wait)
+
+    #With hv_adaptive_capture on, the capture for a step can stop once every channel's exponential has settled, see hv_adaptive.py
+    #The current is watched for the phases that turn on, and the voltage for the ones that turn off, the same as the fits
+    #A step with a measure phase always gets its full length. Its VMon and IMon are read at the end for the resistance, and the
+    #leakage current is still creeping down long after the fit has settled, so stopping early would change the open termination result
+    def adaptive_capture(self, step, chs_map):
+        if (self.json_data.get('hv_adaptive_capture', "False") != "True"):
+            return None
+        if (any(phase.measure for phase in step)):
+            return None
+        columns = []
+        for phase in step:
+            for ch in chs_map[phase.polarity].values():
+                columns.append(f"ch{ch}_I" if phase.action == "on" else f"ch{ch}_V")
+        return AdaptiveCapture(columns, self.json_data.get('hv_adaptive_time_constants', 5), self.json_data.get('hv_adaptive_tau_tolerance', 0.05),
+                               self.json_data.get('hv_adaptive_min_seconds', 30), self.json_data.get('hv_adaptive_check_seconds', 5),
+                               self.json_data.get('hv_fit_fast_path_residual'))
+
+    #Records the HV data for a phase and returns the name of the file it was written to
+    #The name can pick up a compression ending, so the fit and plot code should use what's returned
+    def record_hv_data(self, name, short_time=False, adaptive=None):
         if short_time:
             minutes_wait = self.json_data['hv_minutes_duration_short']
         else:
             minutes_wait = self.json_data['hv_minutes_duration_long']
-        print(f"{self.prefix} --> Collecting data for {name} for {minutes_wait} minutes starting at {time_string}...")
-        while (time.time() - cycle_start_time < (minutes_wait * 60)):
-            if (time.time() > prev_measurement + self.json_data['hv_seconds_interval']):
-                #print(f"{self.prefix} --> Measurement taken at {time.time()}")
-                prev_measurement = prev_measurement + self.json_data['hv_seconds_interval']
-                datum = [datetime.now()]
-                for i in range(16):
-                    datum.append(self.c.get_voltage(i))
-                    datum.append(self.c.get_current(i))
-                #datum.append(self.c.get_voltage(list(range(16))))
-                data.append(datum)
-        with open(os.path.join(self.results_path, name), 'w') as fp:
-            csv_writer = csv.writer(fp, delimiter=',')
-            csv_writer.writerows(data)
-        #input("ok?")
-
-    def hv_curve_fit(self, name, ch, on = True, term = False):
-        ch_datetime = []
-        ch_voltage = []
-        ch_current = []
-        with open(os.path.join(self.results_path, name), 'r', newline='') as csvfile:
-            spamreader = csv.reader(csvfile, delimiter=',')
-            for row in spamreader:
-                ch_datetime.append(datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S.%f'))
-                ch_voltage.append(float(row[1 + (ch*2)]))
-                if (term):
-                    ch_current.append(float(row[2 + (ch*2)])/1000)
-                else:
-                    ch_current.append(float(row[2 + (ch*2)]))
-        if (on):
-            data = ch_current
+        #Snapshot mode reads VMon and IMon for all 16 channels with one call each, so every channel in a row is from the same moment
+        #The old mode does 32 separate reads per row and is kept in case the batched read misbehaves on some firmware
+        snapshot = (self.json_data.get('hv_snapshot_acquisition', "True") == "True")
+        all_chs = list(range(16))
+        #The sampler sleeps between deadlines instead of spinning on the clock, so the plotting and VISA threads get the CPU
+        sampler = PeriodicSampler(self.json_data['hv_seconds_interval'], minutes_wait * 60)
+        #Rows go to disk in chunks as they come in, so a crash or a channel error partway through doesn't lose the phase
+        writer = CaptureWriter(os.path.join(self.results_path, name),
+                               self.json_data.get('hv_capture_compression', "none"),
+                               self.json_data.get('hv_capture_chunk_rows', 10))
+        #The first column is the seconds since the start on the monotonic clock, kept to the microsecond
+        #So faster sampling rates give distinct times all the way through the fit and the plots, and nothing has to parse dates
+        binary_writer = None
+        if (self.json_data.get('hv_capture_binary', "False") == "True"):
+            binary_writer = BinaryCaptureWriter(os.path.join(self.results_path, name), capture_columns(all_chs), datetime.now(),
+                                                self.json_data.get('hv_capture_chunk_rows', 10))
+        if (adaptive):
+            adaptive.start(capture_columns(all_chs))
+            print(f"{self.prefix} --> Collecting data for {name} for up to {minutes_wait} minutes, until it settles, starting at {datetime.now()}...")
         else:
-            data = ch_voltage
-        #print(f"For channel {ch}, grabbed column {2 + (ch*2)} and got this data")
-        #print(ch_current)
-        first_time = ch_datetime[0]
-        ch_timedelta = [i-first_time for i in ch_datetime]
-        ch_time = [datetime(2024, 1, 1, 0, i.seconds//60%60, i.seconds%60, 0) for i in ch_timedelta]
-
-        def exp_fit(x, a, b, c):
-            y = a*np.exp(-b*x) + c
-            return y
-
-        first_timestamp = ch_time[0].timestamp()
-        time_seconds = [dt.timestamp() - first_timestamp for dt in ch_time]
+            print(f"{self.prefix} --> Collecting data for {name} for {minutes_wait} minutes starting at {datetime.now()}...")
         try:
-            fit = curve_fit(exp_fit, time_seconds, data)
-        except RuntimeError:
-            fit = [[0,0]]
-        #The result is an array like
-        #[
-        #    "[-0.0003239   0.04760632  0.29665177]",
-
-        #    "[[ 4.03901010e-10 -5.76474012e-08 -2.84934772e-12],
-        #    [-5.76474012e-08  2.38199865e-05 -7.01897955e-09],
-        #    [-2.84934772e-12 -7.01897955e-09  1.26525944e-11]]"
-        #]
-        #The first array is the convergant results for the 3 parameters a, b, and c
-        #The second array is the confidence levels for each based on the covarience with the other variables
-        #Low numbers less than one mean that the confidence is high
-        #https://docs.scipy.org/doc/scipy/reference/generated/scipy.optimize.curve_fit.html
-        return fit
+            for elapsed in sampler.samples():
+                if (snapshot):
+                    datum = [None] * (1 + (2 * len(all_chs)))
+                    datum[0] = elapsed
+                    self.c.get_monitor_row(all_chs, datum)
+                else:
+                    datum = [elapsed]
+                    for i in all_chs:
+                        datum.append(self.c.get_voltage(i))
+                        datum.append(self.c.get_current(i))
+                writer.write_row(datum)
+                if (binary_writer):
+                    binary_writer.write_row(datum)
+                #If the watchdog turned the HV off, stop the capture here instead of recording a dead channel for the rest of it
+                self.c.check_watchdog()
+                #Same if the fan or heater test failed alongside this one
+                self.scheduler.check()
+                if (adaptive and adaptive.update(datum)):
+                    break
+        finally:
+            writer.close()
+            if (binary_writer):
+                binary_writer.close()
+            stats = sampler.stats()
+            stats['rows_written'] = writer.rows_written
+            #The first column of the capture is seconds from this moment, for putting the data back on the calendar
+            stats['start_time'] = sampler.timestamp(0)
+            if (adaptive):
+                stats['adaptive'] = adaptive.stats()
+            self.datastore['hv_captures'][name] = stats
+        print(f"{self.prefix} --> Took {stats['samples']} samples for {name}, {stats['missed_deadlines']} missed deadlines and {stats['overruns']} overruns")
+        return os.path.basename(writer.path)
+
+    def hv_curve_fit(self, name, ch, on = True, term = False):
+        return self.hv_curve_fit_all(name, [ch], on, term)[ch]
+
+    #Fits a*e^(-tau*t)+c to every given channel of a capture in one go, the channels are all fit together by the engine in hv_fit
+    #The charging current is fit when the HV is turned on, and the relaxing voltage when it's turned off
+    #Each result looks like what curve_fit gives back, plus a dictionary saying whether that channel converged
+    #[
+    #    [-0.0003239   0.04760632  0.29665177],
+
+    #    [[ 4.03901010e-10 -5.76474012e-08 -2.84934772e-12],
+    #    [-5.76474012e-08  2.38199865e-05 -7.01897955e-09],
+    #    [-2.84934772e-12 -7.01897955e-09  1.26525944e-11]],
+
+    #    {"converged": True, "iterations": 5, "method": "levenberg_marquardt"}
+    #]
+    #The first array is the convergant results for the 3 parameters a, b, and c
+    #The second array is the confidence levels for each based on the covarience with the other variables
+    #Low numbers less than one mean that the confidence is high
+    #A channel that doesn't converge still gets its best estimate rather than 0, so it isn't failed for the wrong reason
+    def hv_curve_fit_all(self, name, chs, on = True, term = False):
+        capture = self.capture_cache.get(os.path.join(self.results_path, name))
+        return fit_capture(capture, name, chs, on, term, self.json_data.get('hv_fit_fast_path_residual'))
 
     def make_hv_plots(self): #not used
         ch0_pos_open_fit = self.datastore['hv_ch0']['pos_open_fit'][0][1]
@@ -835,68 +836,20 @@ class LDOmeasure:
         #self.make_plot(f"{self.test_name}_ch0_neg_10k_off", "-2kV to 0, 10k termination", False, True, 8)
 
     def make_plot(self, filename, name, ch, fit=None, axes = None):
-        ch1_time, ch1_voltage, ch1_current = self.get_ch_data(os.path.join(self.results_path, filename), ch)
-        # self.make_plot(f"{self.test_name}_ch0_neg_10k_off", "-2kV to 0, 10k termination", False, False)
-
-        fig = plt.figure(figsize=(16, 12), dpi=80)
-        ax = fig.add_subplot(1,1,1)
-
-        ax.plot(ch1_time, ch1_current, label="Ch Current")
-        self.format_plot(ax)
-                                           
-                                   
-                                             
-
-        ax2 = ax.twinx()
-                                                                  
-                      
-        ax2.plot(ch1_time, ch1_voltage, label="Ch Voltage", color="red")
-                                                                                                             
-
-        fig.suptitle((name), fontsize=36)
-                                
-
-        ax.set_xlabel("Time (Minutes:Seconds)", fontsize=24)
-        ax.set_ylabel("Current (uA)", fontsize=24)
-
-        # ax.set_xlim([0,150])
-        if (axes):
-            ax2.set_ylim([axes[0],axes[1]])
-        ax2.set_ylabel("Voltage (V)", fontsize=24)
-        self.format_plot(ax2)
-
-        if fit:
-            textstr = r'$\tau=%.4f$' % (fit)
-            props = dict(boxstyle='round', facecolor='wheat', alpha=0.5)
-            ax.text(0.75, 0.75, textstr, transform=ax.transAxes, fontsize=24,
-            verticalalignment='top', bbox=props)
-
-        fig.legend(loc='lower left', prop={'size': 20}, ncol=2)
-        stem = Path(filename).stem
-        fig.savefig(os.path.join(self.results_path, f"{stem}_ch{ch}.png"))
-        plt.close(fig)
+        self.plots.submit(plot_capture, self.results_path, filename, name, ch, fit, axes)
 
     def get_ch_data(self, data_file, ch):
-        ch1_datetime = []
-        ch1_voltage = []
-        ch1_current = []
-        with open(data_file, 'r', newline='') as csvfile:
-            spamreader = csv.reader(csvfile, delimiter=',')
-            for row in spamreader:
-                ch1_datetime.append(datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S.%f'))
-                ch1_voltage.append(float(row[1+(ch*2)]))
-                ch1_current.append(float(row[2+(ch*2)]))
-
-        first_time = ch1_datetime[0]
-        ch1_timedelta = [i-first_time for i in ch1_datetime]
-        ch1_time = [datetime(2024, 1, 1, 0, i.seconds//60%60, i.seconds%60, 0) for i in ch1_timedelta]
-        return ch1_time, ch1_voltage, ch1_current
+        return self.get_ch_columns(data_file, ch)
+
+    #Gets the time since the start, voltage and current of one channel from a capture as NumPy arrays
+    #The capture is parsed once and kept in the capture cache, so every channel's fit and plot after the first just takes views of it
+    #If the capture was also written in the binary format, the columns come straight from the memory mapped file
+    #Time is float seconds from the first sample, it isn't rounded or wrapped so sub-second samples keep their own place on the axis
+    def get_ch_columns(self, data_file, ch):
+        return capture_ch_columns(self.capture_cache.get(data_file), ch)
 
     def format_plot(self, ax):
-        tick_size = 18
-        ax.xaxis.set_major_formatter(mdates.DateFormatter('%M:%S'))
-        ax.tick_params(axis='x', labelsize=tick_size, colors='black')  # Set tick size and color here
-        ax.tick_params(axis='y', labelsize=tick_size, colors='black')  # Set tick size and color here
+        format_plot(ax)
 
     def beep_sequence(self):
         #First beep is always longer for some reason
@@ -919,12 +872,14 @@ class LDOmeasure:
         self.k.beep()
 
 if __name__ == "__main__":
+    #--refresh-metadata anywhere on the command line reads all the CAEN parameter properties from the crate again instead of the cache
+    refresh_metadata = pop_refresh_metadata(sys.argv)
     if len(sys.argv) < 2:
         sys.exit(f"Error: You need to supply a config file for this test as the argument! You had {len(sys.argv)-1} arguments!")
     if (len(sys.argv) == 2):
-        LDOmeasure(sys.argv[1])
+        LDOmeasure(sys.argv[1], refresh_metadata=refresh_metadata)
     elif (len(sys.argv) == 3):
-        LDOmeasure(sys.argv[1], sys.argv[2])
+        LDOmeasure(sys.argv[1], sys.argv[2], refresh_metadata=refresh_metadata)
     else:
         sys.exit(f"Error: You need to supply a config file and optional test name for this program, 2 arguments max. You supplied {sys.argv}, which is {len(sys.argv)-1} arguments")
         
@@ -0,0 +1,85 @@
+import time
+import numpy as np
+from hv_fit import fit_exponentials
+
+#Lets an HV capture stop as soon as every channel being tested has finished its exponential, instead of always running for the
+#full duration. The capture's rows are handed over as they're taken, and every few seconds the columns that matter are fit
+#with the same engine the analysis uses, which gives a running tau, its confidence interval and the residual for every channel
+#A channel has settled once the capture covers enough time constants and the 95% confidence interval of its tau is
+#within the tolerance of tau. The capture stops once every channel has, but never before min_duration.
+#The capture's own duration is still the hard maximum, so a channel that never settles just gets the usual capture
+#Use it like:
+#   adaptive = AdaptiveCapture(["ch0_I", "ch1_I"], 5, 0.05, 30, 5)
+#   adaptive.start(capture_columns(all_chs))
+#   for elapsed in sampler.samples():
+#       ...
+#       if (adaptive.update(row)):
+#           break
+#   adaptive.stats()        #The last estimate and when it stopped, meant to go into the datastore JSON
+class AdaptiveCapture:
+    def __init__(self, columns, time_constants=5, tolerance=0.05, min_duration=30, check_interval=5, fast_path_residual=0.02):
+        self.prefix = "HV Adaptive Capture"         #Prefix for log messages
+        self.columns = columns                      #Names of the capture columns that have to settle, like ch0_I
+        self.time_constants = time_constants        #How many time constants the capture has to cover
+        self.tolerance = tolerance                  #Largest allowed half width of tau's 95% confidence interval, as a fraction of tau
+        self.min_duration = min_duration            #Seconds to capture no matter what
+        self.check_interval = check_interval        #Seconds between fits
+        self.fast_path_residual = fast_path_residual
+        self.indexes = None
+        self.times = []
+        self.rows = []
+        self.last_check = None
+        self.checks = 0
+        self.check_time = 0                         #Seconds spent fitting, it all comes out of the time between samples
+        self.estimate = None                        #Latest tau, confidence interval, residual and whether it settled, per column
+        self.stopped = None                         #Seconds into the capture that it was stopped, None if it ran the whole time
+
+    #header is the capture's column names, the first column is the time
+    def start(self, header):
+        self.indexes = [header.index(column) for column in self.columns]
+
+    #Takes one row of the capture. Returns True once every column has settled and the capture can stop
+    def update(self, row):
+        elapsed = row[0]
+        self.times.append(elapsed)
+        self.rows.append([row[index] for index in self.indexes])
+        if (elapsed < self.min_duration or len(self.times) < 10):
+            return False
+        if (self.last_check is not None and elapsed - self.last_check < self.check_interval):
+            return False
+        self.last_check = elapsed
+        if (not self.check()):
+            return False
+        self.stopped = elapsed
+        taus = ", ".join(f"{column} {1 / estimate['tau']:.1f}s" for column, estimate in self.estimate.items())
+        print(f"{self.prefix} --> Every channel settled after {elapsed:.1f} seconds, time constants {taus}")
+        return True
+
+    def check(self):
+        start = time.monotonic()
+        t = np.array(self.times)
+        y = np.array(self.rows, dtype=float)
+        results = fit_exponentials(t, y, fast_path_residual=self.fast_path_residual)
+        tau = results['tau']
+        interval = 1.96 * np.sqrt(np.abs(results['cov'][:, 1, 1]))
+        t = t - t[0]
+        fitted = (results['a'][None, :] * np.exp(-tau[None, :] * t[:, None])) + results['c'][None, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            residual = np.sqrt(((y - fitted) ** 2).mean(axis=0)) / np.abs(results['a'])
+        #tau is the rate, so the number of time constants covered is the rate times the length of the capture
+        settled = results['converged'] & (tau * t[-1] >= self.time_constants) & (interval <= self.tolerance * tau)
+        self.estimate = {}
+        for num,column in enumerate(self.columns):
+            self.estimate[column] = {"tau": float(tau[num]), "tau_interval": float(interval[num]),
+                                     "residual": float(residual[num]), "settled": bool(settled[num])}
+        self.checks += 1
+        self.check_time += time.monotonic() - start
+        return bool(settled.all())
+
+    def stats(self):
+        results = {}
+        results['stopped'] = self.stopped
+        results['checks'] = self.checks
+        results['check_time'] = self.check_time
+        results['estimate'] = self.estimate
+        return results
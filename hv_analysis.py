@@ -0,0 +1,135 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, Future
+import numpy as np
+from hv_capture import CaptureCache
+from hv_fit import fit_exponentials, channel_fit
+from hv_plotting import PlotService, plot_capture, capture_ch_columns
+
+#Fits a*e^(-tau*t)+c to every given channel of a capture in one go, the channels are all fit together by the engine in hv_fit
+#The charging current is fit when the HV is turned on, and the relaxing voltage when it's turned off
+#Returns the fits keyed by channel, each one shaped like what curve_fit gives back plus a dictionary saying how the fit went
+def fit_capture(capture, name, chs, on=True, term=False, fast_path_residual=None):
+    columns = []
+    for ch in chs:
+        time_seconds, ch_voltage, ch_current = capture_ch_columns(capture, ch)
+        if (on):
+            if (term):
+                columns.append(ch_current/1000)
+            else:
+                columns.append(ch_current)
+        else:
+            columns.append(ch_voltage)
+    #Clean curves are taken straight from the closed form estimate, only the noisy ones go through the full fit
+    results = fit_exponentials(time_seconds, np.stack(columns, axis=1), fast_path_residual=fast_path_residual)
+    fits = {}
+    for num,ch in enumerate(chs):
+        fits[ch] = channel_fit(results, num)
+        if (fits[ch][2]['method'] == "no_data"):
+            print(f"HV Analysis --> {name} has no data to fit for channel {ch}")
+        elif (not fits[ch][2]['converged']):
+            print(f"HV Analysis --> Fit for channel {ch} of {name} did not converge, tau estimate is {fits[ch][0][1]}")
+    return fits
+
+#Everything that happens to a capture once it's finished: fit every channel, then draw each channel's plot with its tau
+#plots is a list of (title, channel, voltage axis limits or None), it's left empty when the plot service is drawing them instead
+#Runs in a worker process, so it only takes plain values and reads the capture itself. The capture is parsed once for the fit and all the plots
+def analyse_phase(results_path, name, chs, on, term, fast_path_residual, plots, cache=None):
+    start = time.monotonic()
+    if (cache is None):
+        cache = CaptureCache()
+    path = os.path.join(results_path, name)
+    fits = fit_capture(cache.get(path), name, chs, on, term, fast_path_residual)
+    for title, ch, axes in plots:
+        plot_capture(results_path, name, title, ch, fits[ch][0][1], axes, cache)
+    return fits, time.monotonic() - start
+
+#Runs the fits and plots for each finished HV phase in worker processes, while the main process carries on ramping and
+#recording the next phase. Live voltage and current readings stay in the main process, only the finished capture files are handed over
+#Use it like:
+#   analysis = AnalysisPipeline(results_path, 2, 0.02)
+#   analysis.submit(csv_name, "pos_open_on_fit", {0: 0, 1: 1}, True, False, plots)
+#   ...
+#   analysis.join(hv_results)   #Every fit is in hv_results after this
+#   analysis.shutdown()
+#With 0 workers the phase is fit straight away in the main process, the same as before there was a pipeline
+#The plots go to the plot service, except when the workers are fitting and the plots are wanted straight away.
+#Then the worker that did the fit draws them too, since it already has the capture loaded
+class AnalysisPipeline:
+    def __init__(self, results_path, workers=2, fast_path_residual=None, cache=None, plots=None):
+        self.prefix = "HV Analysis"
+        self.results_path = results_path
+        self.fast_path_residual = fast_path_residual
+        self.cache = cache if cache is not None else CaptureCache()
+        self.plots = plots if plots is not None else PlotService("immediate", 0, self.cache)
+        self.pending = []           #(future, capture name, hv_results key, {test channel: hardware channel}, plots still to queue) in the order submitted
+        self.analysis_time = 0      #Seconds the workers spent on fits and plots
+        self.wait_time = 0          #Seconds the main process spent waiting for them in join
+        if (workers > 0):
+            #Spawned rather than forked, so the workers don't inherit the CAEN handle or the VISA sockets
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        else:
+            self.executor = None
+
+    #Hands a finished capture over for fitting and plotting. chs maps the test channel number to the CAEN channel in the capture
+    def submit(self, name, key, chs, on, term, plots):
+        hw_chs = list(chs.values())
+        if (self.executor):
+            if (self.plots.mode == "immediate"):
+                future = self.executor.submit(analyse_phase, self.results_path, name, hw_chs, on, term, self.fast_path_residual, plots)
+                plots = []
+            else:
+                future = self.executor.submit(analyse_phase, self.results_path, name, hw_chs, on, term, self.fast_path_residual, [])
+        else:
+            #A fit that fails is raised right here, inside the phase, so the HV test's retry and shutoff handling sees it straight away
+            #Plots drawn straight away share the capture the fit loaded, it's only let go once they've been queued
+            try:
+                result = analyse_phase(self.results_path, name, hw_chs, on, term, self.fast_path_residual, [], self.cache)
+                future = Future()
+                future.set_result(result)
+                self.pending.append((future, name, key, chs, []))
+                self.queue_plots(name, result[0], plots)
+            finally:
+                self.cache.evict(os.path.join(self.results_path, name))
+            return future
+        self.pending.append((future, name, key, chs, plots))
+        return future
+
+    #Where the next submit goes, so a test attempt that fails partway through can throw away what it submitted with discard()
+    def mark(self):
+        return len(self.pending)
+
+    #Forgets every phase submitted since mark. Their results aren't waited for, so a failed attempt's fit can't hold up
+    #or fail the join for the attempt that replaces it
+    def discard(self, mark):
+        for future, name, key, chs, plots in self.pending[mark:]:
+            future.cancel()
+            print(f"{self.prefix} --> Dropping {key} for {name}, the attempt it was from failed")
+        del self.pending[mark:]
+
+    def queue_plots(self, name, fits, plots):
+        for title, ch, axes in plots:
+            self.plots.submit(plot_capture, self.results_path, name, title, ch, fits[ch][0][1], axes)
+
+    #Waits for every submitted phase and puts its fits into hv_results, in the order they were submitted
+    #So if a test was run again, the fits from the later run are the ones left in hv_results
+    #An exception from a worker is raised here. With 0 workers it was already raised by submit
+    def join(self, hv_results):
+        start = time.monotonic()
+        while self.pending:
+            future, name, key, chs, plots = self.pending.pop(0)
+            fits, seconds = future.result()
+            self.analysis_time += seconds
+            self.queue_plots(name, fits, plots)
+            for i, ch in chs.items():
+                hv_results[i][key] = fits[ch]
+        waited = time.monotonic() - start
+        self.wait_time += waited
+        print(f"{self.prefix} --> Analysis finished, waited {waited:.1f} seconds for the last of it")
+
+    def shutdown(self):
+        if (self.executor):
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+        self.pending = []
@@ -0,0 +1,289 @@
+import os
+import io
+import sys
+import csv
+import gzip
+import zlib
+import json
+from pathlib import Path
+from datetime import datetime
+import numpy as np
+
+#zstd is optional, gzip is in the standard library and always works
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#File endings for each compression choice in the config file
+compression_suffixes = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+#Binary captures are little endian float64, whatever machine they were written on
+binary_dtype = "<f8"
+
+#Writes HV capture rows to disk while they're being collected, instead of holding the whole capture in memory until the end
+#Rows are buffered and written out every chunk_rows rows. Every chunk is flushed all the way through the compressor,
+#so anything already written can be read back even if the test dies halfway through the capture
+class CaptureWriter:
+    def __init__(self, path, compression="none", chunk_rows=10):
+        self.prefix = "HV Capture Writer"
+        if (compression not in compression_suffixes):
+            sys.exit(f"{self.prefix} --> Compression {compression} is not one of {list(compression_suffixes)}")
+        if (compression == "zstd" and zstandard is None):
+            sys.exit(f"{self.prefix} --> zstd compression needs the zstandard package, install it or set the compression to gzip or none")
+        self.path = path + compression_suffixes[compression]
+        self.compression = compression
+        self.chunk_rows = max(1, chunk_rows)
+        self.rows_written = 0
+        self.pending_rows = 0
+
+        #Rows are formatted into this text buffer and then pushed to the file as one chunk
+        self.buffer = io.StringIO()
+        self.csv_writer = csv.writer(self.buffer, delimiter=',')
+
+        self.raw_file = open(self.path, 'wb')
+        if (self.compression == "gzip"):
+            self.stream = gzip.GzipFile(fileobj=self.raw_file, mode='wb')
+        elif (self.compression == "zstd"):
+            self.stream = zstandard.ZstdCompressor().stream_writer(self.raw_file, closefd=False)
+        else:
+            self.stream = self.raw_file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def write_row(self, row):
+        self.csv_writer.writerow(row)
+        self.pending_rows += 1
+        if (self.pending_rows >= self.chunk_rows):
+            self.flush()
+
+    #Pushes the buffered rows through the compressor and onto the disk
+    #gzip needs a sync flush and zstd needs a block flush, otherwise the compressor keeps the tail of the data to itself
+    def flush(self):
+        if (self.pending_rows == 0):
+            return
+        self.stream.write(self.buffer.getvalue().encode('utf-8'))
+        self.buffer.seek(0)
+        self.buffer.truncate(0)
+        if (self.compression == "gzip"):
+            self.stream.flush(zlib.Z_SYNC_FLUSH)
+        elif (self.compression == "zstd"):
+            self.stream.flush(zstandard.FLUSH_BLOCK)
+        self.raw_file.flush()
+        self.rows_written += self.pending_rows
+        self.pending_rows = 0
+
+    def close(self):
+        if (self.raw_file.closed):
+            return
+        self.flush()
+        if (self.stream is not self.raw_file):
+            self.stream.close()
+        self.raw_file.close()
+
+#Writes the same capture as a flat binary file of float64 rows, with a small JSON header next to it describing the columns
+#The first column is the seconds since the start of the capture, then voltage and current for each channel like the CSV
+#There's no row count in the header, the number of rows comes from the file size, so it can be read while it's still growing
+class BinaryCaptureWriter:
+    def __init__(self, path, columns, start_time, chunk_rows=10):
+        self.prefix = "HV Binary Capture Writer"
+        self.data_path, self.header_path = binary_capture_paths(path)
+        self.columns = columns
+        self.rows_written = 0
+        self.pending_rows = 0
+        #Rows are copied into this preallocated block and written out as one piece when it fills up
+        self.chunk = np.empty((max(1, chunk_rows), len(columns)), dtype=binary_dtype)
+
+        header = {}
+        header['format'] = "hv_capture_f64"
+        header['version'] = 1
+        header['dtype'] = binary_dtype
+        header['columns'] = columns
+        header['start_time'] = str(start_time)
+        with open(self.header_path, 'w', encoding='utf-8') as f:
+            json.dump(header, f, ensure_ascii=False, indent=4)
+        self.raw_file = open(self.data_path, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def write_row(self, row):
+        self.chunk[self.pending_rows] = row
+        self.pending_rows += 1
+        if (self.pending_rows >= len(self.chunk)):
+            self.flush()
+
+    def flush(self):
+        if (self.pending_rows == 0):
+            return
+        self.raw_file.write(self.chunk[:self.pending_rows].tobytes())
+        self.raw_file.flush()
+        self.rows_written += self.pending_rows
+        self.pending_rows = 0
+
+    def close(self):
+        if (self.raw_file.closed):
+            return
+        self.flush()
+        self.raw_file.close()
+
+#Opens a binary capture as a read only memory map, nothing is read from disk until a column is used
+#The channel functions return views into the map, so getting one channel's column doesn't copy the whole capture
+class BinaryCapture:
+    def __init__(self, path):
+        self.data_path, self.header_path = binary_capture_paths(path)
+        with open(self.header_path, 'r', encoding='utf-8') as f:
+            self.header = json.load(f)
+        self.columns = self.header['columns']
+        dtype = np.dtype(self.header['dtype'])
+        #A half written row at the end is left out, same as for the CSV
+        num_rows = os.path.getsize(self.data_path) // (dtype.itemsize * len(self.columns))
+        if (num_rows > 0):
+            self.data = np.memmap(self.data_path, dtype=dtype, mode='r', shape=(num_rows, len(self.columns)))
+        else:
+            self.data = np.empty((0, len(self.columns)), dtype=dtype)
+
+    def column(self, name):
+        return self.data[:, self.columns.index(name)]
+
+    def time(self):
+        return self.column("time")
+
+    def voltage(self, ch):
+        return self.column(f"ch{ch}_V")
+
+    def current(self, ch):
+        return self.column(f"ch{ch}_I")
+
+#Reads a CSV capture into one float array laid out the same as the binary format, so both can be used the same way
+#The first column is the seconds since the start of the capture, straight from the monotonic clock
+#Older captures have a date and time there instead, those are turned into seconds since the first row
+#This is the only place the CSV gets parsed
+class CSVCapture:
+    def __init__(self, path):
+        rows = read_capture_rows(path)
+        num_chs = (len(rows[0]) - 1) // 2 if rows else 0
+        self.columns = capture_columns(range(num_chs))
+        self.data = np.empty((len(rows), len(self.columns)), dtype=binary_dtype)
+        for num,row in enumerate(rows):
+            self.data[num, 1:] = row[1:]
+        if (rows and not is_seconds(rows[0][0])):
+            first_time = datetime.fromisoformat(rows[0][0])
+            for num,row in enumerate(rows):
+                self.data[num, 0] = (datetime.fromisoformat(row[0]) - first_time).total_seconds()
+        else:
+            for num,row in enumerate(rows):
+                self.data[num, 0] = row[0]
+
+    def column(self, name):
+        return self.data[:, self.columns.index(name)]
+
+    def time(self):
+        return self.column("time")
+
+    def voltage(self, ch):
+        return self.column(f"ch{ch}_V")
+
+    def current(self, ch):
+        return self.column(f"ch{ch}_I")
+
+#Holds every capture that's been opened so the fits and plots for all the channels of a phase share one parse of the file
+#The binary copy is used when there is one, otherwise the CSV. If the file has grown since it was loaded, it's loaded again
+#Call evict once a phase is done with its capture, so the test doesn't hold on to every phase's data
+#With a limit, only that many captures are held and the one used longest ago is dropped to make room, for callers that never know when a phase is done
+class CaptureCache:
+    def __init__(self, limit=None):
+        self.captures = {}      #Keyed by the capture path that was asked for, holds (size and modified time, capture), least recently used first
+        self.limit = limit
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        if (has_binary_capture(path)):
+            source = binary_capture_paths(path)[0]
+            loader = BinaryCapture
+        else:
+            source = find_capture(path)
+            loader = CSVCapture
+        stat = os.stat(source)
+        signature = (source, stat.st_size, stat.st_mtime_ns)
+        entry = self.captures.pop(path, None)
+        if (entry is None or entry[0] != signature):
+            entry = (signature, loader(source))
+        self.captures[path] = entry
+        while (self.limit is not None and len(self.captures) > self.limit):
+            self.captures.pop(next(iter(self.captures)))
+        return entry[1]
+
+    def evict(self, path):
+        self.captures.pop(os.path.abspath(path), None)
+
+    def clear(self):
+        self.captures.clear()
+
+def is_seconds(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+#Column names for a capture of the given channels, in the same order as the CSV rows
+def capture_columns(chs):
+    columns = ["time"]
+    for ch in chs:
+        columns.append(f"ch{ch}_V")
+        columns.append(f"ch{ch}_I")
+    return columns
+
+#The binary data and header files that go with a capture, based on the CSV name
+#The header is JSON but doesn't get a .json ending, so it can't be mistaken for the test results JSON in the same folder
+def binary_capture_paths(path):
+    base = os.path.join(os.path.dirname(path), capture_stem(path))
+    return base + ".f64", base + ".f64.hdr"
+
+def has_binary_capture(path):
+    data_path, header_path = binary_capture_paths(path)
+    return os.path.isfile(data_path) and os.path.isfile(header_path)
+
+#Gives back the decoded text of a capture file, whether it's plain, gzip or zstd
+#This works on a file that's still being written. Whatever can be decompressed is returned,
+#and a half written row at the end is dropped so the readers only see complete rows
+def read_capture_text(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if (path.endswith(compression_suffixes["gzip"])):
+        #wbits of 31 means a gzip header, and a decompress object doesn't complain about a missing end of stream
+        data = zlib.decompressobj(wbits=31).decompress(data)
+    elif (path.endswith(compression_suffixes["zstd"])):
+        if (zstandard is None):
+            sys.exit(f"HV Capture Reader --> {path} is zstd compressed, it needs the zstandard package to be read")
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    text = data.decode('utf-8', errors='replace')
+    if (not text.endswith("\n")):
+        text = text[:text.rfind("\n") + 1]
+    return text
+
+def read_capture_rows(path):
+    return [row for row in csv.reader(io.StringIO(read_capture_text(path), newline=''), delimiter=',') if row]
+
+#Captures may have been written with or without compression, this finds which one is on disk
+def find_capture(path):
+    for suffix in compression_suffixes.values():
+        if (os.path.isfile(path + suffix)):
+            return path + suffix
+    return path
+
+#Name of the capture without the .csv and any compression ending, for naming the plots that go with it
+def capture_stem(path):
+    name = Path(path).name
+    for suffix in compression_suffixes.values():
+        if (suffix and name.endswith(suffix)):
+            name = name[:-len(suffix)]
+    return Path(name).stem
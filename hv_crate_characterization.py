@@ -9,13 +9,17 @@ import openpyxl
 from datetime import datetime
 from rigol_dp832a import RigolDP832A
 from caen_r8033dm_wrapper import CAENR8033DM_WRAPPER
+from caen_r8033dm import pop_refresh_metadata
+from periodic_sampler import PeriodicSampler
 
 class LDOmeasure:
-    def __init__(self, config_file, name = None):
+    def __init__(self, config_file, name = None, refresh_metadata = False):
         self.prefix = "DUNE HV Crate Tester"
         print(f"{self.prefix} --> Welcome to the DUNE HV crate production testing script")
         with open(config_file, "r") as jsonfile:
             self.json_data = json.load(jsonfile)
+        if (refresh_metadata):
+            self.json_data['caenR8033DM_refresh_metadata'] = "True"
         self.rm = pyvisa.ResourceManager('@py')
 
         #Initialize all instruments first so that you don't waste time with input if something is not connected
@@ -42,8 +46,25 @@ class LDOmeasure:
         self.datastore['minutes_duration'] = self.minutes_duration
         self.start_time = datetime.now()
         self.datastore['start_time'] = self.start_time
+        self.datastore['captures'] = {}
         self.sequence()
 
+    #Records the voltage and current of the first num_chs channels every seconds_interval for minutes_duration
+    #The sampler sleeps until each deadline rather than spinning, and its timing stats go in the datastore
+    def record_data(self, name, num_chs):
+        data = []
+        sampler = PeriodicSampler(self.seconds_interval, self.minutes_duration * 60)
+        for elapsed in sampler.samples():
+            print(f"measure at {elapsed:.3f}s")
+            #All the channels come from one snapshot, a batched read of VMon and then IMon
+            datum = self.c.get_monitor_row(list(range(num_chs)))
+            datum[0] = sampler.timestamp(elapsed)
+            data.append(datum)
+        with open(name, 'w') as fp:
+            csv_writer = csv.writer(fp, delimiter=',')
+            csv_writer.writerows(data)
+        self.datastore['captures'][name] = sampler.stats()
+
     def sequence(self):
         data = []
         self.r1.power("ON", "hvpullup")
@@ -55,9 +76,8 @@ class LDOmeasure:
             print(f"{i}V")
             self.c.set_HV_value(0, i)
             time.sleep(60)
-            datum = [i]
-            datum.append(self.c.get_voltage(0))
-            datum.append(self.c.get_current(0))
+            datum = self.c.get_monitor_row([0])
+            datum[0] = i
             data.append(datum)
         with open(f"{self.test_name}_scan_voltage.csv", 'w') as fp:
             csv_writer = csv.writer(fp, delimiter=',')
@@ -68,21 +88,7 @@ class LDOmeasure:
         self.r1.power("OFF", "hvpullup2")
         input("Ready for all channel connected and positive test?")
         self.c.turn_on([0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15])
-        data = []
-        cycle_start_time = time.time()
-        prev_measurement = cycle_start_time - 1
-        while (time.time() - cycle_start_time < (self.minutes_duration * 60)):
-            if (time.time() > prev_measurement + self.seconds_interval):
-                print(f"measure at {time.time()}")
-                prev_measurement = prev_measurement + self.seconds_interval
-                datum = [datetime.now()]
-                for i in range(16):
-                    datum.append(self.c.get_voltage(i))
-                    datum.append(self.c.get_current(i))
-                data.append(datum)
-        with open(f"{self.test_name}_multiple_plugged_positive.csv", 'w') as fp:
-            csv_writer = csv.writer(fp, delimiter=',')
-            csv_writer.writerows(data)
+        self.record_data(f"{self.test_name}_multiple_plugged_positive.csv", 16)
 
         self.c.turn_off([0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15])
 
@@ -107,70 +113,30 @@ class LDOmeasure:
 
         input("Ready for all channel connected test?")
         self.c.turn_on(0)
-        data = []
-        cycle_start_time = time.time()
-        prev_measurement = cycle_start_time - 1
-        while (time.time() - cycle_start_time < (self.minutes_duration * 60)):
-            if (time.time() > prev_measurement + self.seconds_interval):
-                print(f"measure at {time.time()}")
-                prev_measurement = prev_measurement + self.seconds_interval
-                datum = [datetime.now()]
-                for i in range(8):
-                    datum.append(self.c.get_voltage(i))
-                    datum.append(self.c.get_current(i))
-                data.append(datum)
-        with open(f"{self.test_name}unplugged_all.csv", 'w') as fp:
-            csv_writer = csv.writer(fp, delimiter=',')
-            csv_writer.writerows(data)
+        self.record_data(f"{self.test_name}unplugged_all.csv", 8)
 
         self.c.turn_off(0)
 
         input("Ready for all channel connected and positive test?")
         self.c.turn_on([0, 1, 2, 3, 4, 5, 6, 7])
-        data = []
-        cycle_start_time = time.time()
-        prev_measurement = cycle_start_time - 1
-        while (time.time() - cycle_start_time < (self.minutes_duration * 60)):
-            if (time.time() > prev_measurement + self.seconds_interval):
-                print(f"measure at {time.time()}")
-                prev_measurement = prev_measurement + self.seconds_interval
-                datum = [datetime.now()]
-                for i in range(16):
-                    datum.append(self.c.get_voltage(i))
-                    datum.append(self.c.get_current(i))
-                data.append(datum)
-        with open(f"{self.test_name}_multiple_plugged_positive.csv", 'w') as fp:
-            csv_writer = csv.writer(fp, delimiter=',')
-            csv_writer.writerows(data)
+        self.record_data(f"{self.test_name}_multiple_plugged_positive.csv", 16)
 
         self.c.turn_off([0, 1, 2, 3, 4, 5, 6, 7])
 
         input("Ready for all channel connected and negative test?")
         self.c.turn_on([0, 8,9,10,11,12,13,14,15])
-        data = []
-        cycle_start_time = time.time()
-        prev_measurement = cycle_start_time - 1
-        while (time.time() - cycle_start_time < (self.minutes_duration * 60)):
-            if (time.time() > prev_measurement + self.seconds_interval):
-                print(f"measure at {time.time()}")
-                prev_measurement = prev_measurement + self.seconds_interval
-                datum = [datetime.now()]
-                for i in range(16):
-                    datum.append(self.c.get_voltage(i))
-                    datum.append(self.c.get_current(i))
-                data.append(datum)
-        with open(f"{self.test_name}_multiple_plugged_negative.csv", 'w') as fp:
-            csv_writer = csv.writer(fp, delimiter=',')
-            csv_writer.writerows(data)
+        self.record_data(f"{self.test_name}_multiple_plugged_negative.csv", 16)
 
         self.c.turn_off([0, 8,9,10,11,12,13,14,15])
 
 if __name__ == "__main__":
+    #--refresh-metadata anywhere on the command line reads all the CAEN parameter properties from the crate again instead of the cache
+    refresh_metadata = pop_refresh_metadata(sys.argv)
     if len(sys.argv) < 2:
         sys.exit(f"Error: You need to supply a config file for this test as the argument! You had {len(sys.argv)-1} arguments!")
     if (len(sys.argv) == 2):
-        LDOmeasure(sys.argv[1])
+        LDOmeasure(sys.argv[1], refresh_metadata=refresh_metadata)
     elif (len(sys.argv) == 3):
-        LDOmeasure(sys.argv[1], sys.argv[2])
+        LDOmeasure(sys.argv[1], sys.argv[2], refresh_metadata=refresh_metadata)
     else:
         sys.exit(f"Error: You need to supply a config file and optional test name for this program, 2 arguments max. You supplied {sys.argv}, which is {len(sys.argv)-1} arguments")
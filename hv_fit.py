@@ -0,0 +1,225 @@
+import numpy as np
+
+#Fits a*e^(-tau*t)+c to every channel of a capture at the same time
+#This is Levenberg-Marquardt written out with NumPy so that all the channels step together, instead of calling curve_fit once per channel
+#The Jacobian is worked out by hand since the model is so simple:
+#   df/da = e^(-tau*t)
+#   df/dtau = -a*t*e^(-tau*t)
+#   df/dc = 1
+#Like the rest of the test, tau here is the rate in the exponent (1/seconds), not the time constant
+
+#Gives a starting guess for every channel, so the fit starts somewhere near the answer instead of at 1,1,1
+#The offset comes from the end of the capture and the amplitude from the start. Then tau comes from a straight line fit
+#of log(|y - c|) against time, using only the points that are still well clear of the offset so the noise doesn't dominate
+def initial_guess(t, y, tau_bounds):
+    num = len(t)
+    tail = max(3, num // 10)
+    c = y[-tail:].mean(axis=0)
+    a = y[:3].mean(axis=0) - c
+
+    distance = (y - c) * np.sign(a)
+    weights = (distance > 0.05 * np.abs(a)).astype(float)
+    log_distance = np.log(np.where(weights > 0, distance, 1.0))
+    x = t[:, None]
+    sum_w = weights.sum(axis=0)
+    sum_x = (weights * x).sum(axis=0)
+    sum_y = (weights * log_distance).sum(axis=0)
+    sum_xx = (weights * x * x).sum(axis=0)
+    sum_xy = (weights * x * log_distance).sum(axis=0)
+    denominator = (sum_w * sum_xx) - (sum_x * sum_x)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = ((sum_w * sum_xy) - (sum_x * sum_y)) / denominator
+    tau = -slope
+    #Not enough points or the curve isn't decaying, so guess that the capture covers a few time constants
+    fallback = 3.0 / max(t[-1] - t[0], np.finfo(float).eps)
+    tau = np.where((sum_w >= 3) & np.isfinite(tau) & (tau > 0), tau, fallback)
+    tau = np.clip(tau, tau_bounds[0], tau_bounds[1])
+    return np.stack([a, tau, c], axis=1)
+
+def model(t, params):
+    decay = np.exp(-params[:, 1][None, :] * t[:, None])
+    return params[:, 0][None, :] * decay + params[:, 2][None, :], decay
+
+#Closed form estimate of a, tau and c for every channel, no iterating
+#For y = a*e^(-tau*t)+c, integrating dy/dt = -tau*(y - c) gives y(t) = -tau*integral(y) + tau*c*t + y(0)
+#So a straight least squares fit of y against the running integral of y, t and a constant gives tau directly
+#The constant soaks up the noise on the first point, which would otherwise bias everything
+#With tau known, a and c come from one more straight line fit of y against e^(-tau*t)
+#Returns the parameters, and how big the leftover residual is compared to the amplitude so the caller can tell if it's good enough
+#The residual is only taken over the first few time constants, where the curve is still moving. Over the whole capture a long flat
+#tail would water it down, and a fast decay the estimate got wrong would still look good enough
+def closed_form_estimate(t, y, tau_bounds, time_constants=5):
+    dt = np.diff(t)[:, None]
+    integral = np.zeros_like(y)
+    integral[1:] = np.cumsum((y[1:] + y[:-1]) * 0.5 * dt, axis=0)
+    x = t[:, None]
+    design = np.stack([integral, np.broadcast_to(x, y.shape), np.ones_like(y)], axis=2)
+    normal = np.einsum('nmi,nmj->mij', design, design)
+    projection = np.einsum('nmi,nm->mi', design, y)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        coefficients = np.einsum('mij,mj->mi', np.linalg.pinv(normal), projection)
+        tau = -coefficients[:, 0]
+        valid = np.isfinite(tau) & (tau >= tau_bounds[0]) & (tau <= tau_bounds[1])
+        tau = np.clip(np.where(np.isfinite(tau), tau, tau_bounds[0]), tau_bounds[0], tau_bounds[1])
+
+        decay = np.exp(-tau[None, :] * x)
+        num = len(t)
+        sum_e = decay.sum(axis=0)
+        sum_ee = (decay * decay).sum(axis=0)
+        sum_y = y.sum(axis=0)
+        sum_ey = (decay * y).sum(axis=0)
+        determinant = (num * sum_ee) - (sum_e * sum_e)
+        a = ((num * sum_ey) - (sum_e * sum_y)) / determinant
+        c = (sum_y - (a * sum_e)) / num
+        valid &= np.isfinite(a) & np.isfinite(c)
+
+        residual = y - ((a[None, :] * decay) + c[None, :])
+        transient = x <= (time_constants / tau[None, :])
+        transient[:4] = True
+        relative_residual = np.sqrt(((residual ** 2) * transient).sum(axis=0) / transient.sum(axis=0)) / np.abs(a)
+    relative_residual = np.where(valid & np.isfinite(relative_residual), relative_residual, np.inf)
+    return np.stack([a, tau, c], axis=1), relative_residual
+
+#The iterative part of the fit, only run for the channels that are passed in. Each step is the Levenberg-Marquardt step
+#for every channel at once, and a channel drops out once it has converged or can't be improved any more
+def levenberg_marquardt(t, y, params, tau_bounds, max_iterations, xtol, ftol):
+    num_chs = y.shape[1]
+    fitted, decay = model(t, params)
+    ssr = ((y - fitted) ** 2).sum(axis=0)
+    damping = np.full(num_chs, 1e-3)
+    converged = np.zeros(num_chs, dtype=bool)
+    iterations = np.zeros(num_chs, dtype=int)
+    active = np.ones(num_chs, dtype=bool)
+    identity = np.eye(3)
+
+    for _ in range(max_iterations):
+        if (not active.any()):
+            break
+        jacobian = np.stack([decay, -params[:, 0][None, :] * t[:, None] * decay, np.ones_like(decay)], axis=2)
+        residual = y - fitted
+        jtj = np.einsum('nmi,nmj->mij', jacobian, jacobian)
+        jtr = np.einsum('nmi,nm->mi', jacobian, residual)
+        diagonal = np.diagonal(jtj, axis1=1, axis2=2)
+        system = jtj + (damping[:, None, None] * diagonal[:, :, None] * identity) + (1e-12 * identity)
+        try:
+            step = np.linalg.solve(system, jtr[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            step = np.einsum('mij,mj->mi', np.linalg.pinv(system), jtr)
+
+        trial = params + step
+        trial[:, 1] = np.clip(trial[:, 1], tau_bounds[0], tau_bounds[1])
+        trial_fitted, trial_decay = model(t, trial)
+        trial_ssr = ((y - trial_fitted) ** 2).sum(axis=0)
+
+        better = active & np.isfinite(trial_ssr) & (trial_ssr <= ssr)
+        small_step = np.all(np.abs(trial - params) <= xtol * (np.abs(params) + xtol), axis=1)
+        small_change = np.abs(ssr - trial_ssr) <= ftol * np.maximum(ssr, np.finfo(float).tiny)
+
+        params = np.where(better[:, None], trial, params)
+        fitted = np.where(better[None, :], trial_fitted, fitted)
+        decay = np.where(better[None, :], trial_decay, decay)
+        ssr = np.where(better, trial_ssr, ssr)
+        damping = np.where(better, damping / 10, damping * 10)
+        iterations += active
+
+        #Converged once the steps get tiny, even if the last tiny step didn't help, or once the fit stops improving
+        done = active & (small_step | (better & small_change))
+        #A perfect fit has nothing left to improve
+        done |= active & (ssr <= np.finfo(float).tiny)
+        #Damping this large means no step in any direction helps, so the channel is as good as it gets
+        stuck = active & (damping > 1e12)
+        converged |= done
+        active &= ~(done | stuck)
+
+    return params, converged, iterations
+
+#t is the time in seconds, shape (samples,), y is one column per channel, shape (samples, channels)
+#If fast_path_residual is given and above 0, the closed form estimate is tried first, and only the channels whose residual
+#is bigger than that fraction of their amplitude go on to the full iterative fit
+#The closed form integrates with the trapezoid rule, which gets tau wrong once a sample is a big part of a time constant,
+#so a channel whose tau times the sample spacing is over fast_path_max_tau_step always gets the full fit too
+#Returns a dictionary of arrays, one entry per channel:
+#   a, tau, c       the fit parameters
+#   cov             the 3x3 covariance of (a, tau, c)
+#   converged       whether the fit actually settled, a failed channel still gets its best estimate
+#   iterations      how many steps the channel took, 0 for the closed form
+#   method          "closed_form" or "levenberg_marquardt", whichever gave the answer, or "no_data" for an empty capture
+def fit_exponentials(t, y, tau_bounds=None, max_iterations=200, xtol=1e-8, ftol=1e-10, fast_path_residual=None, fast_path_max_tau_step=0.1):
+    t = np.asarray(t, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if (y.ndim == 1):
+        y = y[:, None]
+    num_samples, num_chs = y.shape
+    if (num_samples == 0):
+        return no_data_results(num_chs)
+    t = t - t[0]
+    duration = max(t[-1], np.finfo(float).eps)
+    step = np.median(np.diff(t)) if num_samples > 1 else duration
+    if (tau_bounds is None):
+        #Anything from a time constant a hundred times longer than the capture, to one much shorter than a sample
+        tau_bounds = (0.01 / duration, 10.0 / max(step, np.finfo(float).eps))
+
+    #Every channel is scaled to about 1 so the amplitude and offset are on the same footing as tau
+    center = y.mean(axis=0)
+    scale = np.abs(y - center).max(axis=0)
+    scale = np.where(scale > 0, scale, 1.0)
+    y_scaled = (y - center) / scale
+
+    params = initial_guess(t, y_scaled, tau_bounds)
+    converged = np.zeros(num_chs, dtype=bool)
+    iterations = np.zeros(num_chs, dtype=int)
+    fast = np.zeros(num_chs, dtype=bool)
+    if (fast_path_residual and num_samples > 3):
+        estimate, relative_residual = closed_form_estimate(t, y_scaled, tau_bounds)
+        fast = (relative_residual <= fast_path_residual) & (estimate[:, 1] * step <= fast_path_max_tau_step)
+        #The closed form answer is still a better place to start the full fit than the rough guess, when it worked at all
+        usable = np.isfinite(relative_residual)
+        params = np.where(usable[:, None], estimate, params)
+        converged |= fast
+
+    slow = ~fast
+    if (slow.any()):
+        slow_params, slow_converged, slow_iterations = levenberg_marquardt(t, y_scaled[:, slow], params[slow], tau_bounds, max_iterations, xtol, ftol)
+        params[slow] = slow_params
+        converged[slow] = slow_converged
+        iterations[slow] = slow_iterations
+
+    #Covariance the same way curve_fit works it out, the inverse of J^T J scaled by the residual variance
+    fitted, decay = model(t, params)
+    ssr = ((y_scaled - fitted) ** 2).sum(axis=0)
+    jacobian = np.stack([decay, -params[:, 0][None, :] * t[:, None] * decay, np.ones_like(decay)], axis=2)
+    jtj = np.einsum('nmi,nmj->mij', jacobian, jacobian)
+    variance = ssr / max(num_samples - 3, 1)
+    cov = np.linalg.pinv(jtj) * variance[:, None, None]
+
+    #Undo the scaling. The offset moves by the center, the amplitude and offset scale with the channel, tau doesn't change
+    units = np.stack([scale, np.ones(num_chs), scale], axis=1)
+    cov = cov * units[:, :, None] * units[:, None, :]
+    results = {}
+    results['a'] = params[:, 0] * scale
+    results['tau'] = params[:, 1]
+    results['c'] = (params[:, 2] * scale) + center
+    results['cov'] = cov
+    results['converged'] = converged & np.all(np.isfinite(params), axis=1)
+    results['iterations'] = iterations
+    results['method'] = np.where(fast, "closed_form", "levenberg_marquardt")
+    return results
+
+#What a capture with no rows fits to, nothing is known about any channel so every parameter is NaN and none of them converged
+def no_data_results(num_chs):
+    results = {}
+    results['a'] = np.full(num_chs, np.nan)
+    results['tau'] = np.full(num_chs, np.nan)
+    results['c'] = np.full(num_chs, np.nan)
+    results['cov'] = np.full((num_chs, 3, 3), np.nan)
+    results['converged'] = np.zeros(num_chs, dtype=bool)
+    results['iterations'] = np.zeros(num_chs, dtype=int)
+    results['method'] = np.full(num_chs, "no_data")
+    return results
+
+#Turns one channel of the results into the same shape curve_fit gives back, [[a, tau, c], covariance],
+#with a dictionary after it saying how the fit went. So fit[0][1] is still tau everywhere it's used
+def channel_fit(results, num):
+    popt = np.array([results['a'][num], results['tau'][num], results['c'][num]])
+    info = {"converged": bool(results['converged'][num]), "iterations": int(results['iterations'][num]), "method": str(results['method'][num])}
+    return [popt, results['cov'][num], info]
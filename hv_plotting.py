@@ -0,0 +1,205 @@
+import os
+import sys
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, Future
+import matplotlib.ticker as mticker
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from hv_capture import CaptureCache, capture_stem
+
+#Plotting for the HV captures, kept out of the test class so worker processes can draw plots without the instruments
+#Figures are drawn straight onto the Agg canvas and never go through pyplot, so it doesn't matter what backend the
+#main process picked, nothing ever tries to open a window, and there's no global figure list to clean up
+
+#Ways the plots can be made, from the "hv_plot_mode" config setting
+#   immediate   each plot is drawn by the plot workers as soon as it's asked for
+#   deferred    plots are queued up and all drawn at the end of the test, so the workers don't compete with the acquisition
+#   off         no plots at all, the fits and results are still saved
+plot_modes = ["immediate", "deferred", "off"]
+
+#Tick labels for a time axis in seconds, shown as minutes:seconds. Sub-second ticks get a decimal place
+def format_minutes_seconds(seconds, pos=None):
+    minutes, secs = divmod(seconds, 60)
+    if (float(secs).is_integer()):
+        return f"{int(minutes):02d}:{int(secs):02d}"
+    return f"{int(minutes):02d}:{secs:04.1f}"
+
+def format_plot(ax):
+    tick_size = 18
+    ax.xaxis.set_major_formatter(mticker.FuncFormatter(format_minutes_seconds))
+    ax.tick_params(axis='x', labelsize=tick_size, colors='black')  # Set tick size and color here
+    ax.tick_params(axis='y', labelsize=tick_size, colors='black')  # Set tick size and color here
+
+#Gets the time since the start, voltage and current of one channel from a capture as NumPy arrays
+#Time is float seconds from the first sample, it isn't rounded or wrapped so sub-second samples keep their own place on the axis
+#A capture that stopped before its first row gives back empty arrays
+def capture_ch_columns(capture, ch):
+    times = capture.time()
+    if (len(times) == 0):
+        #An empty CSV doesn't even say which channels it had, so there's nothing to look up
+        return times, times.copy(), times.copy()
+    return times - times[0], capture.voltage(ch), capture.current(ch)
+
+#Figures that have been set up in this process, keyed by the kind of plot
+#Making a 16x12 figure with its axes, labels, tick formatting and legend is most of the cost of a plot,
+#so each process builds one of each kind the first time it's needed and only swaps the data in after that
+templates = {}
+
+def channel_template():
+    if ("channel" not in templates):
+        fig = Figure(figsize=(16, 12), dpi=80)
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(1,1,1)
+        current_line, = ax.plot([], [], label="Ch Current")
+        format_plot(ax)
+        ax2 = ax.twinx()
+        voltage_line, = ax2.plot([], [], label="Ch Voltage", color="red")
+        ax.set_xlabel("Time (Minutes:Seconds)", fontsize=24)
+        ax.set_ylabel("Current (uA)", fontsize=24)
+        ax2.set_ylabel("Voltage (V)", fontsize=24)
+        format_plot(ax2)
+        props = dict(boxstyle='round', facecolor='wheat', alpha=0.5)
+        tau_text = ax.text(0.75, 0.75, "", transform=ax.transAxes, fontsize=24,
+                           verticalalignment='top', bbox=props)
+        fig.legend(loc='lower left', prop={'size': 20}, ncol=2)
+        title = fig.suptitle("", fontsize=36)
+        templates["channel"] = (fig, ax, ax2, current_line, voltage_line, tau_text, title)
+    return templates["channel"]
+
+def multiple_template():
+    if ("multiple" not in templates):
+        fig = Figure(figsize=(16, 12), dpi=80)
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(1,1,1)
+        format_plot(ax)
+        ax.set_xlabel("Time (Minutes:Seconds)", fontsize=24)
+        ax.yaxis.set_major_formatter('{x:9<5.3f}')
+        title = fig.suptitle("", fontsize=36)
+        templates["multiple"] = (fig, ax, title)
+    return templates["multiple"]
+
+#Draws the current and voltage of one channel of a capture with the fitted tau on it, and saves it next to the capture
+def plot_capture(results_path, filename, name, ch, fit=None, axes=None, cache=None):
+    if (cache is None):
+        cache = CaptureCache()
+    capture = cache.get(os.path.join(results_path, filename))
+    ch1_time, ch1_voltage, ch1_current = capture_ch_columns(capture, ch)
+    fig, ax, ax2, current_line, voltage_line, tau_text, title = channel_template()
+
+    current_line.set_data(ch1_time, ch1_current)
+    voltage_line.set_data(ch1_time, ch1_voltage)
+    title.set_text(name)
+    for axis in [ax, ax2]:
+        axis.relim()
+        axis.autoscale_view()
+    # ax.set_xlim([0,150])
+    if (axes):
+        ax2.set_ylim([axes[0],axes[1]])
+    else:
+        ax2.set_autoscaley_on(True)
+        ax2.autoscale_view(scalex=False)
+
+    if fit:
+        tau_text.set_text(r'$\tau=%.4f$' % (fit))
+        tau_text.set_visible(True)
+    else:
+        tau_text.set_visible(False)
+
+    stem = capture_stem(filename)
+    fig.savefig(os.path.join(results_path, f"{stem}_ch{ch}.png"))
+
+#Draws one channel from several captures on the same axes, for comparing runs. vc is "c" for current or "v" for voltage
+def plot_multiple(filenames, ch_num, vc, title_text, loc, output_file, cache=None):
+    if (cache is None):
+        cache = CaptureCache()
+    fig, ax, title = multiple_template()
+    for line in list(ax.lines):
+        line.remove()
+    if (ax.get_legend()):
+        ax.get_legend().remove()
+
+    for num,filename in enumerate(filenames):
+        time_seconds, volt, curr = capture_ch_columns(cache.get(filename), ch_num)
+        if (vc == "c"):
+            ax.plot(time_seconds, curr, label=f"Ch{num} Current")
+        elif (vc == "v"):
+            ax.plot(time_seconds, volt, label=f"Ch{num} Voltage")
+    if (vc == "c"):
+        ax.set_ylabel("Current (uA)", fontsize=24)
+    elif (vc == "v"):
+        ax.set_ylabel("Voltage (V)", fontsize=24)
+    ax.relim()
+    ax.autoscale_view()
+    title.set_text(title_text)
+    ax.legend(loc=loc, prop={'size': 20}, ncol=2)
+    fig.savefig(output_file)
+
+#Captures read by the plots in this process. The plots for one phase are queued together and all read the same capture,
+#so it's only parsed once per worker. A worker never hears when a phase is done, so only the last capture it used is kept
+worker_cache = CaptureCache(limit=1)
+
+def timed_plot(function, args, cache=None):
+    start = time.monotonic()
+    function(*args, cache=cache if cache is not None else worker_cache)
+    return time.monotonic() - start
+
+#Draws the plots in a pool of worker processes so the acquisition never waits on matplotlib
+#Each worker keeps its own figure templates, so after its first plot of each kind it only swaps data in
+#Use it like:
+#   plots = PlotService("immediate", 2)
+#   plots.submit(plot_capture, results_path, csv_name, "Ch 0 from 0 to 1500V", 0, tau, [1495, 1505])
+#   plots.finish()      #Draws anything deferred and waits for every plot, errors come out here
+#   plots.shutdown()
+#With 0 workers the plots are drawn in this process, immediately or at finish depending on the mode
+class PlotService:
+    def __init__(self, mode="immediate", workers=2, cache=None):
+        self.prefix = "HV Plot Service"
+        if (mode not in plot_modes):
+            sys.exit(f"{self.prefix} --> Plot mode {mode} is not one of {plot_modes}")
+        self.mode = mode
+        self.cache = cache          #Only used for plots drawn in this process, the workers have their own
+        self.deferred = []          #(function, args) waiting for finish in deferred mode
+        self.pending = []           #Futures for plots that have been handed to the workers
+        self.plot_time = 0          #Seconds spent drawing, added up over all the workers
+        self.plots_made = 0
+        if (workers > 0 and mode != "off"):
+            #Spawned rather than forked, so the workers don't inherit the CAEN handle or the VISA sockets
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        else:
+            self.executor = None
+
+    def submit(self, function, *args):
+        if (self.mode == "off"):
+            return
+        if (self.mode == "deferred"):
+            self.deferred.append((function, args))
+            return
+        self.start(function, args)
+
+    def start(self, function, args):
+        if (self.executor):
+            self.pending.append(self.executor.submit(timed_plot, function, args))
+        else:
+            future = Future()
+            try:
+                future.set_result(timed_plot(function, args, self.cache))
+            except Exception as e:
+                future.set_exception(e)
+            self.pending.append(future)
+
+    #Starts anything that was deferred and waits for every plot to be saved
+    def finish(self):
+        for function, args in self.deferred:
+            self.start(function, args)
+        self.deferred = []
+        while self.pending:
+            self.plot_time += self.pending.pop(0).result()
+            self.plots_made += 1
+
+    def shutdown(self):
+        if (self.executor):
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+        self.deferred = []
+        self.pending = []
@@ -0,0 +1,91 @@
+import sys
+
+#The HV test is a list of phases, each one turning the tested channels of one polarity on or off with one kind of termination,
+#recording the capture and handing it to the analysis. The list comes from hv_phases in the config, so phases can be reordered,
+#dropped or run together without touching the code. config.json ships with the usual eight phases
+#Each phase is a dictionary with:
+#   polarity        "pos" or "neg", which side of each tested channel is ramped
+#   termination     "open" or "term" for the 10k termination resistor
+#   action          "on" to ramp up to the voltage, "off" to ramp back down to 0
+#   voltage         Volts, or the name of the config value to use
+#   relay_hv        "tested" to close the HV relay of every tested channel, "none" to open them all. Leave both relays out to not touch them
+#   relay_term      Same for the termination relays
+#   wait            Most seconds to wait for VMon to settle after the ramp and before the capture, or the name of the config value. 0 if left out
+#   duration        "long" or "short", which of hv_minutes_duration_long and hv_minutes_duration_short the capture runs for
+#   measure         "True" to read every channel's VMon and IMon once the capture is done, for the resistance
+#   analysis        "fit" to fit and plot the capture, or "none". "fit" if left out
+#   pause           Most seconds to wait for VMon to settle once everything for the phase is done, or the name of the config value. 0 if left out
+#   together        Phases next to each other with the same label here are ramped and captured as one, they need the same relays
+#The results of a phase go under its name, which is polarity_termination_action, like pos_open_on_fit
+
+#How each termination is described in the log and in the plot titles
+termination_log = {"open": "open termination", "term": "10k termination"}
+termination_plot = {"open": "open termination", "term": "termination resistor"}
+
+prefix = "HV Sequence"
+
+#One phase from the table, with the config names already looked up
+class HVPhase:
+    def __init__(self, phase, json_data):
+        self.polarity = choice(phase, "polarity", ["pos", "neg"])
+        self.termination = choice(phase, "termination", ["open", "term"])
+        self.action = choice(phase, "action", ["on", "off"])
+        self.name = f"{self.polarity}_{self.termination}_{self.action}"
+        self.voltage = config_value(phase.get("voltage"), json_data, self.name)
+        if (self.voltage is None):
+            sys.exit(f"{prefix} --> Phase {self.name} needs a voltage")
+        self.relay_hv = phase.get("relay_hv")
+        self.relay_term = phase.get("relay_term")
+        if ((self.relay_hv is None) != (self.relay_term is None)):
+            sys.exit(f"{prefix} --> Phase {self.name} needs both relay_hv and relay_term, or neither")
+        if (self.relay_hv is not None):
+            choice(phase, "relay_hv", ["tested", "none"])
+            choice(phase, "relay_term", ["tested", "none"])
+        self.wait = config_value(phase.get("wait", 0), json_data, self.name)
+        self.short_time = (choice(phase, "duration", ["long", "short"]) == "short")
+        self.measure = (phase.get("measure", "False") == "True")
+        self.analysis = choice(phase, "analysis", ["fit", "none"], "fit")
+        self.pause = config_value(phase.get("pause", 0), json_data, self.name)
+        self.together = phase.get("together")
+
+    #The two relay bytes for set_relay, or None to leave them as they are. Each tested channel has its own bit
+    def relays(self, chs_to_test):
+        if (self.relay_hv is None):
+            return None
+        mask = 0
+        for i in chs_to_test:
+            mask = mask | (1 << i)
+        return (mask if self.relay_hv == "tested" else 0, mask if self.relay_term == "tested" else 0)
+
+    def sign(self):
+        return "-" if self.polarity == "neg" else ""
+
+def choice(phase, key, options, default=None):
+    value = phase.get(key, default)
+    if (value not in options):
+        sys.exit(f"{prefix} --> {key} in HV phase {phase} is {value}, it needs to be one of {options}")
+    return value
+
+def config_value(value, json_data, name):
+    if (isinstance(value, str)):
+        if (value not in json_data):
+            sys.exit(f"{prefix} --> Phase {name} uses config value {value}, which isn't in the config")
+        return json_data[value]
+    return value
+
+#Reads the phase table and splits it into the steps that are run one after another, each a list of phases done together
+def load_phases(json_data):
+    if ('hv_phases' not in json_data):
+        sys.exit(f"{prefix} --> The config has no hv_phases, the HV test doesn't know what to run")
+    phases = [HVPhase(phase, json_data) for phase in json_data['hv_phases']]
+    names = [phase.name for phase in phases]
+    for name in names:
+        if (names.count(name) > 1):
+            sys.exit(f"{prefix} --> Phase {name} is in hv_phases more than once, its results would overwrite each other")
+    steps = []
+    for phase in phases:
+        if (steps and phase.together is not None and steps[-1][0].together == phase.together):
+            steps[-1].append(phase)
+        else:
+            steps.append([phase])
+    return steps
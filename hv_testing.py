@@ -1,19 +1,23 @@
 from caen_r8033dm_wrapper import CAENR8033DM_WRAPPER
+from caen_r8033dm import pop_refresh_metadata
 import sys
 import json
 
 class HVTest():
-    def __init__(self, config_file):
+    def __init__(self, config_file, refresh_metadata = False):
         with open(config_file, "r") as jsonfile:
             self.json_data = json.load(jsonfile)
+        if (refresh_metadata):
+            self.json_data['caenR8033DM_refresh_metadata'] = "True"
 
         #Initialize all instruments first so that you don't waste time with input if something is not connected
         self.c = CAENR8033DM_WRAPPER(self.json_data)
 
         v = 2000
+        self.c.apply_configuration({"VSet": dict.fromkeys(range(1,16), v)})
         for i in range(1,16):
-            self.c.set_HV_value(i, v)
             print(f"HV Test --> Turning Channel {i} HV from 0 to {v}V with open termination")
 
 if __name__ == "__main__":
-    HVTest(sys.argv[1])
+    refresh_metadata = pop_refresh_metadata(sys.argv)
+    HVTest(sys.argv[1], refresh_metadata)
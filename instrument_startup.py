@@ -0,0 +1,75 @@
+import sys
+import time
+import threading
+
+#Starts every instrument at the same time, each in its own thread, instead of waiting for one to finish before the next
+#steps maps each instrument's name to a function that makes and sets it up. Each instrument gets its own time limit,
+#counted from the start, and anything still going after that is reported as not answering
+#If anything fails, every failure is listed in one error and the test stops, rather than finding them one at a time
+#Before stopping, close(name, instrument) is called for every instrument that did start, so nothing is left connected or running
+#An instrument that finishes starting after its time limit closes itself the same way
+#The threads are daemon threads, there's no way to stop a thread partway through a VISA call, but a stuck one doesn't keep the test from exiting
+#Returns the instruments and how many seconds each took, both keyed by name
+def bring_up(steps, timeouts=None, default_timeout=30, close=None):
+    prefix = "Instrument Startup"
+    timeouts = timeouts if timeouts is not None else {}
+    start = time.monotonic()
+    lock = threading.Lock()         #Guards results and given_up between the startup threads and this one
+    results = {}                    #Name to (instrument, seconds) or the exception it raised
+    given_up = []                   #Not empty once the startup has failed, any instrument that comes up after that closes itself
+
+    def start_one(name, function):
+        try:
+            result = timed(function)
+        except BaseException as e:
+            result = e
+        with lock:
+            results[name] = result
+            late = bool(given_up) and not isinstance(result, BaseException)
+        if (late):
+            shut(name, result[0])
+
+    def shut(name, instrument):
+        if (close is None):
+            return
+        try:
+            close(name, instrument)
+            print(f"{prefix} --> Closed {name}")
+        except BaseException as e:
+            print(f"{prefix} --> Couldn't close {name}: {e!r}")
+
+    threads = {}
+    for name, function in steps.items():
+        threads[name] = threading.Thread(target=start_one, args=(name, function), name=f"startup {name}", daemon=True)
+        threads[name].start()
+    for name, thread in threads.items():
+        thread.join(max(0, start + timeouts.get(name, default_timeout) - time.monotonic()))
+    instruments = {}
+    times = {}
+    errors = []
+    with lock:
+        for name in steps:
+            result = results.get(name)
+            if (result is None):
+                errors.append(f"{name} didn't finish starting within {timeouts.get(name, default_timeout)} seconds")
+            elif (isinstance(result, BaseException)):
+                errors.append(f"{name} failed to start: {result!r}")
+            else:
+                instruments[name], times[name] = result
+        if (errors):
+            given_up.append(True)
+    total = time.monotonic() - start
+    for name, seconds in times.items():
+        print(f"{prefix} --> {name} ready in {seconds:.2f} seconds")
+    print(f"{prefix} --> All instruments took {total:.2f} seconds together, {sum(times.values()):.2f} seconds one after another")
+    if (errors):
+        for name, instrument in instruments.items():
+            shut(name, instrument)
+        sys.exit(f"{prefix} --> {len(errors)} of {len(steps)} instrument(s) didn't start:\n" + "\n".join(errors))
+    times['total'] = total
+    return instruments, times
+
+def timed(function):
+    start = time.monotonic()
+    instrument = function()
+    return instrument, time.monotonic() - start
@@ -4,13 +4,17 @@ Created on Wed Sept 25 10:51:58 2023
 
 @author: Eraguzin
 """
-import sys, time
+import sys, time, re
+import threading
 
 class Keysight970A:
     def __init__(self, rm, json_data):
         self.prefix = "Keysight DAQ 970A"
         self.json_data = json_data
-        self.keysight = rm.open_resource(self.json_data['keysight970a'])
+        self.address = self.json_data['keysight970a']
+        self.keysight = rm.open_resource(self.address)
+        #The fan and heater tests can use the DAQ at the same time as the HV test, so only one thread talks to it at a time
+        self.lock = threading.RLock()
         print(f"{self.prefix} --> Connected to {self.keysight.query('*IDN?')}")
         self.keysight.write("*RST")
 
@@ -67,39 +71,43 @@ class Keysight970A:
                 self.fan_ch_list += (f",{ch_string}")
 
     def clear_scan_list(self):
-        self.keysight.write("ROUTe:SCAN (@)")
+        with self.lock:
+            self.keysight.write("ROUTe:SCAN (@)")
 
     def initialize_rtd(self):
         #Keysight DAQ970A requires you to do a Configure first and then change the parameters with Sense
         #Configure sets the resistance of the RTD, and default resolution
         #It also updates the scan list so only the channels in this Configure command are scanned
-        self.keysight.write(f"CONFigure:TEMPerature:RTD {self.json_data['keysight970a_rtd_RES']},DEF,({self.rtd_ch_list})")
+        with self.lock:
+            self.keysight.write(f"CONFigure:TEMPerature:RTD {self.json_data['keysight970a_rtd_RES']},DEF,({self.rtd_ch_list})")
 
-        #Sets the sample rate a little slower for accuracy, whether in low power mode or not, and units to use
-        self.keysight.write(f"SENSe:TEMPerature:NPLCycles {self.json_data['keysight970a_rtd_NPLcycles']},({self.rtd_ch_list})")
-        self.keysight.write(f"SENSe:TEMPerature:TRANsducer:RTD:POWer:LIMit:STATe {self.json_data['keysight970a_rtd_LowPower']},({self.rtd_ch_list})")
-        self.keysight.write(f"UNIT:TEMPerature {self.json_data['keysight970a_rtd_units']},({self.rtd_ch_list})")
-        self.keysight.write("FORMat:READing:CHANnel ON")
+            #Sets the sample rate a little slower for accuracy, whether in low power mode or not, and units to use
+            self.keysight.write(f"SENSe:TEMPerature:NPLCycles {self.json_data['keysight970a_rtd_NPLcycles']},({self.rtd_ch_list})")
+            self.keysight.write(f"SENSe:TEMPerature:TRANsducer:RTD:POWer:LIMit:STATe {self.json_data['keysight970a_rtd_LowPower']},({self.rtd_ch_list})")
+            self.keysight.write(f"UNIT:TEMPerature {self.json_data['keysight970a_rtd_units']},({self.rtd_ch_list})")
+            self.keysight.write("FORMat:READing:CHANnel ON")
 
-        self.state = "rtd"
+            self.state = "rtd"
 
     def initialize_resistance(self):
-        self.keysight.write(f"CONFigure:RESistance AUTO,DEF,({self.heater_ch_list})")
-        self.keysight.write(f"SENSe:RESistance:NPLCycles {self.json_data['keysight970a_heater_NPLcycles']},({self.heater_ch_list})")
-        self.keysight.write(f"SENSe:RESistance:POWer:LIMit:STATe {self.json_data['keysight970a_heater_LowPower']},({self.heater_ch_list})")
-        self.keysight.write(f"SENSe:RESistance:OCOMpensated {self.json_data['keysight970a_heater_ocomp']},({self.heater_ch_list})")
-        self.keysight.write("FORMat:READing:CHANnel ON")
+        with self.lock:
+            self.keysight.write(f"CONFigure:RESistance AUTO,DEF,({self.heater_ch_list})")
+            self.keysight.write(f"SENSe:RESistance:NPLCycles {self.json_data['keysight970a_heater_NPLcycles']},({self.heater_ch_list})")
+            self.keysight.write(f"SENSe:RESistance:POWer:LIMit:STATe {self.json_data['keysight970a_heater_LowPower']},({self.heater_ch_list})")
+            self.keysight.write(f"SENSe:RESistance:OCOMpensated {self.json_data['keysight970a_heater_ocomp']},({self.heater_ch_list})")
+            self.keysight.write("FORMat:READing:CHANnel ON")
 
-        self.state = "resistance"
+            self.state = "resistance"
 
     def initialize_fan(self):
-        self.keysight.write(f"CONFigure:VOLTage:DC AUTO,DEF,({self.fan_ch_list})")
-        self.keysight.write(f"SENSe:VOLTage:DC:NPLCycles {self.json_data['keysight970a_fan_NPLcycles']},({self.fan_ch_list})")
-        self.keysight.write(f"SENSe:VOLTage:DC:ZERO:AUTO {self.json_data['keysight970a_fan_autozero']},({self.fan_ch_list})")
-        self.keysight.write(f"SENSe:VOLTage:DC:IMPedance:AUTO {self.json_data['keysight970a_fan_autoimpedance']},({self.fan_ch_list})")
-        self.keysight.write("FORMat:READing:CHANnel ON")
+        with self.lock:
+            self.keysight.write(f"CONFigure:VOLTage:DC AUTO,DEF,({self.fan_ch_list})")
+            self.keysight.write(f"SENSe:VOLTage:DC:NPLCycles {self.json_data['keysight970a_fan_NPLcycles']},({self.fan_ch_list})")
+            self.keysight.write(f"SENSe:VOLTage:DC:ZERO:AUTO {self.json_data['keysight970a_fan_autozero']},({self.fan_ch_list})")
+            self.keysight.write(f"SENSe:VOLTage:DC:IMPedance:AUTO {self.json_data['keysight970a_fan_autoimpedance']},({self.fan_ch_list})")
+            self.keysight.write("FORMat:READing:CHANnel ON")
 
-        self.state = "fan"
+            self.state = "fan"
 
     #Sets the output channels for the HV relay control. Easier to split it into 2 blocks with separate functions
     def set_relay(self, hv, term):
@@ -113,51 +121,84 @@ class Keysight970A:
             print(f"{self.prefix} --> HV value is {term}, it needs to be between 0 and 255")
             return 0
 
-        self.keysight.write(f"SOURce:DIGital:DATA:BYTE {hv},(@{self.json_data['keysight970a_907A_slot']}01)")
-        self.keysight.write(f"SOURce:DIGital:DATA:BYTE {term},(@{self.json_data['keysight970a_907A_slot']}02)")
+        with self.lock:
+            self.keysight.write(f"SOURce:DIGital:DATA:BYTE {hv},(@{self.json_data['keysight970a_907A_slot']}01)")
+            self.keysight.write(f"SOURce:DIGital:DATA:BYTE {term},(@{self.json_data['keysight970a_907A_slot']}02)")
+            self.relay_hv_state = hv
+            self.relay_term_state = term
+
+    #Opens a new session after the old one broke, without the *RST and setup from __init__, the scan list strings are already built
+    #The DAQ keeps its configuration and relay outputs through a dropped connection, so the scan list and relay bytes are only checked
+    #The measurement setup is only sent again if the scan list is gone, and the relays only if either byte isn't what was last set
+    #Returns the setup that had to be sent again, if any
+    def reconnect(self, rm):
+        with self.lock:
+            try:
+                self.keysight.close()
+            except Exception:
+                pass
+            self.keysight = rm.open_resource(self.address)
+            if (self.keysight.query("*OPC?").strip() != "1"):
+                raise ConnectionError(f"{self.prefix} --> DAQ at {self.address} didn't answer after reconnecting")
+            replayed = []
+            if (self.state is not None and not re.search(r"@\d", self.keysight.query("ROUTe:SCAN?"))):
+                getattr(self, f"initialize_{self.state}")()
+                replayed.append(self.state)
+            if (self.relay_hv_state is not None):
+                slot = self.json_data['keysight970a_907A_slot']
+                hv = int(float(self.keysight.query(f"SOURce:DIGital:DATA:BYTE? (@{slot}01)")))
+                term = int(float(self.keysight.query(f"SOURce:DIGital:DATA:BYTE? (@{slot}02)")))
+                if (hv != self.relay_hv_state or term != self.relay_term_state):
+                    self.set_relay(self.relay_hv_state, self.relay_term_state)
+                    replayed.append("relays")
+            return replayed
 
 
     def measure_rtd(self):
-        if (self.state != "rtd"):
-            print(f"{self.prefix} --> Tried to measure temperature without being in the temperature state! State is {self.state}!")
-            return None
-        #Response is something like
-        #['+9.90000000E+2', '101', '+9.90000000E+2', '102', '+9.90000000E+1', '103', '+9.90000000E+0', '104\n']
-        #Get rid of /n at the end of the string
-        resp = self.keysight.query("READ?", delay = self.json_data['keysight970a_rtd_delay']).strip()
-        #Split commas into lists
-        sep = resp.split(",")
-        #Make a dictionary with the channel as the key and the float reading as value
-        results = {}
-        for i in range(0,(self.num_rtds * 2)-1,2):
-            results[self.rtd_convert[f"{sep[i+1]}"]] = float(sep[i])
-
-        return results
+        with self.lock:
+            if (self.state != "rtd"):
+                print(f"{self.prefix} --> Tried to measure temperature without being in the temperature state! State is {self.state}!")
+                return None
+            #Response is something like
+            #['+9.90000000E+2', '101', '+9.90000000E+2', '102', '+9.90000000E+1', '103', '+9.90000000E+0', '104\n']
+            #Get rid of /n at the end of the string
+            resp = self.keysight.query("READ?", delay = self.json_data['keysight970a_rtd_delay']).strip()
+            #Split commas into lists
+            sep = resp.split(",")
+            #Make a dictionary with the channel as the key and the float reading as value
+            results = {}
+            for i in range(0,(self.num_rtds * 2)-1,2):
+                results[self.rtd_convert[f"{sep[i+1]}"]] = float(sep[i])
+
+            return results
 
     def measure_resistance(self):
-        if (self.state != "resistance"):
-            print(f"{self.prefix} --> Tried to measure resistance without being in the resistance state! State is {self.state}!")
-            return None
-        resp = self.keysight.query("READ?", delay = self.json_data['keysight970a_heater_delay']).strip()
-        sep = resp.split(",")
-        results = {}
-        for i in range(0,(self.num_rtds * 2)-1,2):
-            results[self.heater_convert[f"{sep[i+1]}"]] = float(sep[i])
-
-        return results
+        with self.lock:
+            if (self.state != "resistance"):
+                print(f"{self.prefix} --> Tried to measure resistance without being in the resistance state! State is {self.state}!")
+                return None
+            resp = self.keysight.query("READ?", delay = self.json_data['keysight970a_heater_delay']).strip()
+            sep = resp.split(",")
+            results = {}
+            for i in range(0,(self.num_rtds * 2)-1,2):
+                results[self.heater_convert[f"{sep[i+1]}"]] = float(sep[i])
+
+            return results
 
     def measure_fan(self):
-        if (self.state != "fan"):
-            print(f"{self.prefix} --> Tried to measure fan without being in the fan state! State is {self.state}!")
-            return None
-        resp = self.keysight.query("READ?", delay = self.json_data['keysight970a_fan_delay']).strip()
-        #Split commas into lists
-        sep = resp.split(",")
-        results = {}
-        for i in range(0,(self.num_fans * 2)-1,2):
-            results[self.fan_convert[f"{sep[i+1]}"]] = float(sep[i])
-
-        return results
+        with self.lock:
+            if (self.state != "fan"):
+                print(f"{self.prefix} --> Tried to measure fan without being in the fan state! State is {self.state}!")
+                return None
+            resp = self.keysight.query("READ?", delay = self.json_data['keysight970a_fan_delay']).strip()
+            #Split commas into lists
+            sep = resp.split(",")
+            results = {}
+            for i in range(0,(self.num_fans * 2)-1,2):
+                results[self.fan_convert[f"{sep[i+1]}"]] = float(sep[i])
+
+            return results
 
     def beep(self):
-        self.keysight.write("SYSTem:BEEPer:IMMediate")
+        with self.lock:
+            self.keysight.write("SYSTem:BEEPer:IMMediate")
@@ -0,0 +1,77 @@
+import time
+import statistics
+from datetime import datetime
+
+#Takes samples at a fixed interval for a fixed duration without spinning the CPU
+#The deadlines are all computed from the start on the monotonic clock, so they don't drift if one sample runs long
+#Use it like:
+#   sampler = PeriodicSampler(1, 300)
+#   for elapsed in sampler.samples():
+#       take_measurement()
+#   stats = sampler.stats()
+class PeriodicSampler:
+    def __init__(self, interval, duration):
+        self.prefix = "Periodic Sampler"    #Prefix for log messages
+        self.interval = interval            #Seconds between deadlines
+        self.duration = duration            #Seconds to keep sampling for
+        self.start_time = None              #Monotonic time at the start, everything is relative to this
+        self.start_wall_time = None         #Wall clock time at the start, only for turning samples into datetimes
+        self.sample_times = []              #Seconds since the start that each sample actually happened
+        self.jitter = []                    #Seconds that each sample happened after its deadline
+        self.missed_deadlines = 0           #Deadlines that were skipped because the previous sample ran past them
+        self.overruns = 0                   #Samples whose measurement took longer than the interval
+
+    #Generator that sleeps until each deadline and then yields the seconds since the start
+    #The code in the loop body is the measurement, and the time it takes is checked for overruns
+    def samples(self):
+        self.start_time = time.monotonic()
+        self.start_wall_time = time.time()
+        end_time = self.start_time + self.duration
+        num = 0
+        deadline = self.start_time
+        while (deadline < end_time):
+            now = time.monotonic()
+            if (now < deadline):
+                time.sleep(deadline - now)
+                now = time.monotonic()
+            elapsed = now - self.start_time
+            self.sample_times.append(elapsed)
+            self.jitter.append(now - deadline)
+            yield elapsed
+
+            done = time.monotonic()
+            if (done - now > self.interval):
+                self.overruns += 1
+            num += 1
+            deadline = self.start_time + (num * self.interval)
+            #If we're already a full interval or more past the next deadline, those samples are lost
+            #Skip them rather than firing a burst of samples back to back to catch up
+            if (done - deadline >= self.interval):
+                skipped = int((done - deadline) // self.interval)
+                self.missed_deadlines += skipped
+                num += skipped
+                deadline = self.start_time + (num * self.interval)
+
+    #The wall clock time of a sample, based on the monotonic offset so it can't jump if the system clock changes
+    def timestamp(self, elapsed):
+        return datetime.fromtimestamp(self.start_wall_time + elapsed)
+
+    #Summary of how well the schedule was kept, meant to go into the datastore JSON
+    def stats(self):
+        results = {}
+        results['interval'] = self.interval
+        results['duration'] = self.duration
+        results['samples'] = len(self.sample_times)
+        results['missed_deadlines'] = self.missed_deadlines
+        results['overruns'] = self.overruns
+        if (self.jitter):
+            results['jitter_mean'] = statistics.fmean(self.jitter)
+            results['jitter_max'] = max(self.jitter)
+        else:
+            results['jitter_mean'] = None
+            results['jitter_max'] = None
+        if (len(self.jitter) > 1):
+            results['jitter_stdev'] = statistics.stdev(self.jitter)
+        else:
+            results['jitter_stdev'] = None
+        return results
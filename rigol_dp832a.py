@@ -5,14 +5,19 @@ Created on Wed Sept 25 10:51:58 2023
 @author: Eraguzin
 """
 
-import time
+import threading
+import pyvisa
+from settling import wait_until_stable
 
 class RigolDP832A:
     def __init__(self, rm, json_data, index):
         self.prefix = "Rigol DP832A"
         self.json_data = json_data
         #There are 2 Rigols in this setup, the index determines which one this is
-        self.rigol = rm.open_resource(self.json_data[f'rigol832a{index}'])
+        self.address = self.json_data[f'rigol832a{index}']
+        self.rigol = rm.open_resource(self.address)
+        #The fan and HV tests can use different channels of the same supply at the same time, so only one thread talks to it at a time
+        self.lock = threading.RLock()
         print(f"{self.prefix} --> Connected to {self.rigol.query('*IDN?')}")
         self.rigol.write("*RST")
         self.rigol.write("SYSTem:BEEPer:STATe ON")
@@ -20,51 +25,104 @@ class RigolDP832A:
         self.channels = []
         self.index = index
         self.channel_num = 3
+        #Each channel name to (local channel number, voltage, current, the setup commands), so a reconnect can check it and put it back
+        self.setups = {}
+        #How long each output took to settle after being turned on or off, for the results JSON
+        self.settle_times = []
+        #Each channel name to the last state it was turned to, so a rebuilt supply can turn the same outputs back on
+        self.outputs = {}
 
     #This way of initializing each channel and then adding it to a list that gets checked ensures that the higher level test code doesn't mistake which type of channel is on which Rigol
     #So the first Rigol has channels 1,2, and 3. The second Rigol has channels 4,5, and 6. And this converts it to the local Rigol nomenclature
     def setup_fan(self):
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_fan_ch'] - (self.channel_num * self.index)}:VOLTage:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_fan_voltage']}")
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_fan_ch'] - (self.channel_num * self.index)}:CURRent:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_fan_current']}")
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_fan_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:LEVel {self.json_data['rigol832a_fan_overcurrent']}")
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_fan_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:STATe {self.json_data['rigol832a_fan_overcurrent_en']}")
+        commands = []
+        commands.append(f"SOURce{self.json_data['rigol832a_fan_ch'] - (self.channel_num * self.index)}:VOLTage:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_fan_voltage']}")
+        commands.append(f"SOURce{self.json_data['rigol832a_fan_ch'] - (self.channel_num * self.index)}:CURRent:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_fan_current']}")
+        commands.append(f"SOURce{self.json_data['rigol832a_fan_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:LEVel {self.json_data['rigol832a_fan_overcurrent']}")
+        commands.append(f"SOURce{self.json_data['rigol832a_fan_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:STATe {self.json_data['rigol832a_fan_overcurrent_en']}")
+        self.setup_channel("fan", self.json_data['rigol832a_fan_ch'] - (self.channel_num * self.index),
+                           self.json_data['rigol832a_fan_voltage'], self.json_data['rigol832a_fan_current'], commands)
         self.channels.append("fan")
 
     def setup_heater_supply(self):
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_heater_supply_ch'] - (self.channel_num * self.index)}:VOLTage:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_heater_supply_voltage']}")
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_heater_supply_ch'] - (self.channel_num * self.index)}:CURRent:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_heater_supply_current']}")
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_heater_supply_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:LEVel {self.json_data['rigol832a_heater_supply_overcurrent']}")
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_heater_supply_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:STATe {self.json_data['rigol832a_heater_supply_overcurrent_en']}")
+        commands = []
+        commands.append(f"SOURce{self.json_data['rigol832a_heater_supply_ch'] - (self.channel_num * self.index)}:VOLTage:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_heater_supply_voltage']}")
+        commands.append(f"SOURce{self.json_data['rigol832a_heater_supply_ch'] - (self.channel_num * self.index)}:CURRent:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_heater_supply_current']}")
+        commands.append(f"SOURce{self.json_data['rigol832a_heater_supply_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:LEVel {self.json_data['rigol832a_heater_supply_overcurrent']}")
+        commands.append(f"SOURce{self.json_data['rigol832a_heater_supply_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:STATe {self.json_data['rigol832a_heater_supply_overcurrent_en']}")
+        self.setup_channel("heat_supply", self.json_data['rigol832a_heater_supply_ch'] - (self.channel_num * self.index),
+                           self.json_data['rigol832a_heater_supply_voltage'], self.json_data['rigol832a_heater_supply_current'], commands)
         self.channels.append("heat_supply")
 
     def setup_heater_switch(self):
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_heater_switch_ch'] - (self.channel_num * self.index)}:VOLTage:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_heater_switch_voltage']}")
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_heater_switch_ch'] - (self.channel_num * self.index)}:CURRent:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_heater_switch_current']}")
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_heater_switch_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:LEVel {self.json_data['rigol832a_heater_switch_overcurrent']}")
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_heater_switch_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:STATe {self.json_data['rigol832a_heater_switch_overcurrent_en']}")
+        commands = []
+        commands.append(f"SOURce{self.json_data['rigol832a_heater_switch_ch'] - (self.channel_num * self.index)}:VOLTage:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_heater_switch_voltage']}")
+        commands.append(f"SOURce{self.json_data['rigol832a_heater_switch_ch'] - (self.channel_num * self.index)}:CURRent:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_heater_switch_current']}")
+        commands.append(f"SOURce{self.json_data['rigol832a_heater_switch_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:LEVel {self.json_data['rigol832a_heater_switch_overcurrent']}")
+        commands.append(f"SOURce{self.json_data['rigol832a_heater_switch_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:STATe {self.json_data['rigol832a_heater_switch_overcurrent_en']}")
+        self.setup_channel("heat_switch", self.json_data['rigol832a_heater_switch_ch'] - (self.channel_num * self.index),
+                           self.json_data['rigol832a_heater_switch_voltage'], self.json_data['rigol832a_heater_switch_current'], commands)
         self.channels.append("heat_switch")
 
     def setup_hvpullup(self):
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_hvpullup_ch'] - (self.channel_num * self.index)}:VOLTage:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_hvpullup_voltage']}")
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_hvpullup_ch'] - (self.channel_num * self.index)}:CURRent:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_hvpullup_current']}")
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_hvpullup_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:LEVel {self.json_data['rigol832a_hvpullup_overcurrent']}")
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_hvpullup_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:STATe {self.json_data['rigol832a_hvpullup_overcurrent_en']}")
+        commands = []
+        commands.append(f"SOURce{self.json_data['rigol832a_hvpullup_ch'] - (self.channel_num * self.index)}:VOLTage:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_hvpullup_voltage']}")
+        commands.append(f"SOURce{self.json_data['rigol832a_hvpullup_ch'] - (self.channel_num * self.index)}:CURRent:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_hvpullup_current']}")
+        commands.append(f"SOURce{self.json_data['rigol832a_hvpullup_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:LEVel {self.json_data['rigol832a_hvpullup_overcurrent']}")
+        commands.append(f"SOURce{self.json_data['rigol832a_hvpullup_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:STATe {self.json_data['rigol832a_hvpullup_overcurrent_en']}")
+        self.setup_channel("hvpullup", self.json_data['rigol832a_hvpullup_ch'] - (self.channel_num * self.index),
+                           self.json_data['rigol832a_hvpullup_voltage'], self.json_data['rigol832a_hvpullup_current'], commands)
         self.channels.append("hvpullup")
 
     def setup_hvpullup2(self):
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_hvpullup2_ch'] - (self.channel_num * self.index)}:VOLTage:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_hvpullup2_voltage']}")
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_hvpullup2_ch'] - (self.channel_num * self.index)}:CURRent:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_hvpullup2_current']}")
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_hvpullup2_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:LEVel {self.json_data['rigol832a_hvpullup2_overcurrent']}")
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_hvpullup2_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:STATe {self.json_data['rigol832a_hvpullup2_overcurrent_en']}")
+        commands = []
+        commands.append(f"SOURce{self.json_data['rigol832a_hvpullup2_ch'] - (self.channel_num * self.index)}:VOLTage:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_hvpullup2_voltage']}")
+        commands.append(f"SOURce{self.json_data['rigol832a_hvpullup2_ch'] - (self.channel_num * self.index)}:CURRent:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_hvpullup2_current']}")
+        commands.append(f"SOURce{self.json_data['rigol832a_hvpullup2_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:LEVel {self.json_data['rigol832a_hvpullup2_overcurrent']}")
+        commands.append(f"SOURce{self.json_data['rigol832a_hvpullup2_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:STATe {self.json_data['rigol832a_hvpullup2_overcurrent_en']}")
+        self.setup_channel("hvpullup2", self.json_data['rigol832a_hvpullup2_ch'] - (self.channel_num * self.index),
+                           self.json_data['rigol832a_hvpullup2_voltage'], self.json_data['rigol832a_hvpullup2_current'], commands)
         self.channels.append("hvpullup2")
 
     def setup_fanread(self):
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_fanread_ch'] - (self.channel_num * self.index)}:VOLTage:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_fanread_voltage']}")
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_fanread_ch'] - (self.channel_num * self.index)}:CURRent:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_fanread_current']}")
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_fanread_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:LEVel {self.json_data['rigol832a_fanread_overcurrent']}")
-        self.rigol.write(f"SOURce{self.json_data['rigol832a_fanread_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:STATe {self.json_data['rigol832a_fanread_overcurrent_en']}")
+        commands = []
+        commands.append(f"SOURce{self.json_data['rigol832a_fanread_ch'] - (self.channel_num * self.index)}:VOLTage:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_fanread_voltage']}")
+        commands.append(f"SOURce{self.json_data['rigol832a_fanread_ch'] - (self.channel_num * self.index)}:CURRent:LEVel:IMMediate:AMPLitude {self.json_data['rigol832a_fanread_current']}")
+        commands.append(f"SOURce{self.json_data['rigol832a_fanread_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:LEVel {self.json_data['rigol832a_fanread_overcurrent']}")
+        commands.append(f"SOURce{self.json_data['rigol832a_fanread_ch'] - (self.channel_num * self.index)}:CURRent:PROTection:STATe {self.json_data['rigol832a_fanread_overcurrent_en']}")
+        self.setup_channel("fanread", self.json_data['rigol832a_fanread_ch'] - (self.channel_num * self.index),
+                           self.json_data['rigol832a_fanread_voltage'], self.json_data['rigol832a_fanread_current'], commands)
         self.channels.append("fanread")
 
+    def setup_channel(self, name, chan, voltage, current, commands):
+        with self.lock:
+            for command in commands:
+                self.rigol.write(command)
+            self.setups[name] = (chan, voltage, current, commands)
+
+    #Opens a new session after the old one broke, without the *RST and full setup from __init__
+    #The supply keeps its settings and outputs through a dropped connection, so each channel's setpoints are only checked
+    #with one query, and a channel's setup is only sent again if they've changed. Outputs are left the way they were
+    #Returns the names of the channels that had to be set up again
+    def reconnect(self, rm):
+        with self.lock:
+            try:
+                self.rigol.close()
+            except Exception:
+                pass
+            self.rigol = rm.open_resource(self.address)
+            if (self.rigol.query("*OPC?").strip() != "1"):
+                raise ConnectionError(f"{self.prefix} --> Supply {self.index} at {self.address} didn't answer after reconnecting")
+            replayed = []
+            for name, (chan, voltage, current, commands) in self.setups.items():
+                #Answers like CH1:30V/3A,5.000,1.0000
+                setting = self.rigol.query(f"APPLy? CH{chan}").strip().split(",")
+                if (len(setting) < 3 or abs(float(setting[-2]) - voltage) > 0.001 or abs(float(setting[-1]) - current) > 0.001):
+                    for command in commands:
+                        self.rigol.write(command)
+                    replayed.append(name)
+            return replayed
+
     #Because I want to decouple the name of the channel with the actual number, this will need to be called every time
     def get_ch_with_name(self, ch):
         if (ch == "fan" and "fan" in self.channels):
@@ -84,33 +142,54 @@ class RigolDP832A:
             print(f"{self.prefix} --> WARNING: Channels initialized for Rigol {self.index} are {self.channels}")
             return 0
 
-    def power(self, onoff, ch):
+    #settle=False skips waiting for the output to settle, for an emergency shutoff where the next output should go off straight away
+    def power(self, onoff, ch, settle=True):
         if (onoff == "ON" or onoff == "OFF"):
             chan = self.get_ch_with_name(ch)
             if (chan != 0):
-                self.rigol.write(f"OUTPut:STATe CH{chan},{onoff}")
-                time.sleep(1)
+                with self.lock:
+                    self.rigol.write(f"OUTPut:STATe CH{chan},{onoff}")
+                    self.outputs[ch] = onoff
+                if (settle):
+                    self.settle_output(ch, onoff)
                 print(f"{self.prefix} --> Turned {onoff} Power Supply {self.index+1}, {ch}- Channel {chan}")
         else:
             print(f"{self.prefix} --> WARNING: Did not understand on/off choise {onoff}")
 
+    #Waits for the output voltage to stop moving, which is usually a lot less than the second it used to always wait
+    #The output has already been switched, so a query that fails here is only printed, it doesn't undo that
+    def settle_output(self, ch, onoff):
+        try:
+            result = wait_until_stable(lambda: self.get_voltage(ch), self.json_data.get('rigol832a_power_settle_tolerance', 0.05), 3,
+                                       0, self.json_data.get('rigol832a_power_settle_max', 1), 0.1)
+        except pyvisa.errors.VisaIOError as e:
+            print(f"{self.prefix} --> Couldn't read {ch} back while it settled: {e!r}")
+            return
+        result['channel'] = ch
+        result['state'] = onoff
+        self.settle_times.append(result)
+
     def get_current(self, ch):
         chan = self.get_ch_with_name(ch)
         if (chan != 0):
-            curr = self.rigol.query(f"MEASure:CURRent:DC? CH{chan}")
+            with self.lock:
+                curr = self.rigol.query(f"MEASure:CURRent:DC? CH{chan}")
             return float(curr)
 
     def get_voltage(self, ch):
         chan = self.get_ch_with_name(ch)
         if (chan != 0):
-            volt = self.rigol.query(f"MEASure:VOLTage:DC? CH{chan}")
+            with self.lock:
+                volt = self.rigol.query(f"MEASure:VOLTage:DC? CH{chan}")
             return float(volt)
 
     def check_overcurr_protection(self, ch):
         chan = self.get_ch_with_name(ch)
         if (chan != 0):
-            status = self.rigol.query(f"SOURce{chan}:CURRent:PROTection:TRIPped?")
+            with self.lock:
+                status = self.rigol.query(f"SOURce{chan}:CURRent:PROTection:TRIPped?")
             return status
 
     def beep(self):
-        self.rigol.write("SYSTem:BEEPer:IMMediate")
+        with self.lock:
+            self.rigol.write("SYSTem:BEEPer:IMMediate")
@@ -0,0 +1,32 @@
+import time
+import numpy as np
+
+#Waits for a measurement to stop changing, instead of sleeping for a fixed time that has to cover the slowest case
+#measure is called every poll_interval seconds and can give back one number or several, like one reading per channel
+#It's stable once the last window readings of every value are all within tolerance of each other. tolerance can be one number or
+#one per value. It never returns before min_wait, and gives up at max_wait, which is the old fixed wait, so it's never slower than that
+#Returns a dictionary of how long it took and whether it settled, meant to go into the datastore JSON
+#Use it like:
+#   result = wait_until_stable(lambda: rigol.get_current("fan"), 0.01, 5, min_wait=1, max_wait=5)
+def wait_until_stable(measure, tolerance, window=3, min_wait=0, max_wait=60, poll_interval=0.5):
+    start = time.monotonic()
+    readings = []
+    settled = False
+    while (True):
+        readings.append(np.atleast_1d(np.asarray(measure(), dtype=float)))
+        elapsed = time.monotonic() - start
+        if (len(readings) >= window):
+            recent = np.array(readings[-window:])
+            settled = bool(np.all(np.ptp(recent, axis=0) <= tolerance))
+        else:
+            settled = False
+        if ((settled and elapsed >= min_wait) or elapsed >= max_wait):
+            break
+        time.sleep(min(poll_interval, max_wait - elapsed))
+    result = {}
+    result['settled'] = settled
+    result['time'] = elapsed
+    result['readings'] = len(readings)
+    result['max_wait'] = max_wait
+    result['last'] = readings[-1].tolist()
+    return result
@@ -0,0 +1,116 @@
+import time
+import threading
+
+#Raised in a step that was told to stop because another step failed
+class StepAborted(Exception):
+    pass
+
+#Runs the test steps at the same time when they don't need the same parts of the setup
+#Each step lists the resources it uses, like "rigol0" or "keysight.901A" for the DAQ's mux card, and a step only starts once
+#none of its resources are being used by a running step. Steps start in the order they were added, and a step never jumps ahead of
+#an earlier one that's waiting on the same resource, so steps that share something still run in the order they're listed
+#Two steps can share an instrument's session as long as they use different resources on it, the instrument classes lock their sessions
+#If a step fails nothing new is started, on_failure is called right away from the failing step's thread so the setup can be made safe,
+#the steps still running are told to stop, and the error is raised here without waiting for them
+#The steps stop themselves by calling check() between measurements and sleep() instead of time.sleep, which raise StepAborted
+#With threaded=False every step runs one after the other in the calling thread, the same as calling them in order
+#Use it like:
+#   scheduler = StepScheduler(on_failure=emergency_shutoff)
+#   scheduler.add("fan", fan_test, ["rigol0", "keysight.901A"])
+#   scheduler.add("hv", hv_test, ["caen", "keysight.907A"])
+#   scheduler.run()
+#   scheduler.stats()       #When each step started and finished, meant to go into the datastore JSON
+class StepScheduler:
+    def __init__(self, threaded=True, on_failure=None):
+        self.prefix = "Test Scheduler"          #Prefix for log messages
+        self.threaded = threaded
+        self.on_failure = on_failure            #Called once, from the thread of the first step that fails
+        self.steps = []                         #(name, function, resources) in the order they were added
+        self.times = {}                         #Step name to when it started and finished, in seconds from the start of run()
+        self.total = None
+        self.condition = threading.Condition()  #Guards busy, running and failures, and wakes run() when a step finishes
+        self.busy = set()                       #Resources held by the steps that are running
+        self.running = set()
+        self.failures = []                      #(name, exception) of every step that failed
+        self.aborted = threading.Event()        #Set once a step has failed, the other steps stop at their next check()
+
+    def add(self, name, function, resources):
+        self.steps.append((name, function, frozenset(resources)))
+
+    def run(self):
+        self.start = time.monotonic()
+        if (not self.threaded):
+            for name, function, resources in self.steps:
+                self.timed(name, function)
+            self.total = time.monotonic() - self.start
+            return
+        pending = list(self.steps)
+        with self.condition:
+            while ((pending or self.running) and not self.failures):
+                blocked = set()
+                for step in list(pending):
+                    name, function, resources = step
+                    if (not (resources & self.busy) and not (resources & blocked)):
+                        pending.remove(step)
+                        self.busy |= resources
+                        if (self.running):
+                            print(f"{self.prefix} --> Starting {name} alongside {sorted(self.running)}")
+                        self.running.add(name)
+                        threading.Thread(target=self.run_step, args=step, name=f"test step {name}", daemon=True).start()
+                    blocked |= resources
+                if (self.running):
+                    self.condition.wait()
+            running = sorted(self.running)
+        self.total = time.monotonic() - self.start
+        if (self.failures):
+            name, error = self.failures[0]
+            print(f"{self.prefix} --> {name} failed")
+            if (pending):
+                print(f"{self.prefix} --> {[step[0] for step in pending]} weren't started")
+            if (running):
+                print(f"{self.prefix} --> {running} were told to stop")
+            raise error
+
+    def run_step(self, name, function, resources):
+        try:
+            self.timed(name, function)
+        except BaseException as e:
+            with self.condition:
+                self.failures.append((name, e))
+                first = not self.aborted.is_set()
+                self.aborted.set()
+            #Outside the condition, so the other steps can still finish up while the setup is made safe
+            if (first and not isinstance(e, StepAborted) and self.on_failure):
+                try:
+                    self.on_failure()
+                except BaseException as shutoff_error:
+                    print(f"{self.prefix} --> on_failure after {name} failed raised {shutoff_error!r}")
+        finally:
+            with self.condition:
+                self.busy -= resources
+                self.running.discard(name)
+                self.condition.notify()
+
+    def timed(self, name, function):
+        self.times[name] = {"start": time.monotonic() - self.start, "end": None}
+        try:
+            function()
+        finally:
+            self.times[name]["end"] = time.monotonic() - self.start
+
+    #Called by a step between measurements, raises StepAborted once another step has failed
+    def check(self):
+        if (self.aborted.is_set()):
+            raise StepAborted(f"{self.prefix} --> Stopped because another step failed")
+
+    #time.sleep that wakes up and raises StepAborted as soon as another step fails
+    def sleep(self, seconds):
+        if (self.aborted.wait(seconds)):
+            self.check()
+
+    def stats(self):
+        results = {}
+        results['concurrent'] = self.threaded
+        results['steps'] = self.times
+        results['total'] = self.total
+        return results
@@ -0,0 +1,65 @@
+import time
+import pyvisa
+
+#Gets the VISA instruments talking again after a connection drops, without setting every one of them up from scratch
+#Each instrument is asked *OPC? first, and only the ones that don't answer are reconnected. A reconnect only opens a new session
+#and checks the instrument with a query or two, its own reconnect function decides if any of its setup has to be sent again
+#If that fails too, rebuild is called with the instrument's name to make it the old way, with *IDN?, *RST and the full setup
+#Use it like:
+#   reconnects = ReconnectManager(rm)
+#   reconnects.recover({"rigol0": r0, "rigol1": r1, "keysight": k}, rebuild)
+#   reconnects.stats()      #Counts and times for each instrument, meant to go into the datastore JSON
+class ReconnectManager:
+    def __init__(self, rm, probe_timeout=2000):
+        self.prefix = "VISA Reconnect"      #Prefix for log messages
+        self.rm = rm
+        self.probe_timeout = probe_timeout  #Milliseconds to wait for *OPC? before deciding a session is broken
+        self.history = {}                   #Instrument name to its counts and times
+
+    #Returns True if the instrument answers on the session it already has
+    def alive(self, session):
+        try:
+            timeout = session.timeout
+            session.timeout = self.probe_timeout
+            try:
+                return session.query("*OPC?").strip() == "1"
+            finally:
+                session.timeout = timeout
+        except Exception:
+            #Anything going wrong here, like a reset socket, a timeout or a closed session, means the session needs replacing
+            return False
+
+    #Checks every instrument and reconnects the broken ones. instruments maps a name to the instrument object,
+    #and rebuild(name) has to give back a fully set up new one. Returns the instruments, with any rebuilt ones swapped in
+    def recover(self, instruments, rebuild):
+        for name, instrument in instruments.items():
+            record = self.history.setdefault(name, {"checks": 0, "reconnects": 0, "rebuilds": 0, "reconnect_time": 0, "reconnect_time_max": 0, "replayed": []})
+            record["checks"] += 1
+            #Holding the instrument's lock so the probe can't get mixed up with another test step's query
+            with instrument.lock:
+                alive = self.alive(self.session(instrument))
+            if (alive):
+                continue
+            start = time.monotonic()
+            try:
+                replayed = instrument.reconnect(self.rm)
+                record["reconnects"] += 1
+                record["replayed"].extend(replayed)
+                print(f"{self.prefix} --> Reconnected {name} in {(time.monotonic() - start) * 1000:.0f} ms, sent setup again for {replayed if replayed else 'nothing'}")
+            except (OSError, ValueError, pyvisa.errors.Error) as e:
+                print(f"{self.prefix} --> Reconnecting {name} failed ({e!r}), setting it up from scratch")
+                instruments[name] = rebuild(name)
+                record["rebuilds"] += 1
+            seconds = time.monotonic() - start
+            record["reconnect_time"] += seconds
+            record["reconnect_time_max"] = max(record["reconnect_time_max"], seconds)
+        return instruments
+
+    #The VISA session inside each kind of instrument
+    def session(self, instrument):
+        if (hasattr(instrument, "rigol")):
+            return instrument.rigol
+        return instrument.keysight
+
+    def stats(self):
+        return self.history